@@ -0,0 +1,275 @@
+'''
+Angular momentum channels of the reaction-diffusion equation
+
+The radial operator in brownian_integrator describes the angular average of
+the density (the l = 0 channel). An initial condition that is not radially
+symmetric is expanded in Legendre polynomials of cos(theta), about an axis
+through the center of the potential,
+
+    y(r, theta, t) = sum_l y_l(r, t) P_l(cos theta)
+
+and since the potential and the reactive well are both centered, every channel
+obeys its own radial equation: the same spatial operator S less the
+centrifugal diagonal l(l+1)/r^2 (S carries the second derivative with a plus
+sign, and in the Laplacian the centrifugal term has the opposite one). The
+channels are stacked into one block-diagonal system that shares the cached
+radial operator, so that N channels cost about N times one radial solve, in a
+single integration
+
+    y0 = project_channels(lambda r, mu: 1 + .5*mu*r, space, ells=arange(4))
+    out = solve_radiff_channels(y0, settings, params, ells=arange(4),
+                                cos_theta=linspace(-1, 1, 50))
+    out['survival'], out['density']
+
+The operator is the same for every azimuthal number m, so non-axisymmetric
+initial conditions only need the same channels repeated; the projection and
+reconstruction here are for m = 0.
+
+Each channel inherits the spectrum of the radial operator, which has growing
+modes (see the README), and the centrifugal terms make them grow faster. So the
+channels only describe a physical density while the survival decays, and
+solve_radiff_channels warns when it does not.
+
+William Gilpin, 2015
+'''
+
+from numpy import *
+import warnings
+import scipy.sparse as sparse
+from numpy.polynomial.legendre import leggauss, legvander
+
+from brownian_integrator import *
+from rxndiff_solver import integrate_stacked
+
+
+def centrifugal_terms(space, ells):
+    '''
+    The diagonals l(l+1)/r^2 that each channel subtracts from the radial
+    operator S
+
+    RETURNS
+    -------
+
+    terms : array
+        An (L, N) array, one column per channel in ells
+    '''
+    allspace = asarray(space, dtype=double)
+    ells = asarray(ells, dtype=double)
+    return (ells*(ells + 1))[None, :]/(allspace**2)[:, None]
+
+
+def project_channels(profile_fn, space, ells, nquad=None):
+    '''
+    Expand an axisymmetric profile in Legendre polynomials of cos(theta)
+
+    profile_fn : function
+        profile_fn(r, mu) gives the profile relative to eq_dist at radii r and
+        mu = cos(theta), broadcasting over an (L, 1) array of radii and a
+        (1, nquad) array of angles
+
+    space : array
+        The radial grid
+
+    ells : array
+        The channels to keep
+
+    nquad : int
+        The number of Gauss-Legendre points in cos(theta). Defaults to enough
+        to integrate the highest channel of a smooth profile accurately
+
+    RETURNS
+    -------
+
+    y0 : array
+        An (L, N) array whose columns are the channel profiles y_l(r)
+    '''
+    ells = asarray(ells, dtype=int)
+    if nquad is None:
+        nquad = 2*int(amax(ells)) + 16
+    mus, wts = leggauss(nquad)
+    allspace = asarray(space, dtype=double)
+    profile = profile_fn(allspace[:, None], mus[None, :])*ones((len(allspace), nquad))
+    legendre = legvander(mus, int(amax(ells)))[:, ells]
+    return (profile*wts).dot(legendre)*((2*ells + 1)/2)
+
+
+def reconstruct_profile(channels, ells, cos_theta):
+    '''
+    Sum the channels back into the profile y(r, theta) relative to eq_dist
+
+    channels : array
+        An (L, N) array of channel profiles, or an (L, N, T) array of them
+
+    cos_theta : array
+        The values of cos(theta) at which to evaluate
+
+    RETURNS
+    -------
+
+    profile : array
+        An (L, len(cos_theta)) array, or (L, len(cos_theta), T)
+    '''
+    ells = asarray(ells, dtype=int)
+    legendre = legvander(asarray(cos_theta, dtype=double), int(amax(ells)))[:, ells]
+    return einsum('ik...,jk->ij...', channels, legendre)
+
+
+def reconstruct_density(channels, ells, space, params, cos_theta):
+    '''
+    The three-dimensional density c(r, theta) that the channels describe,
+    scaled so that its integral over all space is the surviving fraction.
+    For the l = 0 channel alone, 4 pi r^2 c(r) is the radial density
+    yvals*eq_dist of the other solvers. It is only a probability density
+    where the solution has stayed bounded
+
+    RETURNS
+    -------
+
+    density : array
+        An (L, len(cos_theta)) array, or (L, len(cos_theta), T)
+    '''
+    allspace = asarray(space, dtype=double)
+    profile = reconstruct_profile(channels, ells, cos_theta)
+    radial = eq_dist(allspace, params['POT_DIAM'])/(4*pi*allspace**2)
+    return profile*radial.reshape((-1,) + (1,)*(profile.ndim - 1))
+
+
+def radiff_channel_system(settings, params, ells, nondim=False):
+    '''
+    The right hand side and jacobian for N angular momentum channels advanced
+    together. The state is the (L, N) matrix Y of channel profiles flattened
+    column by column, and the equation is
+
+        dY/dt = -prefactor(t)*(S Y - C * Y) - rates * Y
+
+    with S the cached radial operator and C the centrifugal_terms. The
+    jacobian is block diagonal, with the same bandwidth as for one channel
+
+    RETURNS
+    -------
+
+    rhs : function
+        rhs(t, y) for the flattened state
+
+    jac : function
+        jac(t, y), the block-diagonal jacobian as a CSC matrix
+    '''
+    nch = len(ells)
+    spaceop, rxn_rates = radiff_parts(settings, params, nondim=nondim)
+    L = spaceop.shape[0]
+    cent = centrifugal_terms(settings['space'], ells)
+    stacked_op = (sparse.kron(sparse.identity(nch), spaceop)
+                  - sparse.diags(cent.T.ravel())).tocsc()
+    rxn_op = sparse.diags(tile(rxn_rates, nch)).tocsc()
+
+    def prefactor(t):
+        if nondim:
+            return 1.0
+        return diffusion_prefactor(t, params)
+
+    def rhs(t, y):
+        yvals = y.reshape(nch, L).T
+        nxt_vals = -prefactor(t)*(spaceop.dot(yvals) - cent*yvals) - rxn_rates[:, None]*yvals
+        return nxt_vals.T.ravel()
+
+    def jac(t, y):
+        return -prefactor(t)*stacked_op - rxn_op
+
+    return rhs, jac
+
+
+def solve_radiff_channels(y0, settings, params, ells, method='BDF', nondim=False,
+                          rtol=1e-6, atol=1e-12, output_times=None, keep_full=False,
+                          cos_theta=None):
+    '''
+    Integrate several angular momentum channels of one parameter point as a
+    single stacked system. The integration stops if the state stops being
+    finite, and a RuntimeWarning is raised if it fails or the survival grows in
+    magnitude,
+    since then the growing modes of the radial operator have taken over
+
+    y0 : array
+        An (L, N) array of initial channel profiles, e.g. from project_channels
+
+    settings : dict
+        settings['space'] and settings['times'] for the integration, and
+        optionally settings['stencil']
+
+    params : dict
+        The parameter values of the diffusion equation
+
+    ells : array
+        The angular momentum of each column of y0. Channels may repeat
+
+    method : str
+        'BDF' or 'Radau' (sparse jacobian), or 'LSODA' (banded jacobian)
+
+    output_times : array
+        The times at which to record, overriding settings['times']
+
+    keep_full : bool
+        Whether to also return the channel profiles, which are (L x N x time)
+
+    cos_theta : array
+        If given, the density is reconstructed at these angles at every output
+        time (see reconstruct_density)
+
+    RETURNS
+    -------
+
+    out : dict
+        out['times'], the output times that were reached
+        out['survival'], the surviving fraction, carried by the l = 0 channels
+        out['channels'], the channel profiles, if keep_full is True
+        out['density'], the reconstructed density, an (L x len(cos_theta) x time)
+        array, if cos_theta is given
+        out['success'], False if the integrator failed or the state blew up
+    '''
+    if output_times is None:
+        output_times = settings['times']
+    times = asarray(output_times, dtype=double)
+
+    ells = asarray(ells, dtype=int)
+    y0 = asarray(y0, dtype=double).reshape(len(settings['space']), -1)
+    L, nch = y0.shape
+    if len(ells) != nch:
+        raise ValueError("There must be one angular momentum per column of y0")
+
+    # the higher channels integrate to zero over the angles
+    weights = survival_weights(settings, params)
+    isotropic = (ells == 0)
+    surv = zeros(len(times))
+    if keep_full:
+        sol = zeros((L, nch, len(times)))
+    if cos_theta is not None:
+        density = zeros((L, len(cos_theta), len(times)))
+
+    def record(tind, y):
+        yvals = y.reshape(nch, L).T
+        surv[tind] = sum(weights.dot(yvals[:, isotropic]))
+        if keep_full:
+            sol[:, :, tind] = yvals
+        if cos_theta is not None:
+            density[:, :, tind] = reconstruct_density(yvals, ells, settings['space'], params,
+                                                      cos_theta)
+
+    rhs, jac = radiff_channel_system(settings, params, ells, nondim=nondim)
+    nsaved, success = integrate_stacked(rhs, jac, y0.T.ravel(), times, record, method=method,
+                                        rtol=rtol, atol=atol)
+    if not success:
+        warnings.warn("The channel integration failed or blew up after t = %g" % times[nsaved - 1],
+                      RuntimeWarning)
+    elif amax(abs(surv[:nsaved])) > (1 + sqrt(rtol))*abs(surv[0]):
+        warnings.warn("The survival grows to %g from %g, so the density is not physical"
+                      % (surv[argmax(abs(surv[:nsaved]))], surv[0]), RuntimeWarning)
+
+    out = dict()
+    out['times'] = times[:nsaved]
+    out['survival'] = surv[:nsaved]
+    out['success'] = success
+    if keep_full:
+        out['channels'] = sol[:, :, :nsaved]
+    if cos_theta is not None:
+        out['density'] = density[:, :, :nsaved]
+
+    return out
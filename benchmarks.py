@@ -0,0 +1,628 @@
+'''
+Benchmarks for operator assembly and the integrators
+
+Times each stage of a solve (assembling the operators, evaluating the right
+hand side and the jacobian, the integrators themselves, and parameter sweeps)
+over a range of grid sizes and numbers of output times, and writes wall times,
+peak memory and right hand side/jacobian call counts to a JSON file. Two such
+files, e.g. from two revisions, can then be compared to catch regressions.
+
+    python benchmarks.py                         # quick run, bench_output.json
+    python benchmarks.py --full -o full.json     # space_pts 50-10000, time_pts 1e3-1e6
+    python benchmarks.py --only rhs jacobian --space-pts 100 1000
+    python benchmarks.py --compare old.json new.json
+    python benchmarks.py --accuracy              # resolvent convergence of each stencil
+
+Cases whose dense matrices or full solution meshes would not fit in memory are
+recorded as skipped rather than run.
+
+The accuracy table compares the stencils of the spatial operator
+(SPACE_STENCILS) by how fast the discretized resolvent converges: the first
+two moments n! w.(-A)^-n y0 that survival_moments computes with one
+factorization, against a fine sixth-order reference, and the time taken to
+build the operator and compute them. It then lists the fewest grid points
+with which each stencil reaches each tolerance. These are the moments of the
+survival time only where the survival curve decays, which it does not at
+accuracy_params (the time dependent solves grow without bound there for every
+stencil, see the README), so the table measures the convergence of the
+operators and not the accuracy or the cost of a survival curve. The
+Chebyshev stencil is only run up to CHEBYSHEV_LIMIT points, past which its
+rounding error grows with the grid size.
+
+William Gilpin, 2015
+'''
+
+from numpy import *
+import os
+import sys
+import time
+import json
+import platform
+import argparse
+import subprocess
+import tracemalloc
+
+import scipy
+from scipy.integrate import ode
+
+from diffusion_integrator_funcs import *
+from brownian_integrator import *
+from rxndiff_solver import *
+from frac_brown import rk4_mesh, euler_mesh
+from sweeps import run_sweep
+from propagators import survival_moments
+
+
+QUICK_SPACE_PTS = (50, 200, 1000)
+QUICK_TIME_PTS = (1000, 10000)
+FULL_SPACE_PTS = (50, 200, 1000, 3000, 10000)
+FULL_TIME_PTS = (1000, 10000, 100000, 1000000)
+
+# the largest dense L x L matrix, and the largest stored (space x time) mesh
+DENSE_LIMIT = 3000
+MESH_LIMIT = 5e7
+
+QUICK_ACCURACY_PTS = (25, 50, 100, 200, 400)
+FULL_ACCURACY_PTS = (25, 50, 100, 200, 400, 800, 1600)
+ACCURACY_TOLERANCES = (1e-2, 1e-4, 1e-6)
+REFERENCE_PTS = 6400
+# the spectral derivatives lose accuracy on larger grids
+CHEBYSHEV_LIMIT = 100
+
+
+def bench_params():
+    '''
+    The parameter values of rk4_demo.py
+    '''
+    params = dict()
+    params['WELL_DIAM'] = .2
+    params['POT_DIAM'] = .05
+    params['KAPPA'] = 4e-1
+    params['DCOEFF'] = 1e-4
+    params['ALPHA'] = .5
+    return params
+
+
+def bench_settings(space_pts, time_pts, params):
+    '''
+    The grid of rk4_demo.py, with space_pts points out to 10*POT_DIAM and
+    time_pts output times up to t = 17
+    '''
+    ACTUAL_LENGTH = 10*params['POT_DIAM']
+    dx = ACTUAL_LENGTH/space_pts
+    space = linspace(0.0, ACTUAL_LENGTH, space_pts) + dx
+
+    stop_time = 17.0
+    dt = stop_time/time_pts
+    times = linspace(0.0, stop_time, int(time_pts)) + dt
+
+    settings = dict()
+    settings['space'] = space
+    settings['times'] = times
+    return settings
+
+
+class Counted(object):
+    '''
+    Wrap a function and count how many times it is called
+    '''
+    def __init__(self, func):
+        self.func = func
+        self.calls = 0
+
+    def __call__(self, *args):
+        self.calls += 1
+        return self.func(*args)
+
+
+class Tally(object):
+    '''
+    A call count reported by the solver itself, through its SolverStats
+    '''
+    def __init__(self):
+        self.calls = 0
+
+
+class Skip(Exception):
+    pass
+
+
+## Benchmark cases. Each one sets up a problem and returns a function that
+## runs it once, and a dict of Counted (or Tally) objects whose calls should be reported.
+## uses_time marks the cases whose cost depends on time_pts
+
+def case_assemble_dense(space_pts, time_pts):
+    if space_pts > DENSE_LIMIT:
+        raise Skip("dense matrix too large")
+    params = bench_params()
+    settings = bench_settings(space_pts, 2, params)
+    space = settings['space']
+
+    def run():
+        lap2d(space_pts)
+        grad1D(space_pts)
+        clear_operator_cache()
+        radiff_spaceop(ones(space_pts), space, params['POT_DIAM'])
+    return run, dict()
+
+
+def case_assemble_sparse(space_pts, time_pts):
+    params = bench_params()
+    settings = bench_settings(space_pts, 2, params)
+
+    def run():
+        clear_operator_cache()
+        radiff_parts(settings, params)
+    return run, dict()
+
+
+def case_rhs(space_pts, time_pts, ncalls=1000):
+    params = bench_params()
+    settings = bench_settings(space_pts, 2, params)
+    yvals = ones(space_pts)
+    rhs = Counted(nxt_step)
+    rhs(1.0, yvals, [settings, params])
+
+    def run():
+        for ind in range(ncalls):
+            rhs(1.0 + ind, yvals, [settings, params])
+    return run, dict(rhs=rhs)
+
+
+def case_jacobian(space_pts, time_pts, ncalls=20):
+    if space_pts > DENSE_LIMIT:
+        raise Skip("dense matrix too large")
+    params = bench_params()
+    settings = bench_settings(space_pts, 2, params)
+    yvals = ones(space_pts)
+    jac = Counted(radiff_timeop)
+    jac(1.0, yvals, [settings, params])
+
+    def run():
+        for ind in range(ncalls):
+            jac(1.0 + ind, yvals, [settings, params])
+    return run, dict(jac=jac)
+
+
+def case_jacobian_sparse(space_pts, time_pts, ncalls=20):
+    params = bench_params()
+    settings = bench_settings(space_pts, 2, params)
+    jac = Counted(radiff_timeop_sparse)
+    jac(1.0, settings, params)
+
+    def run():
+        for ind in range(ncalls):
+            jac(1.0 + ind, settings, params)
+    return run, dict(jac=jac)
+
+
+def case_lsoda_notebook(space_pts, time_pts):
+    '''
+    The integration loop of the notebooks: scipy's ode class with LSODA, the
+    dense jacobian, and every output state kept
+    '''
+    if space_pts > DENSE_LIMIT:
+        raise Skip("dense matrix too large")
+    if space_pts*time_pts > MESH_LIMIT:
+        raise Skip("solution mesh too large")
+    params = bench_params()
+    settings = bench_settings(space_pts, time_pts, params)
+    times = settings['times']
+    rhs = Counted(nxt_step)
+    jac = Counted(radiff_timeop)
+
+    def run():
+        r = ode(rhs, jac).set_integrator('lsoda', with_jacobian=True, nsteps=100000,
+                                         rtol=1e-6, atol=1e-12)
+        r.set_initial_value(ones(space_pts), times[0]).set_f_params([settings, params])
+        r.set_jac_params([settings, params])
+        sol = [ones(space_pts)]
+        for t in times[1:]:
+            if not r.successful():
+                break
+            sol.append(r.integrate(t))
+        return array(sol).T
+    return run, dict(rhs=rhs, jac=jac)
+
+
+def _solver_case(space_pts, time_pts, **solve_kwargs):
+    params = bench_params()
+    settings = bench_settings(space_pts, time_pts, params)
+    counters = dict(rhs=Tally(), jac=Tally())
+
+    def run():
+        out = solve_radiff(ones(space_pts), settings, params, reducers=[Survival()],
+                           stats=True, **solve_kwargs)
+        counters['rhs'].calls += out['stats']['rhs_calls']
+        counters['jac'].calls += out['stats']['jac_calls']
+        return out
+    return run, counters
+
+
+def case_lsoda_banded(space_pts, time_pts):
+    return _solver_case(space_pts, time_pts, method='lsoda')
+
+
+def case_bdf(space_pts, time_pts):
+    return _solver_case(space_pts, time_pts, method='BDF')
+
+
+def _mesh_case(space_pts, time_pts, mesh_fn):
+    if space_pts*time_pts > MESH_LIMIT:
+        raise Skip("solution mesh too large")
+    params = bench_params()
+    settings = bench_settings(space_pts, time_pts, params)
+
+    def run():
+        with errstate(over='ignore', invalid='ignore'):
+            return mesh_fn(ones(space_pts), nxt_step, settings, params)
+    return run, dict()
+
+
+def case_rk4_mesh(space_pts, time_pts):
+    return _mesh_case(space_pts, time_pts, rk4_mesh)
+
+
+def case_euler_mesh(space_pts, time_pts):
+    return _mesh_case(space_pts, time_pts, euler_mesh)
+
+
+def _sweep_case(space_pts, time_pts, processes, npoints=8):
+    # the points share one grid, which run_sweep still spreads over the workers
+    params = bench_params()
+    settings = bench_settings(space_pts, time_pts, params)
+    well_diams = params['POT_DIAM']*linspace(.5, 2, npoints)
+
+    def run():
+        return run_sweep(params, [('WELL_DIAM', well_diams)], settings, processes=processes)
+    return run, dict()
+
+
+def case_sweep_serial(space_pts, time_pts):
+    return _sweep_case(space_pts, time_pts, 1)
+
+
+def case_sweep_parallel(space_pts, time_pts):
+    return _sweep_case(space_pts, time_pts, None)
+
+
+# name: (case function, whether the cost depends on time_pts)
+BENCHMARKS = dict()
+BENCHMARKS['assemble_dense'] = (case_assemble_dense, False)
+BENCHMARKS['assemble_sparse'] = (case_assemble_sparse, False)
+BENCHMARKS['rhs'] = (case_rhs, False)
+BENCHMARKS['jacobian'] = (case_jacobian, False)
+BENCHMARKS['jacobian_sparse'] = (case_jacobian_sparse, False)
+BENCHMARKS['lsoda_notebook'] = (case_lsoda_notebook, True)
+BENCHMARKS['lsoda_banded'] = (case_lsoda_banded, True)
+BENCHMARKS['bdf'] = (case_bdf, True)
+BENCHMARKS['rk4_mesh'] = (case_rk4_mesh, True)
+BENCHMARKS['euler_mesh'] = (case_euler_mesh, True)
+BENCHMARKS['sweep_serial'] = (case_sweep_serial, True)
+BENCHMARKS['sweep_parallel'] = (case_sweep_parallel, True)
+
+
+def measure(case, space_pts, time_pts, repeat=3):
+    '''
+    Run one benchmark case: the best wall time of repeat runs, then one more
+    run under tracemalloc for the peak memory. Call counts are per run
+    '''
+    record = dict(space_pts=int(space_pts), time_pts=int(time_pts))
+    try:
+        run, counters = case(space_pts, time_pts)
+    except Skip as err:
+        record['status'] = 'skipped: ' + str(err)
+        return record
+
+    try:
+        walls = list()
+        for rep in range(repeat):
+            for counter in counters.values():
+                counter.calls = 0
+            start = time.perf_counter()
+            run()
+            walls.append(time.perf_counter() - start)
+        for name, counter in counters.items():
+            record[name + '_calls'] = counter.calls
+
+        tracemalloc.start()
+        run()
+        record['peak_memory'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    except Exception as err:
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        record['status'] = 'failed: ' + repr(err)
+        return record
+
+    record['wall_time'] = min(walls)
+    record['repeat'] = repeat
+    record['status'] = 'ok'
+    return record
+
+
+def accuracy_params():
+    '''
+    A parameter point at which the resolvent moments are well conditioned,
+    with a fixed width for the edge of the reactive window (WELL_EDGE), so
+    that the problem is the same on every grid
+    '''
+    params = dict()
+    params['WELL_DIAM'] = .5
+    params['WELL_EDGE'] = .05
+    params['POT_DIAM'] = 1.0
+    params['KAPPA'] = 1.0
+    params['DCOEFF'] = 1.0
+    params['ALPHA'] = .5
+    return params
+
+
+def accuracy_settings(stencil, space_pts, params):
+    '''
+    space_pts points from POT_DIAM/10 out to 10*POT_DIAM: evenly spaced, or
+    the Chebyshev points for the spectral stencil. Unlike bench_settings the
+    first point does not move with the grid size
+    '''
+    first = params['POT_DIAM']/10
+    last = 10*params['POT_DIAM']
+    if stencil == 'chebyshev':
+        space = chebyshev_grid(first, last, space_pts)
+    else:
+        space = linspace(first, last, space_pts)
+
+    settings = dict()
+    settings['space'] = space
+    settings['times'] = array([0.0, 1.0])
+    settings['stencil'] = stencil
+    return settings
+
+
+def resolvent_moments(stencil, space_pts, params):
+    '''
+    The first two moments of survival_moments for a uniform initial
+    condition, normalized by the initial surviving fraction. They are moments
+    of the survival time only where the survival curve decays
+    '''
+    settings = accuracy_settings(stencil, space_pts, params)
+    y0 = ones(space_pts)
+    moments = survival_moments(y0, settings, params, orders=(1, 2), check=False)
+    return moments/survival_weights(settings, params).dot(y0)
+
+
+def accuracy_table(stencils, space_pts, tolerances=ACCURACY_TOLERANCES, repeat=3,
+                   verbose=True):
+    '''
+    The error in the resolvent moments, and the cost of computing them, for
+    each stencil over a range of grid sizes. This is the convergence of the
+    operators, not the error in a survival curve
+
+    RETURNS
+    -------
+
+    out : dict
+        out['results'], one record per (stencil, space_pts) with the largest
+        relative error in the two moments and the best wall time of repeat
+        runs, each of which builds the operator afresh
+        out['points_needed'], for each stencil the fewest of space_pts that
+        reach each of the tolerances, or None
+    '''
+    params = accuracy_params()
+    reference = resolvent_moments('fd6', REFERENCE_PTS, params)
+
+    results = list()
+    for stencil in stencils:
+        for npts in space_pts:
+            record = dict(name='accuracy', stencil=stencil, space_pts=int(npts))
+            if stencil in ('compact4', 'chebyshev') and npts > DENSE_LIMIT:
+                record['status'] = 'skipped: dense matrix too large'
+                results.append(record)
+                continue
+            if stencil == 'chebyshev' and npts > CHEBYSHEV_LIMIT:
+                record['status'] = 'skipped: past CHEBYSHEV_LIMIT'
+                results.append(record)
+                continue
+            walls = list()
+            for rep in range(repeat):
+                clear_operator_cache()
+                start = time.perf_counter()
+                moments = resolvent_moments(stencil, npts, params)
+                walls.append(time.perf_counter() - start)
+            record['error'] = float(amax(abs(moments/reference - 1)))
+            record['wall_time'] = min(walls)
+            record['status'] = 'ok'
+            results.append(record)
+            if verbose:
+                print('%-10s L=%-6d error %10.3g %10.4g s' % (stencil, npts, record['error'],
+                                                              record['wall_time']))
+                sys.stdout.flush()
+
+    points_needed = dict()
+    for stencil in stencils:
+        needed = dict()
+        for tol in tolerances:
+            found = [rec['space_pts'] for rec in results if rec['stencil'] == stencil
+                     and rec['status'] == 'ok' and rec['error'] <= tol]
+            needed[repr(tol)] = int(amin(found)) if found else None
+        points_needed[stencil] = needed
+
+    out = dict()
+    out['results'] = results
+    out['points_needed'] = points_needed
+    return out
+
+
+def format_accuracy(table):
+    '''
+    The fewest grid points (and the time taken with them) each stencil needs
+    for each tolerance, as printable lines
+    '''
+    tols = sorted(table['points_needed'][list(table['points_needed'])[0]], key=float,
+                  reverse=True)
+    times = dict(((rec['stencil'], rec['space_pts']), rec.get('wall_time'))
+                 for rec in table['results'])
+    lines = ['%-10s' % 'stencil' + ''.join(['%22s' % ('error <= ' + tol) for tol in tols])]
+    for stencil, needed in table['points_needed'].items():
+        line = '%-10s' % stencil
+        for tol in tols:
+            npts = needed[tol]
+            if npts is None:
+                line += '%22s' % '-'
+            else:
+                line += '%22s' % ('L=%d, %.3g s' % (npts, times[(stencil, npts)]))
+        lines.append(line)
+    return lines
+
+
+def git_revision():
+    try:
+        here = os.path.dirname(os.path.abspath(__file__))
+        out = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=here, capture_output=True,
+                             text=True, timeout=10)
+        return out.stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run_metadata():
+    '''
+    The machine and library versions and the git revision
+    '''
+    meta = dict()
+    meta['revision'] = git_revision()
+    meta['date'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    meta['python'] = platform.python_version()
+    meta['numpy'] = __import__('numpy').__version__
+    meta['scipy'] = scipy.__version__
+    meta['machine'] = platform.platform()
+    meta['cpus'] = os.cpu_count()
+    return meta
+
+
+def run_benchmarks(names, space_pts, time_pts, repeat=3, verbose=True):
+    '''
+    Run the named benchmarks over every grid size, and every number of output
+    times for the cases that depend on it
+
+    RETURNS
+    -------
+
+    out : dict
+        out['meta'], the machine and library versions and the git revision
+        out['results'], one record per (benchmark, space_pts, time_pts)
+    '''
+    meta = run_metadata()
+    results = list()
+    for name in names:
+        case, uses_time = BENCHMARKS[name]
+        for npts in space_pts:
+            for tpts in (time_pts if uses_time else time_pts[:1]):
+                record = measure(case, npts, tpts, repeat=repeat)
+                record['name'] = name
+                results.append(record)
+                if verbose:
+                    print(format_record(record))
+                    sys.stdout.flush()
+
+    out = dict()
+    out['meta'] = meta
+    out['results'] = results
+    return out
+
+
+def format_record(record):
+    line = '%-16s L=%-6d T=%-8d ' % (record['name'], record['space_pts'], record['time_pts'])
+    if record['status'] != 'ok':
+        return line + record['status']
+    line += '%10.4g s  %10.4g MB' % (record['wall_time'], record['peak_memory']/2.0**20)
+    for key in sorted(record):
+        if key.endswith('_calls'):
+            line += '  %s=%d' % (key, record[key])
+    return line
+
+
+def compare(old, new, threshold=1.2):
+    '''
+    Compare two benchmark outputs and print the ratio of wall times and peak
+    memory (new/old) for every case found in both
+
+    RETURNS
+    -------
+
+    regressions : list
+        The (name, space_pts, time_pts) cases that got slower by more than
+        a factor threshold
+    '''
+    def index(out):
+        return dict(((rec['name'], rec['space_pts'], rec['time_pts']), rec)
+                    for rec in out['results'] if rec['status'] == 'ok')
+    old_recs = index(old)
+    new_recs = index(new)
+
+    print('old revision: ' + str(old['meta'].get('revision')))
+    print('new revision: ' + str(new['meta'].get('revision')))
+    regressions = list()
+    for key in sorted(set(old_recs) & set(new_recs)):
+        time_ratio = new_recs[key]['wall_time']/old_recs[key]['wall_time']
+        mem_ratio = new_recs[key]['peak_memory']/maximum(old_recs[key]['peak_memory'], 1)
+        flag = ''
+        if time_ratio > threshold:
+            flag = '  SLOWER'
+            regressions.append(key)
+        elif time_ratio < 1/threshold:
+            flag = '  faster'
+        print('%-16s L=%-6d T=%-8d time x%-8.3g memory x%-8.3g%s' % (key + (time_ratio, mem_ratio, flag)))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the reaction-diffusion solvers")
+    parser.add_argument('--full', action='store_true',
+                        help="use the full ranges space_pts 50-10000 and time_pts 1e3-1e6")
+    parser.add_argument('--only', nargs='+', choices=sorted(BENCHMARKS), default=None,
+                        help="run only these benchmarks")
+    parser.add_argument('--space-pts', nargs='+', type=int, default=None)
+    parser.add_argument('--time-pts', nargs='+', type=float, default=None)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('-o', '--output', default='bench_output.json')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help="compare two benchmark outputs instead of running")
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help="slowdown factor reported as a regression by --compare")
+    parser.add_argument('--accuracy', action='store_true',
+                        help="compare the resolvent convergence of the stencils instead")
+    parser.add_argument('--stencils', nargs='+', choices=SPACE_STENCILS, default=None,
+                        help="the stencils compared by --accuracy")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            old = json.load(f)
+        with open(args.compare[1]) as f:
+            new = json.load(f)
+        regressions = compare(old, new, threshold=args.threshold)
+        return 1 if regressions else 0
+
+    if args.accuracy:
+        space_pts = args.space_pts or (FULL_ACCURACY_PTS if args.full else QUICK_ACCURACY_PTS)
+        table = accuracy_table(args.stencils or SPACE_STENCILS, space_pts, repeat=args.repeat)
+        for line in format_accuracy(table):
+            print(line)
+        out = dict(meta=run_metadata(), accuracy=table)
+        with open(args.output, 'w') as f:
+            json.dump(out, f, indent=1)
+        print('wrote ' + args.output)
+        return 0
+
+    space_pts = args.space_pts or (FULL_SPACE_PTS if args.full else QUICK_SPACE_PTS)
+    time_pts = [int(tpts) for tpts in (args.time_pts or (FULL_TIME_PTS if args.full else QUICK_TIME_PTS))]
+    names = args.only or list(BENCHMARKS)
+
+    out = run_benchmarks(names, space_pts, time_pts, repeat=args.repeat)
+    with open(args.output, 'w') as f:
+        json.dump(out, f, indent=1)
+    print('wrote ' + args.output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -11,6 +11,7 @@ William Gilpin, 2015
 from matplotlib.pyplot import *
 from scipy import *
 from numpy import *
+from time import perf_counter
 
 from diffusion_integrator_funcs import *
 
@@ -28,15 +29,43 @@ def eq_dist(pts, pot_width):
     return gausspart*radpart/norm_fac
 
 
+def survival_weights(settings, params):
+    '''
+    Quadrature weights w such that w.dot(yvals) is the surviving fraction.
+    With the legacy stencil this is the same dx*sum(yvals*eq_dist) used in
+    the notebooks; the other stencils use a quadrature rule of their own order
+    '''
+    allspace = settings['space']
+    stencil = settings.get('stencil') or default_stencil(allspace)
+    weights = quadrature_weights(allspace, STENCIL_QUADRATURE[stencil])
+    return weights*eq_dist(allspace, params['POT_DIAM'])
+
+
 def nxt_step(timepoint, yvals, settings_and_params):
     """
     Return a space-discretized approximation of the differential equation
     at the given timepoint. Our equation happens to be linear, and so the next
-    step is given by a simple dot product with the relevant operator
+    step is given by a simple dot product with the relevant operator.
+    
+    The cached sparse operator is applied directly, so each call costs O(L)
+    rather than rebuilding the dense L x L matrix from radiff_timeop. yvals
+    may also be an (L, M) stack of profiles, one per column
     """
     settings, params = settings_and_params
-    jac = radiff_timeop(timepoint, yvals, [settings, params])
-    nxt_vals = jac.dot(yvals)
+    spaceop, rxn_rates = radiff_parts(settings, params)
+    dcoeff = diffusion_prefactor(timepoint, params)
+    nxt_vals = -dcoeff*spaceop.dot(yvals) - (rxn_rates*yvals.T).T
+    return nxt_vals
+
+
+def nxt_step_nondim(timepoint, yvals, settings_and_params):
+    """
+    The right hand side matching radiff_timeop_nondim, for use as the
+    derivative function when that operator is passed as the jacobian
+    """
+    settings, params = settings_and_params
+    spaceop, rxn_rates = radiff_parts(settings, params, nondim=True)
+    nxt_vals = -spaceop.dot(yvals) - (rxn_rates*yvals.T).T
     return nxt_vals
 
 
@@ -60,6 +89,220 @@ def time_nondim(time, params):
     return DCOEFF*(time**ALPHA)
 
 
+def diffusion_prefactor(timepoint, params):
+    '''
+    The time-dependent diffusion coefficient ALPHA*DCOEFF*t^(ALPHA-1) that
+    multiplies the spatial operator in the dimensional equation
+    '''
+    ALPHA = params['ALPHA']
+    DCOEFF = params['DCOEFF']
+    return ALPHA*(timepoint**(ALPHA-1))*DCOEFF
+
+
+def kappa_nondim(params):
+    '''
+    The reaction rate KAPPA rescaled into the units of radiff_timeop_nondim
+    '''
+    KAPPA = params['KAPPA']
+    ALPHA = params['ALPHA']
+    DCOEFF = params['DCOEFF']
+    return ( KAPPA/( ALPHA*(DCOEFF**(1/ALPHA)) ) )
+
+
+
+# The spatial operator and the reaction window only depend on the grid and on
+# POT_DIAM / WELL_DIAM, so they are assembled once as sparse matrices and kept
+# here. Oldest entries are dropped once the cache holds OPERATOR_CACHE_SIZE items
+OPERATOR_CACHE_SIZE = 256
+_operator_cache = dict()
+_operator_cache_stats = dict(hits=0, misses=0, build_time=0.0)
+
+
+def cached_operator(key, builder, *args):
+    '''
+    Return the cached object stored under key, calling builder(*args) to make
+    it on a miss. Any object derived from the operators (factorizations,
+    eigendecompositions) can be kept here as well
+    '''
+    if key in _operator_cache:
+        _operator_cache_stats['hits'] += 1
+        return _operator_cache[key]
+    
+    start = perf_counter()
+    op = builder(*args)
+    _operator_cache_stats['misses'] += 1
+    _operator_cache_stats['build_time'] += perf_counter() - start
+    if len(_operator_cache) >= OPERATOR_CACHE_SIZE:
+        del _operator_cache[next(iter(_operator_cache))]
+    _operator_cache[key] = op
+    return op
+
+
+def operator_cache_info():
+    '''
+    The number of cache hits and misses so far, and the total time in seconds
+    spent building operators on misses
+    '''
+    return dict(_operator_cache_stats)
+
+
+def clear_operator_cache():
+    '''
+    Drop all cached spatial operators and reaction windows
+    '''
+    _operator_cache.clear()
+
+
+def grid_key(space):
+    '''
+    A hashable fingerprint of a spatial grid, used to key the operator cache
+    '''
+    space = ascontiguousarray(space, dtype=double)
+    return (len(space), space.tobytes())
+
+
+def default_stencil(space):
+    '''
+    The stencil used when none is requested: 'legacy' on uniform grids, so that
+    existing results are unchanged. Other grids must name their stencil in
+    settings['stencil'] (see SPACE_STENCILS), since no stencil gives these
+    grids a well-behaved time-dependent solve (see the README)
+    '''
+    if is_uniform(space):
+        return 'legacy'
+    raise ValueError("A grid that is not evenly spaced needs settings['stencil'], e.g. 'fd2'")
+
+
+def _build_spaceop(space, pot_diam, stencil='legacy'):
+    
+    a = pot_diam
+    allspace = asarray(space, dtype=double)
+    
+    # second derivative step
+    lap, drv = stencil_operators(allspace, stencil)
+    
+    # first derivative steps, of drift*y
+    drift = 4/allspace - (3/(4*a**2))*allspace
+    if stencil == 'legacy':
+        # The dense version broadcasts the radial factors across columns,
+        # which is a right-multiplication by a diagonal
+        jac = lap + drv.dot(sparse.diags(drift))
+    else:
+        # by the product rule, so that the zero slope at the reflecting ends
+        # applies to y rather than to drift*y
+        jac = lap + sparse.diags(drift).dot(drv) + sparse.diags(-4/allspace**2 - 3/(4*a**2))
+    
+    # other steps
+    diag_terms = (1/(8*a**4))*(allspace**2) - (1/a**2)
+    # assume \ell = 0; other channels subtract \ell(\ell+1)/r^2 (see angular_channels.py)
+    diag_terms = diag_terms + (2/(allspace**2))
+    jac = jac + sparse.diags(diag_terms)
+    
+    jac = jac.tocsr()
+    jac.sort_indices()
+    return jac
+
+
+def _build_drain_window(space, well_diam, edge_width=None):
+    
+    allspace = asarray(space, dtype=double)
+    
+    if edge_width is None and not is_uniform(allspace):
+        # smooth over the local grid spacing at the edge of the well, which
+        # is what the index-based step below does on a uniform grid
+        edge_width = interp(well_diam, allspace[1:], diff(allspace))
+    
+    if edge_width is not None:
+        steps = clip((allspace - well_diam)/edge_width, -50, 50)
+        return smoothstep(steps, center=0.0, sharpness=3)
+    
+    drain_window = double(allspace < well_diam)
+    
+    allinds = linspace(0,len(allspace),len(allspace))
+    drain_window = smoothstep(allinds,center = sum(drain_window),sharpness=3)
+    
+    return drain_window
+
+
+def spaceop_sparse(space, pot_diam, stencil=None):
+    '''
+    Sparse (CSR) version of radiff_spaceop. The operator is assembled once
+    per (space, pot_diam, stencil) and then served from the cache, so repeated
+    calls cost only the O(L) grid lookup
+    
+    space : array
+        The x values on which the simulation occurs. They need not be evenly
+        spaced (see clustered_grid and expspace)
+    
+    pot_diam : the one parameter of the diffusion operator
+    
+    stencil : str
+        One of SPACE_STENCILS. Defaults to 'legacy', which needs an evenly
+        spaced grid (see default_stencil)
+    '''
+    if stencil is None:
+        stencil = default_stencil(space)
+    key = ('spaceop', grid_key(space), pot_diam, stencil)
+    return cached_operator(key, _build_spaceop, space, pot_diam, stencil)
+
+
+def drain_window(space, well_diam, edge_width=None):
+    '''
+    The smoothed indicator of the reactive well on the grid, cached per
+    (space, well_diam, edge_width)
+    
+    edge_width : double
+        The distance over which the window falls from one to zero. By default
+        this is one grid step, as in the notebooks, so the window sharpens as
+        the grid is refined; a fixed width (params['WELL_EDGE']) gives the
+        same window on every grid, which grid convergence studies need
+    '''
+    key = ('drain', grid_key(space), well_diam, edge_width)
+    return cached_operator(key, _build_drain_window, space, well_diam, edge_width)
+
+
+def radiff_parts(settings, params, nondim=False):
+    '''
+    Return the time-independent pieces of the reaction-diffusion operator:
+    the cached sparse spatial operator and the vector of local reaction rates
+    KAPPA*drain_window. The full operator at time t is then
+    
+        -diffusion_prefactor(t, params)*spaceop - diag(rxn_rates)
+    
+    or, for the nondimensional equation, -spaceop - diag(rxn_rates)
+    
+    nondim : bool
+        Whether to rescale KAPPA into the nondimensional units
+    
+    The stencil of the spatial operator is taken from settings['stencil'],
+    and the width of the edge of the reactive window from params['WELL_EDGE'],
+    if present (see SPACE_STENCILS and drain_window)
+    '''
+    allspace = settings['space']
+    
+    if nondim:
+        KAPPA = kappa_nondim(params)
+    else:
+        KAPPA = params['KAPPA']
+    
+    spaceop = spaceop_sparse(allspace, params['POT_DIAM'], stencil=settings.get('stencil'))
+    rxn_rates = KAPPA*drain_window(allspace, params['WELL_DIAM'], params.get('WELL_EDGE'))
+    
+    return spaceop, rxn_rates
+
+
+def radiff_timeop_sparse(timepoint, settings, params, nondim=False):
+    '''
+    Sparse (CSR) form of radiff_timeop, or of radiff_timeop_nondim if nondim
+    is True, for solvers that only need matrix-vector products
+    '''
+    spaceop, rxn_rates = radiff_parts(settings, params, nondim=nondim)
+    if nondim:
+        jac = -spaceop
+    else:
+        jac = -diffusion_prefactor(timepoint, params)*spaceop
+    return (jac - sparse.diags(rxn_rates)).tocsr()
+
 
 def radiff_spaceop(yvals, space, pot_diam):
     '''
@@ -82,30 +325,7 @@ def radiff_spaceop(yvals, space, pot_diam):
     William Gilpin, 2015
     '''
     
-    a = pot_diam
-    allspace = space
-    dx = allspace[2]-allspace[1]
-    
-    L = len(space)
-    
-    # second derivative step
-    lap = lap2d(L)/dx**2
-    jac = lap
-    
-    
-    # first derivative steps
-    drv = grad1D(L)/dx
-    jac += (4*drv/allspace) - (3/(4*a**2))*allspace*drv
-    
-    
-    # other steps
-    iden = identity(L)
-    jac += (1/(8*a**4))*(allspace**2)*iden
-    jac += -(1/a**2)*iden
-    # assume \ell = 0
-    jac += (2/(allspace**2))*iden
-    
-    return jac
+    return spaceop_sparse(space, pot_diam).toarray()
 
 
 
@@ -114,37 +334,19 @@ def radiff_timeop(timepoint, yvals, settings_and_params):
     Time evolution operator for three-dimensional, fractional brownian
     motion in a harmonci potential with a reactive well.
     
+    The dense matrix is returned because LSODA expects a full jacobian, but
+    it is built from the cached sparse pieces (see radiff_parts) instead of
+    reassembling the stencils on every call
     '''
     
     settings, params = settings_and_params
     
-    allspace = settings['space']
+    spaceop, rxn_rates = radiff_parts(settings, params)
+    DCOEFF = diffusion_prefactor(timepoint, params)
     
-    WELL_DIAM = params['WELL_DIAM']
-    POT_DIAM = params['POT_DIAM']
-    KAPPA = params['KAPPA']
-    DCOEFF = params['DCOEFF']
-    ALPHA = params['ALPHA']
-    
-    DCOEFF = ALPHA*(timepoint**(ALPHA-1))*DCOEFF
-    
-    # remove this and change allspace
-    a = POT_DIAM
-
-    L = len(allspace)
-    iden = identity(L)
-    
-    jac = radiff_spaceop(yvals, allspace, a)
-    # now multiply by diffusion coefficient and all that
-    jac = -DCOEFF*jac
-    
-    # now implement reaction step
-    drain_window = double(allspace < WELL_DIAM)
-    
-    allinds = linspace(0,len(allspace),len(allspace))
-    drain_window = smoothstep(allinds,center = sum(drain_window),sharpness=3)
-
-    jac += -KAPPA*drain_window*iden
+    jac = spaceop.toarray()
+    jac *= -DCOEFF
+    jac[diag_indices_from(jac)] -= rxn_rates
     
     return jac
 
@@ -159,37 +361,10 @@ def radiff_timeop_nondim(timepoint, yvals, settings_and_params):
     
     settings, params = settings_and_params
     
-    allspace = settings['space']
-    dx = allspace[2]-allspace[1]
-    
-    WELL_DIAM = params['WELL_DIAM']
-    POT_DIAM = params['POT_DIAM']
-    KAPPA = params['KAPPA']
-    ALPHA = params['ALPHA']
-    DCOEFF = params['DCOEFF']
-    
-    # Rescale into dimensionless form
-    KAPPA = ( KAPPA/( ALPHA*(DCOEFF**(1/ALPHA)) ) )
-    
+    spaceop, rxn_rates = radiff_parts(settings, params, nondim=True)
     
-    # remove this and change allspace
-    a = POT_DIAM
-
-    L = len(allspace)
-    iden = identity(L)
-    
-    jac = radiff_spaceop(yvals, allspace, a)
-    
-    # now multiply by diffusion coefficient and all that
-    jac = -jac
-    
-    # now implement reaction step
-    drain_window = double(allspace < WELL_DIAM)
-    
-    allinds = linspace(0,len(allspace),len(allspace))
-    drain_window = smoothstep(allinds,center = sum(drain_window),sharpness=3)
-
-    jac += -KAPPA*drain_window*iden
+    jac = -spaceop.toarray()
+    jac[diag_indices_from(jac)] -= rxn_rates
     
     return jac
 
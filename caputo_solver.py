@@ -0,0 +1,213 @@
+'''
+Time-fractional (Caputo) reaction-diffusion solver
+
+The main integrator models anomalous diffusion through the time-dependent
+coefficient ALPHA*DCOEFF*t^(ALPHA-1). This file solves the genuine memory-kernel
+model instead,
+
+    D_t^ALPHA y = -DCOEFF S y - KAPPA drain_window y
+
+where D_t^ALPHA is the Caputo derivative and S the cached spatial operator of
+radiff_spaceop. Here DCOEFF has units of length^2/time^ALPHA and KAPPA of
+1/time^ALPHA, so both equations share the scaling DCOEFF*t^ALPHA of the
+mean-squared displacement.
+
+The derivative is discretized with the implicit L1 scheme. Its history term,
+a convolution with the power-law kernel t^-ALPHA, costs O(N) per step and
+O(N^2) overall if it is summed directly. Instead the kernel is replaced by a
+sum of K exponentials (a "fast L1" or sum-of-exponentials scheme), whose
+history terms each obey a two-term recurrence, so a run of N steps costs
+O(N*K*L) time and O(K*L) memory with K ~ log(N)*log(1/eps).
+
+William Gilpin, 2015
+'''
+
+from numpy import *
+import scipy.sparse as sparse
+from scipy.special import gamma
+from scipy.sparse.linalg import splu
+
+from brownian_integrator import *
+from observables import *
+
+
+def _build_soe_kernel(alpha, delta, tmax, eps):
+
+    # t^-alpha = 1/Gamma(alpha) * integral over x of exp(alpha*x - t*exp(x)),
+    # discretized with the trapezoidal rule in x
+    xmin = log(eps)/alpha - log(tmax) - 1.0
+    xmax = log((log(1/eps) + 5.0)/delta)
+    test_times = expspace(delta, tmax, 400)
+    exact = test_times**(-alpha)
+
+    step = 1.0
+    while True:
+        xvals = arange(xmin, xmax + step, step)
+        nodes = exp(xvals)
+        weights = step*exp(alpha*xvals)/gamma(alpha)
+        approx = exp(-outer(test_times, nodes)).dot(weights)
+        if amax(abs(approx - exact)/exact) < eps or step < 1e-3:
+            break
+        step = step/2
+
+    return nodes, weights
+
+
+def soe_kernel(alpha, delta, tmax, eps=1e-8):
+    '''
+    A sum-of-exponentials fit t^-alpha ~ sum_j weights[j]*exp(-nodes[j]*t),
+    with relative error below eps for delta <= t <= tmax. The number of terms
+    grows only like log(tmax/delta)*log(1/eps)
+
+    RETURNS
+    -------
+
+    nodes, weights : array
+        The decay rates and weights of the exponentials
+    '''
+    key = ('soe', alpha, delta, tmax, eps)
+    return cached_operator(key, _build_soe_kernel, alpha, delta, tmax, eps)
+
+
+def caputo_operator(settings, params):
+    '''
+    The right hand side operator of the Caputo equation, -DCOEFF*S - KAPPA*diag(window),
+    as a CSR matrix
+    '''
+    spaceop, rxn_rates = radiff_parts(settings, params)
+    return (-params['DCOEFF']*spaceop - sparse.diags(rxn_rates)).tocsr()
+
+
+def caputo_march(jac, y0, dt, nsteps, alpha, callback, history='soe', eps=1e-8):
+    '''
+    March D_t^alpha y = jac y through nsteps implicit L1 steps of size dt,
+    calling callback(tind, yvals) after each step (tind = 1..nsteps)
+
+    jac : sparse matrix
+        The (constant) right hand side operator
+
+    history : str
+        'soe' compresses the memory kernel into exponentials; 'full' sums
+        the L1 history directly, at O(nsteps^2) cost, for validation
+
+    eps : double
+        The relative accuracy of the sum-of-exponentials kernel
+    '''
+    L = jac.shape[0]
+    local_coeff = dt**(-alpha)/gamma(2 - alpha)
+    lu = splu((local_coeff*sparse.identity(L) - jac).tocsc())
+
+    y_old = asarray(y0, dtype=double)
+
+    if history == 'soe':
+        if nsteps > 1:
+            nodes, weights = soe_kernel(alpha, dt, nsteps*dt, eps=eps)
+        else:
+            nodes, weights = zeros(0), zeros(0)
+        decay = exp(-nodes*dt)
+        # contribution of one linear piece of y to each history mode,
+        # (decay - decay**2)/(nodes*dt) without the cancellation at small nodes*dt
+        piece = -expm1(-nodes*dt)*decay/(nodes*dt)
+        hist_coeff = weights/gamma(1 - alpha)
+        modes = zeros((L, len(nodes)))
+        y_older = None
+
+        for tind in range(1, nsteps + 1):
+            if y_older is not None:
+                modes *= decay
+                modes += outer(y_old - y_older, piece)
+            rhs = local_coeff*y_old - modes.dot(hist_coeff)
+            y_new = lu.solve(rhs)
+            callback(tind, y_new)
+            y_older, y_old = y_old, y_new
+
+    elif history == 'full':
+        kvals = arange(nsteps + 1)
+        bcoeffs = (kvals + 1)**(1 - alpha) - kvals**(1 - alpha)
+        increments = zeros((nsteps, L))
+
+        for tind in range(1, nsteps + 1):
+            # sum_{k=1}^{n-1} b_k (y^{n-k} - y^{n-k-1})
+            past = increments[:tind-1][::-1]
+            hist = bcoeffs[1:tind].dot(past) if tind > 1 else 0.0
+            rhs = local_coeff*(y_old - hist)
+            y_new = lu.solve(rhs)
+            increments[tind-1] = y_new - y_old
+            callback(tind, y_new)
+            y_old = y_new
+
+    else:
+        raise ValueError("Unknown history treatment: " + str(history))
+
+
+def solve_caputo(y0, settings, params, history='soe', eps=1e-8, reducers=None,
+                 output_times=None):
+    '''
+    Solve the Caputo time-fractional reaction-diffusion equation with the
+    fast L1 scheme, for comparison with the D(t) model of solve_radiff
+
+    y0 : array
+        The initial condition on settings['space'], at t = settings['times'][0]
+
+    settings : dict
+        settings['space'], and settings['times'], a uniform grid of time steps
+
+    params : dict
+        The parameter values. ALPHA is the order of the Caputo derivative
+
+    history : str
+        'soe' (the default) or 'full', see caputo_march
+
+    eps : double
+        Accuracy of the sum-of-exponentials memory kernel
+
+    reducers : list
+        Streaming reducers from observables.py, as in solve_radiff. If None,
+        the full solution is kept
+
+    output_times : array
+        The times at which to hand the state to the reducers; each is matched
+        to the first step at or after it. Defaults to every step
+
+    RETURNS
+    -------
+
+    out : dict
+        out['times'], the output times
+        out[reducer.name], the result of each reducer (out['sol'] by default)
+    '''
+    times = asarray(settings['times'], dtype=double)
+    dt = times[1] - times[0]
+    if not allclose(diff(times), dt):
+        raise ValueError("The Caputo solver needs uniformly spaced times")
+
+    if output_times is None:
+        out_inds = arange(len(times))
+    else:
+        out_inds = unique(clip(searchsorted(times, output_times), 0, len(times) - 1))
+    out_times = times[out_inds]
+
+    if reducers is None:
+        reducers = [FullSolution()]
+    for reducer in reducers:
+        reducer.start(out_times, settings, params)
+
+    slots = dict(zip(out_inds.tolist(), range(len(out_inds))))
+
+    def callback(tind, yvals):
+        if tind in slots:
+            for reducer in reducers:
+                reducer.update(slots[tind], times[tind], yvals)
+
+    y0 = asarray(y0, dtype=double)
+    callback(0, y0)
+
+    jac = caputo_operator(settings, params)
+    caputo_march(jac, y0, dt, len(times) - 1, params['ALPHA'], callback,
+                 history=history, eps=eps)
+
+    out = dict()
+    out['times'] = out_times
+    for reducer in reducers:
+        out[reducer.name] = reducer.result()
+    return out
@@ -0,0 +1,184 @@
+'''
+Factorization reuse across KAPPA and WELL_DIAM sweeps
+
+In the nondimensional operator, KAPPA and WELL_DIAM only enter through the
+reaction term -KAPPA*drain_window, a diagonal that is essentially zero outside
+the first few grid points past the edge of the reactive well. So
+
+    -A(KAPPA, WELL_DIAM) = B + P C P^T
+
+where B is a reference operator that is factorized once, P picks out the k
+grid points where any of the windows in the sweep is non-negligible, and C is a
+k x k diagonal. The Woodbury identity then turns every solve against a new
+sweep point into one sparse solve against B plus a k x k dense solve, so a
+KAPPA or WELL_DIAM scan costs a cheap update per point rather than a fresh
+factorization. When the reactive well covers a large part of the grid the
+update space is no longer small, and each point is simply refactorized.
+
+William Gilpin, 2015
+'''
+
+from numpy import *
+import scipy.linalg
+import scipy.special
+from scipy.sparse.linalg import splu
+
+from brownian_integrator import *
+
+
+def window_continuation(settings, params, well_diams=None, tol=1e-14, max_rank=None):
+    '''
+    Factorize the reference operator at params and prepare the low-rank
+    update space for a sweep over KAPPA and WELL_DIAM
+
+    settings : dict
+        settings['space'] is used to build the operators
+
+    params : dict
+        The reference parameter values. POT_DIAM, ALPHA and DCOEFF are fixed
+        for the whole sweep
+
+    well_diams : array
+        The WELL_DIAM values the sweep will visit. Defaults to params['WELL_DIAM']
+
+    tol : double
+        Window entries below tol are treated as zero when choosing the
+        update space
+
+    max_rank : int
+        If the update space has more than max_rank points (a reactive well
+        that covers much of the grid), the k x k update would cost more than
+        a fresh banded factorization, so each point is refactorized directly
+        instead. Defaults to 2*sqrt(L)
+
+    RETURNS
+    -------
+
+    cont : dict
+        The factorization and update space, to pass to continuation_solve and
+        continuation_moments
+    '''
+    if well_diams is None:
+        well_diams = [params['WELL_DIAM']]
+
+    allspace = settings['space']
+    L = len(allspace)
+    if max_rank is None:
+        max_rank = int(2*sqrt(L))
+
+    ref_op = -radiff_timeop_sparse(0.0, settings, params, nondim=True)
+    ref_rates = radiff_parts(settings, params, nondim=True)[1]
+
+    # the grid points where any of the windows matters
+    windows = dict()
+    support = zeros(L, dtype=bool)
+    for well_diam in well_diams:
+        windows[well_diam] = drain_window(allspace, well_diam, params.get('WELL_EDGE'))
+        support |= windows[well_diam] > tol
+    support |= abs(ref_rates) > tol*amax(abs(ref_rates))
+    inds = where(support)[0]
+
+    cont = dict()
+    cont['params'] = params
+    cont['settings'] = settings
+    cont['windows'] = windows
+    cont['weights'] = survival_weights(settings, params)
+    cont['direct'] = len(inds) > max_rank
+
+    if not cont['direct']:
+        lu = splu(ref_op.tocsc())
+        basis = zeros((L, len(inds)))
+        basis[inds, arange(len(inds))] = 1.0
+        cont['lu'] = lu
+        cont['inds'] = inds
+        cont['ref_rates'] = ref_rates[inds]
+        # P^T B^-1 P, the only dense piece that is kept
+        cont['inv_block'] = lu.solve(basis)[inds, :]
+
+    return cont
+
+
+def _point_solver(cont, kappa, well_diam):
+    '''
+    Return a function that solves -A x = rhs at the sweep point
+    '''
+    if well_diam not in cont['windows']:
+        raise ValueError("WELL_DIAM " + str(well_diam) + " was not in the continuation set")
+
+    point = cont['params'].copy()
+    point['KAPPA'] = kappa
+    point['WELL_DIAM'] = well_diam
+
+    if cont['direct']:
+        jac = radiff_timeop_sparse(0.0, cont['settings'], point, nondim=True)
+        return splu((-jac).tocsc()).solve
+
+    inds = cont['inds']
+    lu = cont['lu']
+    update = kappa_nondim(point)*cont['windows'][well_diam][inds] - cont['ref_rates']
+    small_lu = scipy.linalg.lu_factor(identity(len(inds)) + cont['inv_block']*update[None, :])
+
+    def solve(rhs):
+        # (B + P C P^T)^-1 r = B^-1 (r - P C (I + P^T B^-1 P C)^-1 P^T B^-1 r)
+        xvals = lu.solve(rhs)
+        corr = scipy.linalg.lu_solve(small_lu, xvals[inds])
+        rhs = rhs.copy()
+        rhs[inds] -= update*corr
+        return lu.solve(rhs)
+
+    return solve
+
+
+def continuation_solve(cont, rhs, kappa, well_diam=None):
+    '''
+    Solve -A x = rhs at the sweep point (kappa, well_diam), using the reference
+    factorization. kappa is in the units of the dimensional equation
+    '''
+    if well_diam is None:
+        well_diam = cont['params']['WELL_DIAM']
+    return _point_solver(cont, kappa, well_diam)(asarray(rhs, dtype=double))
+
+
+def continuation_moments(y0, cont, kvals, well_diams=None, orders=(1,)):
+    '''
+    Survival-time moments (see propagators.survival_moments) at every point
+    of a KAPPA x WELL_DIAM sweep, reusing one factorization throughout
+
+    y0 : array
+        The initial condition
+
+    cont : dict
+        The output of window_continuation
+
+    kvals : array
+        The KAPPA values, in the units of the dimensional equation
+
+    well_diams : array
+        The WELL_DIAM values. Defaults to the reference WELL_DIAM
+
+    orders : list of int
+        Which moments to return
+
+    RETURNS
+    -------
+
+    moments : array
+        Nondimensional moments, of shape (len(well_diams), len(kvals), len(orders))
+    '''
+    if well_diams is None:
+        well_diams = [cont['params']['WELL_DIAM']]
+    orders = [int(order) for order in orders]
+    y0 = asarray(y0, dtype=double)
+
+    moments = zeros((len(well_diams), len(kvals), len(orders)))
+    for dind, well_diam in enumerate(well_diams):
+        for kind, kappa in enumerate(kvals):
+            solve = _point_solver(cont, kappa, well_diam)
+            powers = dict()
+            yvals = y0
+            for order in range(1, amax(orders) + 1):
+                yvals = solve(yvals)
+                powers[order] = cont['weights'].dot(yvals)
+            moments[dind, kind] = [scipy.special.factorial(order)*powers[order] for order in orders]
+
+    return moments
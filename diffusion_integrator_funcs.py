@@ -9,6 +9,8 @@ William Gilpin, 2015
 from matplotlib.pyplot import *
 from scipy import *
 from numpy import *
+import scipy.sparse as sparse
+from scipy.sparse.linalg import splu
 
 def smoothstep(x,center=1.0,sharpness=1.0):
     '''
@@ -64,6 +66,329 @@ def grad1D(npts):
     return op
 
 
+def lap2d_sparse(npts):
+    """
+    Sparse (CSR) version of lap2d, with the same interior stencil and edge rows.
+    Only O(npts) entries are stored, so matrix-vector products cost O(npts)
+    """
+    b = ones(npts-1)
+    op = sparse.diags([b, -2*ones(npts), b], [-1, 0, 1], format='lil')
+
+    op[0,0] = 2
+    op[0,1] = 5
+    op[0,2] = 4
+    op[0,3] = 1
+
+    op[-1,-2] = 2
+
+    return op.tocsr()
+
+
+def grad1D_sparse(npts):
+    """
+    Sparse (CSR) version of grad1D, with the same interior stencil and edge rows
+    """
+    b = .5*ones(npts-1)
+    op = sparse.diags([b, b], [-1, 1], format='lil')
+
+    op[0,0] = -1.5
+    op[0,1] = 2.0
+    op[0,2] = -.5
+
+    op[-1,-1] = 1.
+    op[-1,-2] = 0.
+
+    op = op.tocsr()
+    op.eliminate_zeros()
+    return op
+
+
+def fd_weights(x0, xs, order):
+    """
+    Finite-difference weights for the derivative of the given order at x0,
+    using the values at the (arbitrarily spaced) points xs. Fornberg's
+    algorithm, Math. Comp. 51, 699 (1988)
+    """
+    npts = len(xs)
+    c = zeros((order+1, npts))
+    c[0,0] = 1.
+    c1 = 1.
+    c4 = xs[0] - x0
+    for i in range(1, npts):
+        mn = i if i < order else order
+        c2 = 1.
+        c5 = c4
+        c4 = xs[i] - x0
+        for j in range(i):
+            c3 = xs[i] - xs[j]
+            c2 = c2*c3
+            if j == i-1:
+                for k in range(mn, 0, -1):
+                    c[k,i] = c1*(k*c[k-1,i-1] - c5*c[k,i-1])/c2
+                c[0,i] = -c1*c5*c[0,i-1]/c2
+            for k in range(mn, 0, -1):
+                c[k,j] = (c4*c[k,j] - k*c[k-1,j])/c3
+            c[0,j] = c4*c[0,j]/c3
+        c1 = c2
+    return c[order]
+
+
+def is_uniform(space, rtol=1e-8):
+    """
+    Whether the grid points are evenly spaced
+    """
+    steps = diff(space)
+    return allclose(steps, steps[0], rtol=rtol, atol=0)
+
+
+def cell_edges(space):
+    """
+    The edges of the cells around each grid point: the midpoints between
+    neighbours, and half a step beyond each end of the grid
+    """
+    space = asarray(space, dtype=double)
+    return concatenate(([space[0] - (space[1] - space[0])/2],
+                        (space[1:] + space[:-1])/2,
+                        [space[-1] + (space[-1] - space[-2])/2]))
+
+
+def quadrature_weights(space, order=None):
+    """
+    Weights w such that w.dot(f) approximates the integral of f over the grid.
+    By default each point gets the width of its cell, which on a uniform grid
+    is the dx*sum(f) rule used in the notebooks. That rule runs half a step
+    past each end of the grid, so it is only first-order accurate
+    
+    order : int
+        If given, integrate each interval between grid points exactly for
+        polynomials through the order nearest points, which is accurate to
+        that order over [space[0], space[-1]]. order=2 is the trapezoidal rule
+    """
+    space = asarray(space, dtype=double)
+    if order is None:
+        if is_uniform(space):
+            return (space[2]-space[1])*ones(len(space))
+        return diff(cell_edges(space))
+    
+    npts = len(space)
+    powers = arange(order)
+    weights = zeros(npts)
+    for i in range(npts-1):
+        first = int(clip(i - order//2 + 1, 0, npts - order))
+        inds = arange(first, first + order)
+        step = space[i+1] - space[i]
+        # the interval is [0, 1] in these coordinates
+        coords = (space[inds] - space[i])/step
+        vander = coords[None, :]**powers[:, None]
+        weights[inds] += step*linalg.solve(vander, 1/(powers + 1.))
+    return weights
+
+
+def zero_slope_weights(x0, xs):
+    """
+    Weights for the second derivative at x0 of the polynomial through the
+    values at xs that also has zero slope at x0 (x0 is one of xs). This is
+    the reflecting edge condition built into a one-sided stencil; with the
+    three points of a uniform grid it is exact up to cubics
+    """
+    xs = asarray(xs, dtype=double)
+    scale = amax(abs(xs - x0))
+    coords = (xs - x0)/scale
+    # every power but the linear one, whose coefficient is the slope
+    powers = concatenate(([0], arange(2, len(xs) + 1)))
+    target = zeros(len(xs))
+    target[1] = 2.
+    return linalg.solve(coords[None, :]**powers[:, None], target)/scale**2
+
+
+def _fd_operator(space, deriv, order):
+    """
+    Sparse operator for the derivative of the given order (1 or 2) on an
+    arbitrary grid, accurate to the given even order. Rows that have room use
+    centered stencils of order+1 points, and the rows next to the ends
+    off-centered stencils of order+deriv points. Both ends reflect: the slope
+    is zero there, and the end rows of the second derivative use that
+    condition (see zero_slope_weights). At the outer edge this is what the
+    last row of lap2d does, and at the inner edge it is the condition on y for
+    a density that is smooth at the origin
+    """
+    space = asarray(space, dtype=double)
+    npts = len(space)
+    half = order//2
+    nside = order + deriv
+    
+    rows, cols, vals = list(), list(), list()
+    for i in range(npts):
+        if i in (0, npts-1):
+            if deriv == 1:
+                continue
+            inds = arange(order+1) if i == 0 else arange(npts-order-1, npts)
+            wts = zero_slope_weights(space[i], space[inds])
+        else:
+            if i < half:
+                inds = arange(nside)
+            elif i >= npts - half:
+                inds = arange(npts-nside, npts)
+            else:
+                inds = arange(i-half, i+half+1)
+            wts = fd_weights(space[i], space[inds], deriv)
+        rows.extend([i]*len(inds))
+        cols.extend(inds)
+        vals.extend(wts)
+    
+    return sparse.csr_matrix((vals, (rows, cols)), shape=(npts, npts))
+
+
+def lap_nonuniform(space, order=2):
+    """
+    Sparse second-derivative operator on an arbitrary grid. With order=2 the
+    rows are the three-point stencils for the local spacings, and higher
+    (even) orders use wider stencils. Both ends reflect, unlike lap2d, whose
+    first row is a one-sided stencil
+    """
+    return _fd_operator(space, 2, order)
+
+
+def grad_nonuniform(space, order=2):
+    """
+    Sparse first-derivative operator on an arbitrary grid. With order=2 the
+    rows are the three-point stencils for the local spacings, and higher
+    (even) orders use wider stencils. The slope is zero at both (reflecting)
+    ends
+    """
+    return _fd_operator(space, 1, order)
+
+
+def compact_operators(space):
+    """
+    Fourth-order compact (Pade) second and first derivative operators on a
+    uniform grid. In the interior
+
+        f''[i-1]/10 + f''[i] + f''[i+1]/10 = (6/5) (f[i+1] - 2 f[i] + f[i-1])/dx**2
+        f'[i-1]/4 + f'[i] + f'[i+1]/4 = (3/4) (f[i+1] - f[i-1])/dx
+
+    and the first and last rows are the explicit fourth-order stencils of
+    lap_nonuniform and grad_nonuniform, which reflect at both ends. Each
+    operator is the solution of a tridiagonal system, and so is a dense
+    matrix (returned in sparse form)
+
+    RETURNS
+    -------
+
+    lap, grad : sparse matrices
+    """
+    space = asarray(space, dtype=double)
+    if not is_uniform(space):
+        raise ValueError("The compact stencils need a uniform grid")
+    npts = len(space)
+    dx = space[2]-space[1]
+    
+    ops = list()
+    for deriv, alpha, rhs_stencil in [(2, 1/10., array([6/5., -12/5., 6/5.])/dx**2),
+                                      (1, 1/4., array([-3/4., 0., 3/4.])/dx)]:
+        off = alpha*ones(npts-1)
+        off_lo, off_up = off.copy(), off.copy()
+        off_lo[-1] = 0
+        off_up[0] = 0
+        lhs = sparse.diags([off_lo, ones(npts), off_up], [-1, 0, 1], format='csc')
+        
+        rhs = sparse.diags([rhs_stencil[0]*ones(npts-1), rhs_stencil[1]*ones(npts),
+                            rhs_stencil[2]*ones(npts-1)], [-1, 0, 1], format='lil')
+        edges = _fd_operator(space, deriv, 4).tolil()
+        rhs[0,:] = edges[0,:]
+        rhs[-1,:] = edges[-1,:]
+        
+        op = splu(lhs).solve(rhs.toarray())
+        ops.append(sparse.csr_matrix(op))
+    return ops[0], ops[1]
+
+
+def chebyshev_grid(first, last, npts):
+    """
+    The Chebyshev (Gauss-Lobatto) points on [first, last], which cluster at
+    both ends. The 'chebyshev' stencil should be used on this grid
+    """
+    s = -cos(pi*arange(npts)/(npts-1))
+    return first + (last - first)*(s + 1)/2
+
+
+def spectral_operators(space):
+    """
+    Pseudospectral second and first derivative operators: the derivatives of
+    the polynomial through all of the grid values, using the barycentric
+    formula. These are dense, and are only well conditioned on grids that
+    cluster at the ends like chebyshev_grid. The first derivative is set to
+    zero at both ends before the second derivative is built from it, so that
+    both ends reflect as for the finite-difference stencils. Rounding error
+    grows with the grid size, so past about 100 points the operators get less
+    accurate rather than more
+
+    RETURNS
+    -------
+
+    lap, grad : sparse matrices
+    """
+    space = asarray(space, dtype=double)
+    
+    # the barycentric weights, through their logarithms as the products of
+    # many differences overflow
+    diffs = space[:, None] - space[None, :]
+    fill_diagonal(diffs, 1.)
+    logs = -sum(log(abs(diffs)), axis=1)
+    bary = prod(sign(diffs), axis=1)*exp(logs - amax(logs))
+    
+    drv = (bary[None, :]/bary[:, None])/(space[:, None] - space[None, :] + eye(len(space)))
+    fill_diagonal(drv, 0.)
+    drv -= diag(sum(drv, axis=1))
+    
+    grad = drv.copy()
+    grad[0] = 0.
+    grad[-1] = 0.
+    lap = drv.dot(grad)
+    return sparse.csr_matrix(lap), sparse.csr_matrix(grad)
+
+
+# The finite-difference stencils for the spatial operator. 'legacy' is lap2d and
+# grad1D, exactly as in the notebooks, and needs a uniform grid. 'fd2', 'fd4' and
+# 'fd6' use stencils of that order weighted for the local spacing, so they work on
+# any grid. 'compact4' is the fourth-order Pade scheme, for uniform grids, and
+# 'chebyshev' is spectral, for chebyshev_grid
+SPACE_STENCILS = ('legacy', 'fd2', 'fd4', 'fd6', 'compact4', 'chebyshev')
+
+# The order of the quadrature_weights used with each stencil
+STENCIL_QUADRATURE = dict(legacy=None, fd2=2, fd4=4, fd6=6, compact4=4, chebyshev=6)
+
+# The formal order of accuracy of each stencil. The legacy stencils are
+# nominally second order, and the spectral one beats any power
+STENCIL_ORDER = dict(legacy=2, fd2=2, fd4=4, fd6=6, compact4=4, chebyshev=inf)
+
+
+def stencil_operators(space, stencil):
+    """
+    The second and first derivative operators of one of SPACE_STENCILS on the
+    grid space
+
+    RETURNS
+    -------
+
+    lap, grad : sparse matrices
+    """
+    space = asarray(space, dtype=double)
+    if stencil == 'legacy':
+        if not is_uniform(space):
+            raise ValueError("The legacy stencils need a uniform grid, use stencil='fd2'")
+        dx = space[2]-space[1]
+        return lap2d_sparse(len(space))/dx**2, grad1D_sparse(len(space))/dx
+    elif stencil in ('fd2', 'fd4', 'fd6'):
+        order = int(stencil[2:])
+        return lap_nonuniform(space, order), grad_nonuniform(space, order)
+    elif stencil == 'compact4':
+        return compact_operators(space)
+    elif stencil == 'chebyshev':
+        return spectral_operators(space)
+    raise ValueError("Unknown stencil: " + str(stencil))
+
+
 def make_fht(times, sol):
     '''
     Make an approximate first-passage time distribution given the survival probability distribution
@@ -76,6 +401,9 @@ def janky_laplace(signal, num_lvls = 50):
     '''
     finds the relative weights of various timescales present in
     a monotonically-decaying signal
+    
+    This only builds the basis; fit_rate_spectrum in rate_spectrum.py fits
+    many curves against a log-spaced one
     '''
     signal = signal.copy()
     signal = signal/ sum(signal)
@@ -108,19 +436,86 @@ def expspace(lowlim, uplum, npts):
     '''
     return exp(linspace(log(lowlim), log(uplum),npts))
 
-def gram_schmidt(X, row_vecs=True, norm = True):
+
+def clustered_grid(first, last, npts, center, width):
+    '''
+    A grid from first to last whose points are concentrated around center,
+    e.g. the edge of the reactive well. Within about width of center the
+    spacing is smallest, and it grows exponentially away from it. This is
+    the map r = center + width*sinh(s) applied to evenly spaced s
+    '''
+    s0 = arcsinh((first - center)/width)
+    s1 = arcsinh((last - center)/width)
+    space = center + width*sinh(linspace(s0, s1, npts))
+    space[0] = first
+    space[-1] = last
+    return space
+
+
+def output_schedule(start_time, stop_time, npts, spacing='log', first_step=None):
+    '''
+    Build a grid of output times for the solvers, which take their own internal
+    steps and only record the state at these times
     
+    start_time, stop_time : double
+        The span of the integration. start_time is always the first entry
+        
+    npts : int
+        The number of output times, including start_time
+        
+    spacing : str
+        'linear' is the old linspace grid. 'log' samples [start_time, stop_time]
+        logarithmically with expspace, and so requires start_time > 0. 'geometric'
+        places the offsets from start_time on a logarithmic grid running from
+        first_step to (stop_time - start_time), so it may start at zero
+        
+    first_step : double
+        The first offset of a geometric schedule. Defaults to 1e-6 of the span
+    '''
+    npts = int(npts)
+    
+    if spacing == 'linear':
+        times = linspace(start_time, stop_time, npts)
+    elif spacing == 'log':
+        if start_time <= 0:
+            raise ValueError("A log schedule needs start_time > 0, use 'geometric' instead")
+        times = expspace(start_time, stop_time, npts)
+    elif spacing == 'geometric':
+        span = stop_time - start_time
+        if first_step is None:
+            first_step = 1e-6*span
+        times = start_time + concatenate(([0.0], expspace(first_step, span, npts-1)))
+    else:
+        raise ValueError("Unknown schedule spacing: " + str(spacing))
+    
+    # guard against roundoff at the endpoints
+    times[0] = start_time
+    times[-1] = stop_time
+    return times
+
+def gram_schmidt(X, row_vecs=True, norm = True):
+    '''
+    Orthogonalize the rows (or columns, if row_vecs is False) of X in order,
+    as classical Gram-Schmidt would, but through one Householder QR
+    factorization rather than a projection per vector. If norm is False the
+    vectors keep the lengths that Gram-Schmidt leaves them with. The output
+    has the shape of X; when there are more vectors than dimensions, those
+    past the dimension have nothing left after the projections and are zero
+    '''
     if not row_vecs:
         X = X.T
-        
-    Y = X[0:1,:].copy()
-    for i in range(1, X.shape[0]):
-        proj = np.diag((X[i,:].dot(Y.T)/np.linalg.norm(Y,axis=1)**2).flat).dot(Y)
-        Y = np.vstack((Y, X[i,:] - proj.sum(0)))
+    
+    X = asarray(X, dtype=double)
+    q, r = linalg.qr(X.T)
+    # the Gram-Schmidt vectors are r[i, i] q[:, i], and point along the rows of X
+    nvec = min(X.shape)
+    Y = zeros(X.shape)
     if norm:
-        Y = np.diag(1/np.linalg.norm(Y,axis=1)).dot(Y)
+        Y[:nvec] = (q*sign(diag(r)))[:, :nvec].T
+    else:
+        Y[:nvec] = (q*diag(r))[:, :nvec].T
         
     if row_vecs:
         return Y
     else:
-        return Y.T
\ No newline at end of file
+        return Y.T
@@ -0,0 +1,224 @@
+'''
+Monte Carlo simulation of fractional Brownian walkers
+
+A particle-level check on the reaction-diffusion solvers. Each walker moves in
+three dimensions in the harmonic potential whose equilibrium is eq_dist, driven
+by fractional Gaussian noise with Hurst exponent ALPHA/2, so that a free walker
+has the mean-squared displacement 2*DCOEFF*t^ALPHA per coordinate. The
+restoring force uses the same time change tau = DCOEFF*t^ALPHA as the PDE,
+
+    X(t_k+1) = exp(-(tau_k+1 - tau_k)/(2 POT_DIAM^2)) X(t_k) + sqrt(2 DCOEFF) dB_H
+
+so that for ALPHA = 1 the walkers approximate the Ornstein-Uhlenbeck process
+that radiff_timeop is meant to describe. The restoring force is integrated
+exactly over each step, but the noise increment leaves out the shrinking of
+its variance by the restoring force within the step, and the reaction weight
+uses the rate at the start of the step, so both errors are first order in the
+step. For other ALPHA the walkers keep the memory of the noise, which the PDE
+does not, and the difference between the two is the point of comparison.
+
+The noise is generated with the Davies-Harte circulant embedding, which costs
+O(N log N) per walker for N time steps. Walkers are simulated in chunks whose
+noise fits in a fixed memory budget, and only the running sums behind the
+survival curve and the radial histograms are kept between chunks.
+
+Rather than removing walkers when they react, each walker carries the
+probability that it has not yet reacted, which decays at the local rate
+KAPPA*drain_window. This gives the same survival curve with less noise.
+
+William Gilpin, 2015
+'''
+
+from numpy import *
+
+from brownian_integrator import *
+
+
+def _build_fgn_spectrum(nsteps, hurst):
+
+    # autocovariance of unit-variance fractional Gaussian noise
+    lags = arange(nsteps + 1, dtype=double)
+    acov = 0.5*(abs(lags + 1)**(2*hurst) - 2*lags**(2*hurst) + abs(lags - 1)**(2*hurst))
+
+    # eigenvalues of the 2N circulant matrix that embeds the covariance
+    row = concatenate((acov, acov[-2:0:-1]))
+    evals = real(fft.fft(row))
+    if amin(evals) < -1e-8*amax(evals):
+        raise ValueError("Circulant embedding failed for Hurst exponent " + str(hurst))
+
+    return sqrt(maximum(evals, 0)/len(row))
+
+
+def fgn_davies_harte(nsteps, hurst, nseries, rng):
+    '''
+    Sample nseries independent paths of nsteps unit-variance fractional
+    Gaussian noise with the Davies-Harte method. The real and imaginary parts
+    of each FFT give two independent paths
+
+    RETURNS
+    -------
+
+    noise : array
+        An (nsteps, nseries) array
+    '''
+    key = ('fgn', nsteps, hurst)
+    spectrum = cached_operator(key, _build_fgn_spectrum, nsteps, hurst)
+
+    npairs = (nseries + 1)//2
+    # complex normals as (re, im) pairs, with the FFT along the contiguous axis
+    white = rng.standard_normal((npairs, len(spectrum), 2)).view(complex128)[:, :, 0]
+    white *= spectrum
+    paths = fft.fft(white, axis=1)[:, :nsteps]
+    return concatenate((paths.real, paths.imag), axis=0)[:nseries].T
+
+
+def initial_positions(nwalkers, settings, params, rng, y0=None):
+    '''
+    Sample walker positions from the radial density y0*eq_dist on the grid,
+    with uniformly random directions. If y0 is None, the positions are drawn
+    exactly from the three-dimensional gaussian equilibrium
+
+    RETURNS
+    -------
+
+    pos : array
+        An (nwalkers, 3) array of positions
+
+    mass : double
+        The total mass survival_weights.dot(y0), the survival at t = 0
+    '''
+    a = params['POT_DIAM']
+    if y0 is None:
+        return sqrt(2)*a*rng.standard_normal((nwalkers, 3)), 1.0
+
+    allspace = settings['space']
+    edges = cell_edges(allspace)
+    weights = survival_weights(settings, params)
+    density = maximum(asarray(y0, dtype=double), 0)*weights
+    mass = weights.dot(y0)
+
+    # uniformly within the cell of each chosen grid point
+    inds = rng.choice(len(allspace), size=nwalkers, p=density/sum(density))
+    radii = abs(edges[inds] + diff(edges)[inds]*rng.random(nwalkers))
+    dirs = rng.standard_normal((nwalkers, 3))
+    dirs /= sqrt(sum(dirs**2, axis=1))[:, None]
+    return radii[:, None]*dirs, mass
+
+
+def simulate_walkers(settings, params, nwalkers=100000, nsteps=1000, y0=None, output_times=None,
+                     max_memory=2**28, seed=None):
+    '''
+    Simulate fractional Brownian walkers in the harmonic potential with a
+    reactive well, and collect the observables that the PDE solvers return
+
+    settings : dict
+        settings['space'] sets the radial histogram bins and the reaction window,
+        settings['times'] the time span (and the default output times)
+
+    params : dict
+        POT_DIAM, WELL_DIAM, KAPPA, DCOEFF and ALPHA, with 0 < ALPHA < 2
+
+    nwalkers : int
+        The number of walkers
+
+    nsteps : int
+        The number of uniform time steps from times[0] to times[-1]
+
+    y0 : array
+        The initial profile relative to eq_dist, as passed to solve_radiff. If
+        None, the walkers start from the exact equilibrium (y0 = 1)
+
+    output_times : array
+        The times at which to record observables; each is matched to the first
+        step at or after it. Defaults to settings['times']
+
+    max_memory : int
+        The approximate number of bytes of noise held at once, which sets how
+        many walkers are simulated per chunk
+
+    seed : int
+        Seed for the random number generator
+
+    RETURNS
+    -------
+
+    out : dict
+        out['times'], the output times
+        out['survival'], the surviving fraction, comparable to the Survival reducer
+        out['survival_err'], its standard error
+        out['fht'], -diff(survival), the first-passage histogram in the
+        convention of make_fht
+        out['density'], an (L, len(times)) array of the radial density of
+        unreacted walkers on settings['space'], comparable to yvals*eq_dist
+    '''
+    alpha = params['ALPHA']
+    if not 0 < alpha < 2:
+        raise ValueError("ALPHA must lie between 0 and 2 for fractional Brownian motion")
+    hurst = alpha/2
+
+    rng = random.default_rng(seed)
+    allspace = asarray(settings['space'], dtype=double)
+    window = drain_window(allspace, params['WELL_DIAM'], params.get('WELL_EDGE'))
+    L = len(allspace)
+
+    times = asarray(settings['times'], dtype=double)
+    steps = linspace(times[0], times[-1], nsteps + 1)
+    dt = steps[1] - steps[0]
+    if output_times is None:
+        output_times = times
+    out_inds = unique(clip(searchsorted(steps, asarray(output_times) - 1e-12*dt), 0, nsteps))
+    slots = dict(zip(out_inds.tolist(), range(len(out_inds))))
+
+    # the restoring force over each step, with the same time change as the PDE
+    taus = time_nondim(steps, params)
+    decay = exp(-diff(taus)/(2*params['POT_DIAM']**2))
+    noise_scale = sqrt(2*params['DCOEFF'])*dt**hurst
+    rxn_step = params['KAPPA']*dt
+
+    # histogram bins centered on the grid points
+    edges = cell_edges(allspace)
+    widths = diff(edges)
+
+    surv_sum = zeros(len(out_inds))
+    surv_sq = zeros(len(out_inds))
+    hist_sum = zeros((L, len(out_inds)))
+
+    # complex noise of length 2*nsteps for half of the 3 coordinates per walker
+    chunk_size = int(maximum(1, max_memory//(48*nsteps)))
+
+    for start in range(0, nwalkers, chunk_size):
+        nchunk = int(minimum(chunk_size, nwalkers - start))
+        pos, mass = initial_positions(nchunk, settings, params, rng, y0=y0)
+        pos = ascontiguousarray(pos.T)
+        noise = fgn_davies_harte(nsteps, hurst, 3*nchunk, rng).reshape(nsteps, 3, nchunk)
+        noise *= noise_scale
+        logw = zeros(nchunk)
+
+        def record(step_ind, radii):
+            slot = slots[step_ind]
+            wts = mass*exp(logw)
+            surv_sum[slot] += sum(wts)
+            surv_sq[slot] += sum(wts**2)
+            bins = searchsorted(edges, radii) - 1
+            inside = (bins >= 0) & (bins < L)
+            hist_sum[:, slot] += bincount(bins[inside], weights=wts[inside], minlength=L)
+
+        radii = sqrt(einsum('ij,ij->j', pos, pos))
+        if 0 in slots:
+            record(0, radii)
+        for k in range(nsteps):
+            logw -= rxn_step*interp(radii, allspace, window)
+            pos *= decay[k]
+            pos += noise[k]
+            radii = sqrt(einsum('ij,ij->j', pos, pos))
+            if k + 1 in slots:
+                record(k + 1, radii)
+
+    surv = surv_sum/nwalkers
+    out = dict()
+    out['times'] = steps[out_inds]
+    out['survival'] = surv
+    out['survival_err'] = sqrt(maximum(surv_sq/nwalkers - surv**2, 0)/nwalkers)
+    out['fht'] = -diff(surv)
+    out['density'] = hist_sum/(nwalkers*widths[:, None])
+    return out
@@ -1,13 +1,16 @@
 '''
-DEV NOTE: This functions are deprecated and are thus not called by the primary integrator. These are 
+DEV NOTE: These fixed-step integrators are not called by the primary integrator. They are 
 mainly useful for testing on small meshes for internal consistency 
 
 
 Simulation of fractional Brownian motion subject to a harmonic potential 
 using standard reaction schemes
 
-Several integrators are available, including Euler, RK4, and a fancy method that uses LSODA and 
-which exploits the linearity of the diffusion operator for the system.
+Several fixed-step integrators are available: Euler, RK4, Crank-Nicolson and exponential Euler.
+The equation is linear, so each scheme reduces to applying a step operator. For the
+time-independent nondimensional operator that step operator is built once; for the dimensional
+operator it is assembled from the cached sparse pieces at each step. Many initial conditions can
+be advanced at once as the columns of an (L, M) array, and only the scheduled output times are kept.
 
 
 Notes:
@@ -27,24 +30,189 @@ from matplotlib.pyplot import *
 from scipy import *
 from numpy import *
 
+import scipy.linalg
+import scipy.sparse as sparse
+from scipy.sparse.linalg import splu, expm_multiply
+
 from diffusion_integrator_funcs import *
+from brownian_integrator import *
 
 
-def rk4_mesh(yinit, ynxt, settings, params):
+FIXED_STEP_SCHEMES = ('euler', 'rk4', 'crank', 'expeuler')
+
+
+def _constant_stepper(jac, dt, scheme):
+    '''
+    Precompute the one-step operator of a scheme for a constant operator jac
+    '''
+    iden = sparse.identity(jac.shape[0], format='csr')
+    hjac = dt*jac
+    
+    if scheme == 'euler':
+        stepmat = (iden + hjac).tocsr()
+    elif scheme == 'rk4':
+        # the RK4 stability polynomial of h*A, which is still banded
+        hjac2 = hjac.dot(hjac)
+        hjac3 = hjac2.dot(hjac)
+        stepmat = (iden + hjac + hjac2/2 + hjac3/6 + hjac3.dot(hjac)/24).tocsr()
+    elif scheme == 'crank':
+        lu = splu((iden - hjac/2).tocsc())
+        explicit_part = (iden + hjac/2).tocsr()
+        return lambda t, yvals: lu.solve(explicit_part.dot(yvals))
+    elif scheme == 'expeuler':
+        # exact for a constant operator; dense, so meant for small meshes
+        stepmat = scipy.linalg.expm(hjac.toarray())
+    
+    return lambda t, yvals: stepmat.dot(yvals)
+
+
+def _timedep_stepper(settings, params, dt, scheme):
+    '''
+    One-step operator of a scheme for the dimensional operator, whose
+    diffusion prefactor changes with time
+    '''
+    spaceop, rxn_rates = radiff_parts(settings, params)
+    rxn_op = sparse.diags(rxn_rates)
+    iden = sparse.identity(spaceop.shape[0], format='csr')
+    
+    def jac_at(t):
+        return -diffusion_prefactor(t, params)*spaceop - rxn_op
+    
+    def deriv(t, yvals):
+        return -diffusion_prefactor(t, params)*spaceop.dot(yvals) - (rxn_rates*yvals.T).T
+    
+    if scheme == 'euler':
+        def step(t, yvals):
+            return yvals + dt*deriv(t, yvals)
+    elif scheme == 'rk4':
+        def step(t, yvals):
+            k1 = deriv(t, yvals)
+            k2 = deriv(t + 0.5*dt, yvals + 0.5*dt*k1)
+            k3 = deriv(t + 0.5*dt, yvals + 0.5*dt*k2)
+            k4 = deriv(t + dt, yvals + dt*k3)
+            return yvals + dt*(k1 + 2.0*(k2 + k3) + k4)/6.0
+    elif scheme == 'crank':
+        def step(t, yvals):
+            lu = splu((iden - (dt/2)*jac_at(t + dt)).tocsc())
+            return lu.solve(yvals + (dt/2)*deriv(t, yvals))
+    elif scheme == 'expeuler':
+        def step(t, yvals):
+            return expm_multiply(dt*jac_at(t + 0.5*dt), yvals)
+    
+    return step
+
+
+def _function_stepper(ynxt, settings, params, dt, scheme):
+    '''
+    One-step operator of an explicit scheme for an arbitrary derivative
+    function ynxt(t, yvals, [settings, params])
+    '''
+    settings_and_params = [settings, params]
+    
+    def deriv(t, yvals):
+        return ynxt(t, yvals, settings_and_params)
+    
+    if scheme == 'euler':
+        def step(t, yvals):
+            return yvals + dt*deriv(t, yvals)
+    elif scheme == 'rk4':
+        def step(t, yvals):
+            k1 = deriv(t, yvals)
+            k2 = deriv(t + 0.5*dt, yvals + 0.5*dt*k1)
+            k3 = deriv(t + 0.5*dt, yvals + 0.5*dt*k2)
+            k4 = deriv(t + dt, yvals + dt*k3)
+            return yvals + dt*(k1 + 2.0*(k2 + k3) + k4)/6.0
+    else:
+        raise ValueError("Only the explicit schemes accept a derivative function")
+    
+    return step
+
+
+def fixed_step_mesh(yinit, settings, params, scheme='rk4', nondim=False, ynxt=None,
+                    output_times=None):
     """
-    ynxt : function
-        The function that computes the next step in the forward march
+    March the reaction-diffusion equation with a fixed time step
     
-    dt : double
-        The spatial step
+    yinit : array
+        The initial condition on settings['space'], or an (L, M) array whose
+        columns are M initial conditions that are advanced together
+        
+    settings : dict
+        settings['space'], and settings['times'], a uniform grid of time steps
+        whose first entry is the initial time
+        
+    params : dict
+        A dictionary containing all the necessary parameters for the 
+        differential equation system.
+        
+    scheme : str
+        'euler', 'rk4', 'crank' (Crank-Nicolson) or 'expeuler' (exponential
+        Euler, which is exact for the nondimensional operator)
+        
+    nondim : bool
+        Integrate the nondimensional equation of radiff_timeop_nondim. Its
+        step operator is built once before the march
+        
+    ynxt : function
+        Optionally, an arbitrary derivative function ynxt(t, yvals, [settings, params])
+        to march instead of the built-in operators (euler and rk4 only)
         
-    dx : double
-        The time step size
+    output_times : array
+        The times at which to keep the state; each is matched to the first
+        step at or after it. Defaults to every step
         
-    use_crank : boolean
-        Whether to use Crank-Nicolson forward marching, in which the next timestep
-        is determined by equal weights of the previous two timesteps. If not, the
-        integrator uses standard Forward Euler
+    RETURNS
+    -------
+    
+    out_times : array
+        The times of the kept states
+        
+    solmesh : array
+        The kept states, (L x time), or (L x M x time) for stacked initial conditions
+    """
+    if scheme not in FIXED_STEP_SCHEMES:
+        raise ValueError("Unknown fixed step scheme: " + str(scheme))
+    
+    times = asarray(settings['times'], dtype=double)
+    dt = times[1] - times[0]
+    if not allclose(diff(times), dt):
+        raise ValueError("The fixed step integrators need uniformly spaced times")
+    
+    if ynxt is not None:
+        step = _function_stepper(ynxt, settings, params, dt, scheme)
+    elif nondim:
+        step = _constant_stepper(radiff_timeop_sparse(0.0, settings, params, nondim=True),
+                                 dt, scheme)
+    else:
+        step = _timedep_stepper(settings, params, dt, scheme)
+    
+    if output_times is None:
+        out_inds = arange(len(times))
+    else:
+        out_inds = clip(searchsorted(times, output_times), 0, len(times) - 1)
+    
+    yvals = array(yinit, dtype=double)
+    solmesh = zeros(yvals.shape + (len(out_inds),))
+    
+    next_out = 0
+    for tind in range(len(times)):
+        if tind > 0:
+            yvals = step(times[tind-1], yvals)
+        while next_out < len(out_inds) and out_inds[next_out] == tind:
+            solmesh[..., next_out] = yvals
+            next_out += 1
+        if next_out == len(out_inds):
+            break
+    
+    return times[out_inds], solmesh
+
+
+def rk4_mesh(yinit, ynxt, settings, params):
+    """
+    ynxt : function
+        The function that computes the derivative, nxt_step or nxt_step_nondim.
+        For these two the cached operators are used directly; any other
+        function with the same signature is marched as given
         
     settings : dict
         A dictionary containing all the necessary steps and 
@@ -54,86 +222,46 @@ def rk4_mesh(yinit, ynxt, settings, params):
         A dictionary containing all the necessary parameters for the 
         differential equation system.
         
+    Returns the solution times the gaussian weight of the notebooks,
+    4 pi r^2 exp(-r^2/(4 a^2))/sqrt(2 pi a^2), at every time in
+    settings['times']. This is 4 sqrt(2) pi a^2 times the radial probability
+    density yvals*eq_dist
     """
-    use_crank = True
-    
-    space = settings['space']
-    times = settings['times']
-    dt = times[2] - times[1]
-    
-    solmesh = zeros([len(yinit), len(times)])
-    solmesh[:,0] = yinit
-    tL = len(solmesh[0,:])
-    for tind, time in enumerate(times):
-        if tind > 0 and tind < tL:
-            
-            if use_crank == False:
-                ind_list = [1]
-                wgt = 1.0
-            else:
-                ind_list = [1,2]
-                wgt = .5
-            
-            solmesh[:,tind] = solmesh[:,tind-1]
-            for ii in ind_list:
-                k1 = ynxt( solmesh[:,tind-ii], time, dt, settings, params)          
-                k2 = ynxt( solmesh[:,tind-ii]+ 0.5*k1, time + 0.5*dt, dt, settings, params)
-                k3 = ynxt( solmesh[:,tind-ii]+ 0.5*k2, time + 0.5*dt, dt, settings, params)
-                k4 = ynxt( solmesh[:,tind-ii]+ k3, time+dt, dt, settings, params)
-                solmesh[:,tind] += wgt*dt*(k1 + 2.0*(k2 + k3) + k4)/6.0
-    
-    # get gaussian part
-    gauss = (1/sqrt(2*pi*params['POT_DIAM']**2))*exp(-space**2/(4*params['POT_DIAM']**2))
-    gausspart = tile(gauss,(tL,1)).T
-    solmesh = solmesh*gausspart
-    
-    # now convert to pdf
-    radpart = tile(4*pi*(space**2),(tL,1)).T
-    solmesh = radpart*solmesh
-    return solmesh
+    return _density_mesh(yinit, ynxt, settings, params, 'rk4')
     
 def euler_mesh(yinit, ynxt, settings, params):
     """
     ynxt : function
         The function that returns the discrete derivative at a given timepoint
+        (see rk4_mesh)
     
-    dt : double
-        The spatial step
-        
-    dx : double
-        The time step size
-
     Notes: For almost any situation in which you might call this function, you might
-    as well just use rk4_mesh. This code is slow and mainly exists for testing purposes
-    """
+    as well just use rk4_mesh. This code mainly exists for testing purposes
     
-    space = settings['space']
-    times = settings['times']
-    dt = times[2] - times[1]
+    Returns the radial probability density (the solution times eq_dist) at
+    every time in settings['times'], the normalization that the original
+    version of this function set out to apply
+    """
+    return _density_mesh(yinit, ynxt, settings, params, 'euler')
+
 
-    solmesh = zeros([len(yinit), len(times)])
-    solmesh[:,0] = yinit
-    tL = len(solmesh[0,:])
-    for tind, time in enumerate(times):
-        if tind > 0 and tind < tL:
-            solmesh[:,tind] = solmesh[:,tind-1] + dt*ynxt( solmesh[:,tind-1], time, dt, settings, params)
+def _density_mesh(yinit, ynxt, settings, params, scheme):
     
-    # get gaussian part
-    # gauss = (1/sqrt(2*pi*params['POT_DIAM']**2))*exp(-space**2/(4*params['POT_DIAM']**2))
-    # gausspart = tile(gauss,(tL,1)).T
-    # solmesh = solmesh*gausspart
+    if ynxt is nxt_step:
+        times, solmesh = fixed_step_mesh(yinit, settings, params, scheme=scheme)
+    elif ynxt is nxt_step_nondim:
+        times, solmesh = fixed_step_mesh(yinit, settings, params, scheme=scheme, nondim=True)
+    else:
+        times, solmesh = fixed_step_mesh(yinit, settings, params, scheme=scheme, ynxt=ynxt)
     
-    # # now convert to pdf
-    # radpart = tile(4*pi*(space**2),(tL,1)).T
-    # solmesh = radpart*solmesh
-
-    gauss = eq_dist(space, params['POT_DIAM'])
-    gauss = gauss[:, None]
-    sol = sol*gauss
+    space = settings['space']
+    a = params['POT_DIAM']
+    if scheme == 'rk4':
+        # rk4_mesh keeps its original normalization
+        gauss = 4*pi*(space**2)*exp(-space**2/(4*a**2))/sqrt(2*pi*a**2)
+    else:
+        gauss = eq_dist(space, a)
+    gauss = gauss.reshape(gauss.shape + (1,)*(solmesh.ndim - 1))
+    solmesh = solmesh*gauss
 
     return solmesh
-
-
-
-
-
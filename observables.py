@@ -0,0 +1,155 @@
+'''
+Streaming reducers for the reaction-diffusion solvers
+
+Storing the full (space x time) solution costs L*time_pts doubles, but most
+analyses immediately collapse it to a surviving fraction or a first-passage
+time distribution. A reducer is handed each output state as the integrator
+reaches it, and it keeps only the observable it is responsible for, so that
+memory scales as O(L + number of outputs).
+
+Each reducer has three methods, called by solve_radiff:
+
+    start(times, settings, params)  -- before integration, with the output times
+    update(tind, time, yvals)       -- once per output time, in order
+    result()                        -- the reduced observable
+
+and a name, under which its result is stored in the dictionary returned by
+solve_radiff.
+
+William Gilpin, 2015
+'''
+
+from numpy import *
+
+from brownian_integrator import *
+
+
+class FullSolution(object):
+    '''
+    Keep every output state, which reproduces the old behaviour of
+    returning the full (space x time) solution mesh
+    '''
+    name = 'sol'
+
+    def start(self, times, settings, params):
+        self.sol = zeros((len(settings['space']), len(times)))
+        self.nsaved = 0
+
+    def update(self, tind, time, yvals):
+        self.sol[:, tind] = yvals
+        self.nsaved = tind + 1
+
+    def result(self):
+        return self.sol[:, :self.nsaved]
+
+
+class Survival(object):
+    '''
+    The surviving fraction dx*sum(yvals*eq_dist) at every output time
+    '''
+    name = 'survival'
+
+    def start(self, times, settings, params):
+        self.weights = survival_weights(settings, params)
+        self.surv = zeros(len(times))
+        self.nsaved = 0
+
+    def update(self, tind, time, yvals):
+        self.surv[tind] = self.weights.dot(yvals)
+        self.nsaved = tind + 1
+
+    def result(self):
+        return self.surv[:self.nsaved]
+
+
+class FirstPassage(object):
+    '''
+    The first-passage time density -dS/dt, estimated from the change in the
+    surviving fraction between successive output times. Unlike make_fht the
+    differences are divided by the time step, so the density integrates to
+    the fraction that has reacted. Entry k is the density on the interval
+    between output times k and k+1
+    '''
+    name = 'fpt'
+
+    def start(self, times, settings, params):
+        self.weights = survival_weights(settings, params)
+        self.fpt = zeros(maximum(len(times) - 1, 0))
+        self.nsaved = 0
+        self.last_time = None
+        self.last_surv = None
+
+    def update(self, tind, time, yvals):
+        surv = self.weights.dot(yvals)
+        if self.last_time is not None:
+            self.fpt[tind-1] = -(surv - self.last_surv)/(time - self.last_time)
+            self.nsaved = tind
+        self.last_time = time
+        self.last_surv = surv
+
+    def result(self):
+        return self.fpt[:self.nsaved]
+
+
+class RadialMoments(object):
+    '''
+    The radial moments dx*sum(r**k * yvals*eq_dist) at every output time.
+    Divide by the surviving fraction to get moments of the distribution of
+    surviving walkers
+
+    orders : list of int
+        Which moments k to track
+    '''
+    name = 'moments'
+
+    def __init__(self, orders=(1, 2)):
+        self.orders = list(orders)
+
+    def start(self, times, settings, params):
+        allspace = settings['space']
+        weights = survival_weights(settings, params)
+        self.moment_weights = array([weights*allspace**k for k in self.orders])
+        self.moments = zeros((len(self.orders), len(times)))
+        self.nsaved = 0
+
+    def update(self, tind, time, yvals):
+        self.moments[:, tind] = self.moment_weights.dot(yvals)
+        self.nsaved = tind + 1
+
+    def result(self):
+        return self.moments[:, :self.nsaved]
+
+
+class Snapshots(object):
+    '''
+    Store the full state only at selected times. Each requested time is
+    matched to the first output time at or after it (or to the last output
+    time, if it lies past the end)
+
+    snapshot_times : array
+        The times at which to keep the state
+    '''
+    name = 'snapshots'
+
+    def __init__(self, snapshot_times):
+        self.snapshot_times = asarray(snapshot_times, dtype=double)
+
+    def start(self, times, settings, params):
+        times = asarray(times)
+        inds = searchsorted(times, self.snapshot_times)
+        inds = clip(inds, 0, len(times) - 1)
+        self.keep = dict()
+        for col, ind in enumerate(inds):
+            self.keep.setdefault(int(ind), list()).append(col)
+        self.times = times[inds]
+        self.snaps = zeros((len(settings['space']), len(inds)))
+        self.filled = zeros(len(inds), dtype=bool)
+
+    def update(self, tind, time, yvals):
+        if tind in self.keep:
+            for col in self.keep[tind]:
+                self.snaps[:, col] = yvals
+                self.filled[col] = True
+
+    def result(self):
+        return self.times[self.filled], self.snaps[:, self.filled]
@@ -0,0 +1,422 @@
+'''
+Propagators for the nondimensional reaction-diffusion equation
+
+In the nondimensional form (radiff_timeop_nondim) the operator A does not depend
+on time; all of the time dependence sits in the rescaled time tau = time_nondim(t).
+The solution is therefore y(t) = exp(tau A) y0, which can be evaluated directly
+at any set of output times without marching an integrator through them.
+
+For small grids the spectral_* functions diagonalize A once. For large grids
+the krylov_* functions apply the action of the matrix exponential to the sparse
+operator with expm_multiply, which never forms a dense matrix.
+
+Moments of the survival time need no time stepping at all: they are linear
+solves against the same operator (see survival_moments).
+
+The dimensional operator A(t) = -ALPHA*DCOEFF*t^(ALPHA-1) S - R does change with
+time, but only through a scalar. magnus_step integrates that scalar exactly
+over each step, so large steps can be taken right from t = 0.
+
+In all of these functions y0 is the state at t = 0.
+
+William Gilpin, 2015
+'''
+
+from scipy import *
+from numpy import *
+import scipy.linalg
+import scipy.special
+import warnings
+import scipy.sparse as sparse
+from scipy.sparse.linalg import expm_multiply, splu, eigs, ArpackNoConvergence
+
+from brownian_integrator import *
+
+
+def _nondim_key(settings, params):
+    return (grid_key(settings['space']), settings.get('stencil'), params['POT_DIAM'],
+            params['WELL_DIAM'], params.get('WELL_EDGE'), kappa_nondim(params))
+
+
+def _output_taus(times, params, physical_times):
+    times = asarray(times, dtype=double)
+    if physical_times:
+        return time_nondim(times, params)
+    else:
+        return times
+
+
+def _build_spectral_decomp(settings, params):
+
+    jac = radiff_timeop_nondim(0.0, None, [settings, params])
+    evals, evecs = scipy.linalg.eig(jac)
+
+    # slowest modes first
+    order = argsort(-evals.real)
+    evals = evals[order]
+    evecs = evecs[:, order]
+
+    decomp = dict()
+    decomp['evals'] = evals
+    decomp['evecs'] = evecs
+    decomp['lu'] = scipy.linalg.lu_factor(evecs)
+    decomp['surv_modes'] = survival_weights(settings, params).dot(evecs)
+
+    return decomp
+
+
+def spectral_decomp(settings, params):
+    '''
+    Eigendecomposition of the nondimensional operator, A = V diag(evals) V^-1.
+    It is computed once per (space, POT_DIAM, WELL_DIAM, rescaled KAPPA) and
+    kept in the operator cache
+
+    RETURNS
+    -------
+
+    decomp : dict
+        decomp['evals'], the eigenvalues sorted from slowest to fastest decay
+        decomp['evecs'], the matching eigenvectors as columns
+        decomp['lu'], an LU factorization of the eigenvectors
+        decomp['surv_modes'], the surviving fraction carried by each eigenvector
+    '''
+    key = ('eig',) + _nondim_key(settings, params)
+    return cached_operator(key, _build_spectral_decomp, settings, params)
+
+
+def spectral_coeffs(y0, settings, params):
+    '''
+    Expand an initial condition (or a stack of them as columns) in the
+    eigenvectors of the nondimensional operator
+    '''
+    decomp = spectral_decomp(settings, params)
+    return scipy.linalg.lu_solve(decomp['lu'], asarray(y0, dtype=complex))
+
+
+def _mode_amplitudes(y0, taus, settings, params):
+    # the amplitude of each mode at each time, with any stack axis of y0
+    # between the two
+    decomp = spectral_decomp(settings, params)
+    coeffs = spectral_coeffs(y0, settings, params)
+    return einsum('kt,k...->k...t', exp(outer(decomp['evals'], taus)), coeffs)
+
+
+def spectral_propagate(y0, times, settings, params, physical_times=True):
+    '''
+    Evaluate the solution of the nondimensional equation at arbitrary output
+    times with no time stepping. After the one-time eigendecomposition each
+    output time costs O(L^2)
+
+    y0 : array
+        The initial condition on settings['space'], or an (L, N) stack of
+        them as columns
+
+    times : array
+        The output times, which may be log-spaced or in any order
+
+    settings : dict
+        settings['space'] is used to build the operator
+
+    params : dict
+        The parameter values of the diffusion equation
+
+    physical_times : bool
+        If True, times are in the units of the dimensional equation and are
+        converted with time_nondim. If False they are already rescaled
+
+    RETURNS
+    -------
+
+    sol : array
+        A (space x time) array of solution values, or (space x N x time)
+        for a stack of initial conditions
+    '''
+    decomp = spectral_decomp(settings, params)
+    taus = _output_taus(times, params, physical_times)
+    mode_amps = _mode_amplitudes(y0, taus, settings, params)
+    return real(tensordot(decomp['evecs'], mode_amps, axes=1))
+
+
+def spectral_survival(y0, times, settings, params, physical_times=True):
+    '''
+    The surviving fraction at arbitrary output times. Since the survival
+    weights are projected onto the eigenvectors ahead of time, each output
+    time only costs O(L)
+
+    RETURNS
+    -------
+
+    surv : array
+        The surviving fraction at each of the output times, or an (N x time)
+        array for an (L, N) stack of initial conditions
+    '''
+    decomp = spectral_decomp(settings, params)
+    taus = _output_taus(times, params, physical_times)
+    mode_amps = _mode_amplitudes(y0, taus, settings, params)
+    return real(tensordot(decomp['surv_modes'], mode_amps, axes=1))
+
+
+def relaxation_rates(settings, params, num_rates=5):
+    '''
+    The slowest decay rates of the nondimensional operator, -Re(eigenvalue),
+    in units of the rescaled time. The first one sets the long-time decay of
+    the surviving fraction, surv ~ exp(-rate*time_nondim(t))
+
+    num_rates : int
+        How many of the slowest rates to return
+    '''
+    decomp = spectral_decomp(settings, params)
+    return -decomp['evals'][:num_rates].real
+
+
+def krylov_propagate(y0, times, settings, params, physical_times=True):
+    '''
+    Evaluate the solution of the nondimensional equation at a vector of output
+    times using the action of the matrix exponential on the sparse operator
+    (scipy.sparse.linalg.expm_multiply). Nothing dense is ever built, so this
+    is the propagator to use at large space_pts. Uniformly spaced outputs are
+    produced in a single expm_multiply sweep; otherwise the state is carried
+    from one output time to the next.
+
+    This takes the same arguments as spectral_propagate, so the notebook loop
+    over r.integrate can be replaced by
+
+        sol = krylov_propagate(y0, settings['times'], settings, params, physical_times=False)
+
+    RETURNS
+    -------
+
+    sol : array
+        A (space x time) array of solution values
+    '''
+    jac = radiff_timeop_sparse(0.0, settings, params, nondim=True)
+    taus = _output_taus(times, params, physical_times)
+
+    order = argsort(taus, kind='stable')
+    sorted_taus = taus[order]
+
+    sol = zeros((len(y0), len(taus)))
+    if len(taus) == 0:
+        return sol
+
+    # move to the first output time
+    yvals = expm_multiply(jac*sorted_taus[0], asarray(y0, dtype=double))
+
+    steps = diff(sorted_taus)
+    if len(steps) > 1 and is_uniform(sorted_taus):
+        sorted_sol = expm_multiply(jac, yvals, start=0.0, stop=sorted_taus[-1]-sorted_taus[0],
+                                   num=len(taus), endpoint=True).T
+    else:
+        sorted_sol = zeros((len(y0), len(taus)))
+        sorted_sol[:, 0] = yvals
+        for ind, step in enumerate(steps):
+            yvals = expm_multiply(jac*step, yvals)
+            sorted_sol[:, ind+1] = yvals
+
+    sol[:, order] = sorted_sol
+    return sol
+
+
+def krylov_survival(y0, times, settings, params, physical_times=True):
+    '''
+    The surviving fraction at each output time, computed with krylov_propagate
+    '''
+    sol = krylov_propagate(y0, times, settings, params, physical_times=physical_times)
+    return survival_weights(settings, params).dot(sol)
+
+
+def _build_growth_rate(settings, params):
+    jac = radiff_timeop_sparse(0.0, settings, params, nondim=True)
+    try:
+        evals = eigs(sparse.csc_matrix(jac), k=1, which='LR', return_eigenvectors=False)
+    except ArpackNoConvergence:
+        evals = spectral_decomp(settings, params)['evals'][:1]
+    return float(evals[0].real)
+
+
+def growth_rate(settings, params):
+    '''
+    The largest real part of the eigenvalues of the nondimensional operator,
+    i.e. minus the slowest relaxation rate. Unlike relaxation_rates it does
+    not need the dense eigendecomposition. The survival time only has moments
+    when this is negative, so that the surviving fraction decays to zero
+    '''
+    key = ('growth',) + _nondim_key(settings, params)
+    return cached_operator(key, _build_growth_rate, settings, params)
+
+
+def _check_decay(settings, params):
+    # whether the survival time has moments, with a warning if not
+    rate = growth_rate(settings, params)
+    if rate >= 0:
+        warnings.warn("The operator has a mode growing at rate %g, so the survival time has no "
+                      "moments" % rate, RuntimeWarning)
+    return rate < 0
+
+
+def _build_nondim_lu(settings, params):
+    jac = radiff_timeop_sparse(0.0, settings, params, nondim=True)
+    return splu((-jac).tocsc())
+
+
+def nondim_lu(settings, params):
+    '''
+    Sparse LU factorization of -A, the negated nondimensional operator, kept
+    in the operator cache
+    '''
+    key = ('lu',) + _nondim_key(settings, params)
+    return cached_operator(key, _build_nondim_lu, settings, params)
+
+
+def survival_moments(y0, settings, params, orders=(1, 2), check=True):
+    '''
+    Moments of the survival time in nondimensional units,
+
+        M_n = n * integral( tau^(n-1) S(tau) dtau ) = n! w (-A)^-n y0
+
+    where S is the surviving fraction and w the survival weights. All of the
+    moments come from repeated solves against a single sparse factorization.
+    M_1 is the mean first-passage time. Divide by the initial surviving
+    fraction to normalize. These are only finite when every eigenvalue of A
+    has a negative real part, so that S decays to zero
+
+    orders : list of int
+        Which (positive, integer) moments to return
+
+    check : bool
+        Check with growth_rate that S decays. If it does not, a RuntimeWarning
+        is raised and the moments are nan. With check False the resolvent
+        moments n! w (-A)^-n y0 are returned regardless
+
+    RETURNS
+    -------
+
+    moments : array
+        M_n for each n in orders
+    '''
+    orders = [int(order) for order in orders]
+    if check and not _check_decay(settings, params):
+        return nan*ones(len(orders))
+
+    lu = nondim_lu(settings, params)
+    weights = survival_weights(settings, params)
+
+    powers = dict()
+    yvals = asarray(y0, dtype=double)
+    for order in range(1, amax(orders) + 1):
+        yvals = lu.solve(yvals)
+        powers[order] = weights.dot(yvals)
+
+    return array([scipy.special.factorial(order)*powers[order] for order in orders])
+
+
+def physical_survival_moment(y0, settings, params, order=1):
+    '''
+    A moment of the survival time in the units of the dimensional equation,
+    order * integral( t^(order-1) S(t) dt ). For order = 1 this is the survival
+    time dt*sum(survival) computed in the notebooks.
+
+    Since tau = DCOEFF*t^ALPHA, this is the nondimensional moment of order
+    s = order/ALPHA divided by DCOEFF^s. When s is an integer it comes from
+    survival_moments; otherwise the fractional power of -A is applied through
+    the eigendecomposition. It is nan, with a RuntimeWarning, if the operator
+    has a mode that does not decay (see survival_moments)
+    '''
+    ALPHA = params['ALPHA']
+    DCOEFF = params['DCOEFF']
+    frac_order = order/ALPHA
+
+    if not _check_decay(settings, params):
+        return nan
+    if abs(frac_order - round(frac_order)) < 1e-12:
+        moment = survival_moments(y0, settings, params, orders=[int(round(frac_order))],
+                                  check=False)[0]
+    else:
+        decomp = spectral_decomp(settings, params)
+        amps = decomp['surv_modes']*spectral_coeffs(y0, settings, params)
+        moment = scipy.special.gamma(frac_order + 1)*real(sum(amps*(-decomp['evals'])**(-frac_order)))
+
+    return moment/DCOEFF**frac_order
+
+
+def magnus_exponent(t0, t1, settings, params, order=4):
+    '''
+    The Magnus exponent Omega of the dimensional equation over [t0, t1], so
+    that y(t1) = exp(Omega) y(t0) up to the truncation of the Magnus series.
+    With A(t) = -p(t) S - R and p(t) = ALPHA*DCOEFF*t^(ALPHA-1), the first two
+    terms of the series are
+
+        Omega_1 = -(P(t1) - P(t0)) S - (t1 - t0) R,    P(t) = DCOEFF*t^ALPHA
+        Omega_2 = c [S, R]
+
+    where the scalar c is a double integral of p that is also done in closed
+    form. The singular t^(ALPHA-1) is therefore never evaluated, and t0 = 0
+    is allowed
+
+    order : int
+        2 keeps only Omega_1 (an exponential midpoint-type rule), 4 also adds
+        the commutator term
+    '''
+    spaceop, rxn_rates = radiff_parts(settings, params)
+    DCOEFF = params['DCOEFF']
+    ALPHA = params['ALPHA']
+
+    step = t1 - t0
+    pot0 = DCOEFF*t0**ALPHA
+    pot1 = DCOEFF*t1**ALPHA
+    rxn_op = sparse.diags(rxn_rates)
+
+    omega = -(pot1 - pot0)*spaceop - step*rxn_op
+
+    if order == 4:
+        # (1/2) double integral over s2 < s1 of p(s1) - p(s2)
+        coeff = 0.5*(step*(pot1 + pot0)
+                     - 2*DCOEFF/(ALPHA + 1)*(t1**(ALPHA + 1) - t0**(ALPHA + 1)))
+        omega = omega + coeff*(spaceop.dot(rxn_op) - rxn_op.dot(spaceop))
+    elif order != 2:
+        raise ValueError("Magnus order must be 2 or 4")
+
+    return omega.tocsr()
+
+
+def magnus_step(yvals, t0, t1, settings, params, substeps=1, order=4):
+    '''
+    Advance the dimensional equation from t0 to t1 with Magnus steps. The
+    substeps are spaced uniformly in the rescaled time DCOEFF*t^ALPHA, which
+    puts them close together where the diffusion prefactor changes fastest
+
+    substeps : int
+        The number of Magnus steps between t0 and t1
+    '''
+    ALPHA = params['ALPHA']
+    knots = linspace(t0**ALPHA, t1**ALPHA, substeps + 1)**(1/ALPHA)
+    knots[0] = t0
+    knots[-1] = t1
+    for ind in range(substeps):
+        omega = magnus_exponent(knots[ind], knots[ind+1], settings, params, order=order)
+        yvals = expm_multiply(omega, yvals)
+    return yvals
+
+
+def magnus_propagate(y0, times, settings, params, substeps=1, order=4):
+    '''
+    Solve the dimensional equation from t = 0 with Magnus steps, and return
+    the state at each of the (increasing) output times
+
+    RETURNS
+    -------
+
+    sol : array
+        A (space x time) array of solution values
+    '''
+    times = asarray(times, dtype=double)
+    yvals = asarray(y0, dtype=double)
+    sol = zeros((len(yvals), len(times)))
+    t_last = 0.0
+    for tind, t_next in enumerate(times):
+        if t_next > t_last:
+            yvals = magnus_step(yvals, t_last, t_next, settings, params,
+                                substeps=substeps, order=order)
+        sol[:, tind] = yvals
+        t_last = t_next
+    return sol
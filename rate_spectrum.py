@@ -0,0 +1,154 @@
+'''
+Decomposition of survival curves into spectra of decay rates
+
+A survival curve is fit as a non-negative mixture of exponentials,
+
+    S(t) = sum_k w_k exp(-k t)
+
+over a fixed, logarithmically spaced set of rates k, which is a discretized
+(and regularized) inverse Laplace transform. The weights show which relaxation
+timescales dominate the first-passage process, and how they shift across a
+sweep. Tikhonov regularization, with weight reg, keeps the ill-posed inversion
+stable: the fit minimizes |B w - S|^2 + reg^2 |w|^2 with w >= 0.
+
+The basis B = exp(-outer(times, rates)) and the QR factorization of the
+regularized system depend only on the two grids, so they are built once and
+kept in the operator cache. Every curve then reduces to a small triangular
+problem with one row per rate, and a whole sweep of curves is projected with a
+single matrix product
+
+    out = fit_rate_spectrum(sweep['results'], times)
+    out['weights'], out['timescale']
+
+William Gilpin, 2015
+'''
+
+from numpy import *
+import scipy.linalg
+from scipy.optimize import nnls
+
+from brownian_integrator import *
+
+
+def rate_grid(times, num_rates=50, min_rate=None, max_rate=None):
+    '''
+    Logarithmically spaced decay rates suited to a time grid, by default from
+    a tenth of one over the longest time to ten over the shortest nonzero
+    time. A curve that has barely decayed by the last time needs a smaller
+    min_rate
+    '''
+    times = asarray(times, dtype=double)
+    if min_rate is None:
+        min_rate = .1/amax(times)
+    if max_rate is None:
+        max_rate = 10/amin(times[times > 0])
+    return expspace(min_rate, max_rate, num_rates)
+
+
+def _build_rate_basis(times, rates, reg):
+
+    basis = exp(-outer(times, rates))
+    augmented = vstack((basis, reg*identity(len(rates))))
+    q, r = scipy.linalg.qr(augmented, mode='economic')
+    return basis, q[:len(times)], r
+
+
+def rate_basis(times, rates, reg=1e-3):
+    '''
+    The exponential basis exp(-outer(times, rates)) and the QR factorization of
+    the regularized system, cached per (times, rates, reg)
+
+    RETURNS
+    -------
+
+    basis : array
+        The (T, K) basis
+
+    q : array
+        The first T rows of the orthogonal factor, so that the projection of
+        the curves is q.T.dot(curves)
+
+    r : array
+        The (K, K) upper triangular factor
+    '''
+    times = asarray(times, dtype=double)
+    rates = asarray(rates, dtype=double)
+    key = ('rate_basis', grid_key(times), grid_key(rates), reg)
+    return cached_operator(key, _build_rate_basis, times, rates, reg)
+
+
+def fit_rate_spectrum(curves, times, rates=None, reg=1e-3, nonneg=True):
+    '''
+    Fit one or many survival curves as mixtures of decaying exponentials
+
+    curves : array
+        A curve sampled at times, or an array of them whose last axis is
+        time (such as the (N x time) survival of solve_radiff_batch, or the
+        results of run_sweep)
+
+    times : array
+        The times at which the curves are sampled. Shift them to start at zero
+        to fit the decay relative to the first time
+
+    rates : array
+        The decay rates of the basis. Defaults to rate_grid(times)
+
+    reg : double
+        The Tikhonov regularization weight
+
+    nonneg : bool
+        Constrain the weights to be non-negative, as for a genuine mixture of
+        decays. Otherwise the regularized least-squares weights are found for
+        all curves at once with a single triangular solve
+
+    RETURNS
+    -------
+
+    out : dict
+        out['rates'], the decay rates
+        out['weights'], the weights, with the shape of curves but with the
+        last axis over rates
+        out['fit'], the fitted curves
+        out['residual'], the root-mean-square misfit of each curve
+        out['timescale'], the weighted mean timescale sum(w/k)/sum(w), or nan
+        where the weights sum to zero
+    '''
+    times = asarray(times, dtype=double)
+    if rates is None:
+        rates = rate_grid(times)
+    rates = asarray(rates, dtype=double)
+
+    curves = asarray(curves, dtype=double)
+    shape = curves.shape[:-1]
+    flat = curves.reshape(-1, len(times))
+
+    basis, q, r = rate_basis(times, rates, reg)
+    projected = q.T.dot(flat.T)
+    if nonneg:
+        weights = zeros((len(rates), flat.shape[0]))
+        for ind in range(flat.shape[0]):
+            weights[:, ind] = nnls(r, projected[:, ind])[0]
+    else:
+        weights = scipy.linalg.solve_triangular(r, projected)
+
+    fit = basis.dot(weights).T
+    out = dict()
+    out['rates'] = rates
+    out['weights'] = weights.T.reshape(shape + (len(rates),))
+    out['fit'] = fit.reshape(curves.shape)
+    out['residual'] = sqrt(mean((fit - flat)**2, axis=1)).reshape(shape)
+    # a curve whose weights sum to zero (e.g. one that is zero throughout) has no
+    # timescale
+    total = sum(weights, axis=0)
+    timescale = weights.T.dot(1/rates)/where(total != 0, total, 1.0)
+    out['timescale'] = where(total != 0, timescale, nan).reshape(shape)
+    return out
+
+
+def dominant_rates(out, num_rates=3):
+    '''
+    The rates carrying the largest weights in a fit from fit_rate_spectrum,
+    largest first, with the shape of the curves plus a last axis of num_rates
+    '''
+    order = argsort(-out['weights'], axis=-1)[..., :num_rates]
+    return out['rates'][order]
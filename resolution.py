@@ -0,0 +1,283 @@
+'''
+Automatic choice of grid resolution and solver tolerance
+
+Rather than guessing space_pts and the integrator tolerance by hand, and
+over-resolving everything to be safe, auto_resolution solves one parameter
+point on a sequence of grids, each twice as fine as the last, and estimates
+the error of each by Richardson extrapolation: with the differences between
+three successive solutions it finds the observed order of convergence, and
+from that the remaining error. It stops at the first grid whose estimated
+error in the survival curve and the mean first-passage time meets the target,
+then loosens the integrator tolerance as far as the target allows.
+
+    out = auto_resolution(params, settings, target=1e-3)
+    out['space_pts'], out['rtol'], out['survival'], out['error']
+
+For sweeps, auto_survival_point picks the resolution separately at every
+point, so that only the hard points pay for fine grids:
+
+    run_sweep(params, [('KAPPA', kappas)], settings, point_fn=auto_survival_point,
+              target=1e-3)
+
+William Gilpin, 2015
+'''
+
+from numpy import *
+from time import perf_counter
+
+from brownian_integrator import *
+from rxndiff_solver import *
+from propagators import physical_survival_moment
+
+
+QUANTITIES = ('survival', 'mfpt')
+
+
+def fixed_grid(params, space_pts, stencil=None, inner_factor=.1, length_factor=10):
+    '''
+    space_pts points from inner_factor*POT_DIAM out to length_factor*POT_DIAM,
+    evenly spaced or, for the 'chebyshev' stencil, at the Chebyshev points.
+    Unlike scaled_grid, whose first point is one step from the origin, the
+    ends stay put as the grid is refined, as the Richardson estimates need
+    '''
+    first = inner_factor*params['POT_DIAM']
+    last = length_factor*params['POT_DIAM']
+    if stencil == 'chebyshev':
+        return chebyshev_grid(first, last, space_pts)
+    return linspace(first, last, space_pts)
+
+
+def richardson(coarse, medium, fine, ratio=2.0, max_order=8.0):
+    '''
+    Richardson extrapolation from a quantity computed on three grids, each
+    ratio times finer than the last. The order of convergence is found from
+    the largest differences between the three, and is capped at max_order
+    (e.g. the formal order of the stencil) so that a chance near-agreement
+    does not give a wildly optimistic estimate
+
+    RETURNS
+    -------
+
+    order : double
+        The observed order of convergence, or nan if the values are not
+        converging
+
+    medium_error, fine_error : double
+        The estimated largest errors of the medium and fine values (inf if
+        they are not converging)
+
+    extrapolated : array
+        The extrapolated value
+    '''
+    coarse_diff = amax(abs(asarray(medium) - asarray(coarse)))
+    fine_diff = amax(abs(asarray(fine) - asarray(medium)))
+
+    if fine_diff == 0:
+        return max_order, 0.0, 0.0, asarray(fine)
+    order = log(coarse_diff/fine_diff)/log(ratio)
+    if not order > 0:
+        return nan, inf, inf, asarray(fine)
+
+    gain = ratio**minimum(order, max_order)
+    fine_error = fine_diff/(gain - 1)
+    medium_error = gain*fine_error
+    extrapolated = asarray(fine) + (asarray(fine) - asarray(medium))/(gain - 1)
+    return order, medium_error, fine_error, extrapolated
+
+
+def _solve_level(params, settings, space_pts, quantities, refine_grid, y0_fn, **solve_kwargs):
+    '''
+    The quantities on one grid. The survival curve is normalized by the
+    initial surviving fraction, so that its errors are fractions, and the
+    mean first-passage time is in the units of the dimensional equation
+    '''
+    level_settings = settings.copy()
+    level_settings['space'] = refine_grid(params, space_pts)
+    allspace = level_settings['space']
+    if y0_fn is None:
+        y0 = ones(len(allspace))
+    else:
+        y0 = y0_fn(allspace)
+    mass = survival_weights(level_settings, params).dot(y0)
+
+    level = dict(space_pts=space_pts, rtol=solve_kwargs.get('rtol'))
+    start = perf_counter()
+    if 'survival' in quantities:
+        out = solve_radiff(y0, level_settings, params, reducers=[Survival()], **solve_kwargs)
+        # a run that stops early does not reach the later output times
+        surv = nan*ones(len(settings['times']))
+        surv[:len(out['survival'])] = out['survival']/mass
+        level['survival'] = surv
+    if 'mfpt' in quantities:
+        level['mfpt'] = physical_survival_moment(y0, level_settings, params, order=1)/mass
+    level['wall_time'] = perf_counter() - start
+    level['space'] = allspace
+    return level
+
+
+def _level_errors(levels, quantities, max_order):
+    '''
+    The estimated (relative, for the mean first-passage time) errors of the
+    last two levels, and the observed orders, from the last three
+    '''
+    medium_error, fine_error = 0.0, 0.0
+    orders = dict()
+    for name in quantities:
+        vals = [level[name] for level in levels[-3:]]
+        order, med_err, fine_err, _ = richardson(*vals, max_order=max_order)
+        if name == 'mfpt':
+            med_err, fine_err = med_err/abs(vals[-1]), fine_err/abs(vals[-1])
+        orders[name] = order
+        medium_error = maximum(medium_error, med_err)
+        fine_error = maximum(fine_error, fine_err)
+    return medium_error, fine_error, orders
+
+
+def auto_resolution(params, settings, target=1e-3, quantities=QUANTITIES, refine_grid=None,
+                    start_pts=25, max_pts=3200, y0_fn=None, tol_factors=(1., .1), safety=.1,
+                    **solve_kwargs):
+    '''
+    Find the cheapest grid and integrator tolerance with which the survival
+    curve and mean first-passage time of one parameter point meet an error
+    target, and return the solution there
+
+    params : dict
+        The parameter point
+
+    settings : dict
+        settings['times'] are the output times of the survival curve, and
+        settings['stencil'], if present, picks the spatial stencil. The grid
+        in settings['space'] is not used
+
+    target : double
+        The largest acceptable error: absolute for the survival curve, which
+        is a fraction, and relative for the mean first-passage time
+
+    quantities : tuple
+        Which of 'survival' and 'mfpt' must meet the target. The mean
+        first-passage time comes from a linear solve, so it depends only on
+        the grid. It is nan, with a RuntimeWarning, on a grid whose operator
+        has a growing mode (see propagators.growth_rate), and then the
+        result is not converged
+
+    refine_grid : function
+        refine_grid(params, space_pts) gives the grid with space_pts points.
+        Defaults to fixed_grid. The grids should all span the same interval
+
+    start_pts, max_pts : int
+        The first grid size, which is doubled until the target is met or
+        max_pts is passed
+
+    y0_fn : function
+        y0_fn(space) gives the initial condition. Defaults to the flat one
+
+    tol_factors : tuple
+        The integrator tolerances tried once the grid is fixed, as multiples
+        of target, loosest first. The grids are compared at rtol =
+        safety*target, and the loosest of these that still meets the target
+        is kept
+
+    solve_kwargs :
+        Passed on to solve_radiff (e.g. method)
+
+    RETURNS
+    -------
+
+    out : dict
+        out['converged'], whether the target was met. If not, the finest
+        solution is returned
+        out['space_pts'], out['space'] and out['rtol'], the configuration
+        out['survival'] and/or out['mfpt'], the solution with it
+        out['error'], the estimated error of the solution
+        out['order'], the observed orders of convergence
+        out['levels'], the size, tolerance and wall time of every solve
+    '''
+    quantities = [name for name in QUANTITIES if name in quantities]
+    stencil = settings.get('stencil')
+    if refine_grid is None:
+        def refine_grid(point, space_pts):
+            return fixed_grid(point, space_pts, stencil)
+    # the error estimates trust no more than the formal order of the stencil
+    max_order = minimum(STENCIL_ORDER[stencil or default_stencil(refine_grid(params, start_pts))], 8)
+    solve_kwargs = dict(solve_kwargs)
+    solve_kwargs['rtol'] = safety*target
+
+    levels = list()
+    chosen, error, orders = None, inf, dict()
+    space_pts = start_pts
+    while space_pts <= max_pts:
+        levels.append(_solve_level(params, settings, space_pts, quantities, refine_grid, y0_fn,
+                                   **solve_kwargs))
+        if not all([all(isfinite(levels[-1][name])) for name in quantities]):
+            # the solution has blown up, or the operator has a growing mode
+            # so that there is no first-passage time, and finer grids will
+            # not help
+            break
+        if len(levels) >= 3:
+            medium_error, fine_error, orders = _level_errors(levels, quantities, max_order)
+            if medium_error <= target:
+                chosen, error = len(levels) - 2, medium_error
+                break
+            elif fine_error <= target:
+                chosen, error = len(levels) - 1, fine_error
+                break
+        space_pts *= 2
+
+    converged = chosen is not None
+    if not converged:
+        finite = [ind for ind, level in enumerate(levels)
+                  if all([all(isfinite(level[name])) for name in quantities])]
+        chosen = finite[-1] if finite else len(levels) - 1
+    best = levels[chosen]
+
+    # loosen the integrator tolerance as far as the remaining error allows
+    if converged and 'survival' in quantities:
+        for factor in tol_factors:
+            loose_kwargs = dict(solve_kwargs)
+            loose_kwargs['rtol'] = factor*target
+            if loose_kwargs['rtol'] <= best['rtol']:
+                break
+            trial = _solve_level(params, settings, best['space_pts'], ['survival'], refine_grid,
+                                 y0_fn, **loose_kwargs)
+            levels.append(trial)
+            tol_error = amax(abs(trial['survival'] - best['survival']))
+            if error + tol_error <= target:
+                trial['mfpt'] = best.get('mfpt')
+                best, error = trial, error + tol_error
+                break
+
+    out = dict()
+    out['converged'] = converged
+    out['space_pts'] = best['space_pts']
+    out['space'] = best['space']
+    out['rtol'] = best['rtol']
+    for name in quantities:
+        out[name] = best[name]
+    out['error'] = error
+    out['order'] = orders
+    out['levels'] = [dict(space_pts=level['space_pts'], rtol=level['rtol'],
+                          wall_time=level['wall_time']) for level in levels]
+    return out
+
+
+def auto_survival_point(params, settings, target=1e-3, **kwargs):
+    '''
+    A point function for run_sweep and run_points that picks its own
+    resolution with auto_resolution, and returns the survival curve at
+    settings['times'] (normalized by the initial surviving fraction)
+    '''
+    out = auto_resolution(params, settings, target=target, quantities=('survival',), **kwargs)
+    return out['survival']
+
+
+def auto_mfpt_point(params, settings, target=1e-3, **kwargs):
+    '''
+    A point function for run_sweep and run_points that picks its own
+    resolution with auto_resolution, and returns the mean first-passage time
+    and the number of grid points used. The time is nan where the target was
+    not met, rather than the finest unconverged value
+    '''
+    out = auto_resolution(params, settings, target=target, quantities=('mfpt',), **kwargs)
+    if not out['converged']:
+        return array([nan, out['space_pts']])
+    return array([out['mfpt'], out['space_pts']])
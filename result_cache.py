@@ -0,0 +1,335 @@
+'''
+Content-addressed cache of solver results
+
+The same parameter points get solved again and again, across notebook
+sessions and across sweeps that overlap (e.g. repeated well_diams scans). The
+functions here wrap solve_radiff and the sweeps so that each result is stored
+on disk under a hash of everything that determines it:
+
+    params, settings['space'], settings['times'] and settings['stencil'],
+    the initial condition, the solver options and reducers, the source of
+    every module in this directory, and the source of any functions or
+    classes passed in (point_fn, grid_fn, reducers, stopping events)
+
+so a change to any of them (including an edit to the operators) gives a new
+key. Code outside this directory that those functions call, and the installed
+numpy and scipy, are not part of the key, so after changing them the cache
+should be cleared. The cache is a directory of .npz files, bounded in size by
+evicting the least recently used entries.
+
+    cache = ResultCache('result_cache')
+    out = cached_sweep(params, axes, settings, cache, grid_fn=scaled_grid)
+    cache.stats()
+
+William Gilpin, 2015
+'''
+
+from numpy import *
+import os
+import glob
+import builtins
+import hashlib
+import inspect
+
+from brownian_integrator import *
+from rxndiff_solver import *
+from sweeps import *
+
+
+_code_version = None
+
+
+def code_files():
+    '''
+    The modules whose source goes into every key: all of the Python files next
+    to this one, since a point function may reach any of them
+    '''
+    here = os.path.dirname(os.path.abspath(__file__))
+    return sorted(glob.glob(os.path.join(here, '*.py')))
+
+
+def code_version():
+    '''
+    A hash of the source of the solver modules
+    '''
+    global _code_version
+    if _code_version is None:
+        digest = hashlib.sha256()
+        for fname in code_files():
+            digest.update(os.path.basename(fname).encode())
+            with open(fname, 'rb') as f:
+                digest.update(f.read())
+        _code_version = digest.hexdigest()
+    return _code_version
+
+
+def _source(obj):
+    # the source of a function or class, where it can be found
+    try:
+        return inspect.getsource(obj)
+    except (OSError, TypeError):
+        return ''
+
+
+def _hash_update(digest, obj):
+    '''
+    Feed a description of obj into a hashlib digest. Handles nested dicts,
+    lists, arrays, numbers (python and numpy scalars of equal value hash
+    alike), strings, functions, and objects such as reducers
+    and stopping events, which are described by their class and the
+    attributes named like their constructor arguments (so that state left
+    over from an earlier run does not change the key). Functions and classes
+    are hashed with their source, so editing them gives a new key
+    '''
+    if isinstance(obj, dict):
+        digest.update(b'dict')
+        for key in sorted(obj, key=str):
+            _hash_update(digest, str(key))
+            _hash_update(digest, obj[key])
+    elif isinstance(obj, (list, tuple)):
+        digest.update(b'list' + str(len(obj)).encode())
+        for val in obj:
+            _hash_update(digest, val)
+    elif isinstance(obj, ndarray):
+        obj = ascontiguousarray(obj)
+        digest.update(b'array' + str(obj.dtype).encode() + str(obj.shape).encode())
+        digest.update(obj.tobytes())
+    elif isinstance(obj, (builtins.bool, bool_)):
+        # (numpy's bool, from the star import, is not the builtin)
+        digest.update(b'bool' + str(builtins.bool(obj)).encode())
+    elif isinstance(obj, (int, integer)):
+        # python and numpy scalars of the same value share a key
+        digest.update(b'int' + str(int(obj)).encode())
+    elif isinstance(obj, (float, floating)):
+        digest.update(b'float' + repr(float(obj)).encode())
+    elif isinstance(obj, (complex, complexfloating)):
+        digest.update(b'complex' + repr(complex(obj)).encode())
+    elif isinstance(obj, (str, str_)):
+        digest.update(b'str' + str(obj).encode())
+    elif isinstance(obj, generic) or obj is None:
+        digest.update(type(obj).__name__.encode() + repr(obj).encode())
+    elif callable(obj) and hasattr(obj, '__qualname__'):
+        digest.update(b'func' + obj.__module__.encode() + obj.__qualname__.encode())
+        digest.update(_source(obj).encode())
+    else:
+        digest.update(b'obj' + type(obj).__name__.encode())
+        digest.update(_source(type(obj)).encode())
+        config = inspect.signature(type(obj).__init__).parameters
+        _hash_update(digest, dict((name, val) for name, val in vars(obj).items() if name in config))
+
+
+def cache_key(*parts):
+    '''
+    The cache key of a computation described by parts (params, settings, ...),
+    which always includes the code version
+    '''
+    digest = hashlib.sha256()
+    _hash_update(digest, code_version())
+    for part in parts:
+        _hash_update(digest, part)
+    return digest.hexdigest()
+
+
+class ResultCache(object):
+    '''
+    A directory of cached results, with least recently used eviction
+
+    directory : str
+        Where the entries are kept. It is created if needed
+
+    max_bytes : int
+        When the entries take up more than this, the least recently used ones
+        are removed
+
+    The hit, miss and eviction counts cover this session only
+    '''
+
+    def __init__(self, directory='result_cache', max_bytes=2**30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _file(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def get(self, key):
+        '''
+        The stored dict of arrays for key, or None
+        '''
+        fname = self._file(key)
+        try:
+            with load(fname) as saved:
+                entry = dict((name, saved[name]) for name in saved.files)
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            return None
+        # mark as recently used
+        os.utime(fname, None)
+        self.hits += 1
+        return entry
+
+    def put(self, key, entry):
+        '''
+        Store a dict of arrays under key, then evict down to max_bytes
+        '''
+        tmpfile = self._file(key) + '.tmp.npz'
+        savez(tmpfile, **entry)
+        os.replace(tmpfile, self._file(key))
+        self.evict()
+
+    def _entries(self):
+        entries = list()
+        for fname in glob.glob(os.path.join(self.directory, '*.npz')):
+            if fname.endswith('.tmp.npz'):
+                continue
+            try:
+                stat = os.stat(fname)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, fname))
+        return sorted(entries)
+
+    def evict(self):
+        entries = self._entries()
+        total = sum([size for _, size, _ in entries])
+        for _, size, fname in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(fname)
+            except OSError:
+                continue
+            total -= size
+            self.evictions += 1
+
+    def clear(self):
+        for _, _, fname in self._entries():
+            os.remove(fname)
+
+    def stats(self):
+        '''
+        Hit and miss counts, and the number and total size of stored entries
+        '''
+        entries = self._entries()
+        out = dict()
+        out['hits'] = self.hits
+        out['misses'] = self.misses
+        out['evictions'] = self.evictions
+        out['entries'] = len(entries)
+        out['bytes'] = sum([size for _, size, _ in entries])
+        return out
+
+
+def _pack_output(out):
+    # None if an output is not made of numbers (such as the ResultStore of a
+    # StoreWriter), since it could only be stored pickled
+    entry = dict()
+    for name, val in out.items():
+        if name == 'stats':
+            # timings belong to the run, not to the result
+            continue
+        if isinstance(val, tuple):
+            for ind, part in enumerate(val):
+                entry[name + '.' + str(ind)] = asarray(part)
+        elif val is not None:
+            entry[name] = asarray(val)
+    if any([val.dtype == object for val in entry.values()]):
+        return None
+    return entry
+
+
+def _unpack_output(entry):
+    out = dict()
+    parts = dict()
+    for name, val in entry.items():
+        if val.ndim == 0:
+            val = val.item()
+        if '.' in name:
+            base, ind = name.rsplit('.', 1)
+            parts.setdefault(base, dict())[int(ind)] = val
+        else:
+            out[name] = val
+    for base, vals in parts.items():
+        out[base] = tuple(vals[ind] for ind in sorted(vals))
+    if 'y_stop' not in out:
+        out['y_stop'] = None
+    return out
+
+
+def cached_solve(y0, settings, params, cache, reducers=None, **solve_kwargs):
+    '''
+    solve_radiff, with the output served from the cache when the same solve
+    has been run before. Runs ended by a WallTime event depend on the machine,
+    so they are not stored, and nor are runs with outputs that are not
+    arrays, such as the ResultStore of a StoreWriter (whose writes would not
+    be repeated by a cache hit anyway). Nor is out['stats'], so a result
+    served from the cache has no instrumentation summary
+
+    cache : ResultCache
+        Where to look up and store the result
+
+    reducers, solve_kwargs :
+        As for solve_radiff, and part of the key
+    '''
+    if reducers is None:
+        reducers = [FullSolution()]
+    key = cache_key('solve_radiff', asarray(y0, dtype=double), params,
+                    asarray(settings['space']), asarray(settings['times']),
+                    settings.get('stencil'), reducers, solve_kwargs)
+
+    entry = cache.get(key)
+    if entry is not None:
+        return _unpack_output(entry)
+
+    out = solve_radiff(y0, settings, params, reducers=reducers, **solve_kwargs)
+    stoppers = solve_kwargs.get('stop_when') or list()
+    entry = _pack_output(out)
+    if entry is not None and not any([isinstance(stopper, WallTime) for stopper in stoppers]):
+        cache.put(key, entry)
+    return out
+
+
+def cached_sweep(params, axes, settings, cache, point_fn=survival_point, grid_fn=None,
+                 processes=None, **solve_kwargs):
+    '''
+    run_sweep, where each point is looked up in the cache first and only the
+    points that are missing are solved. A repeated sweep returns at once, and
+    an extended or shifted sweep only solves its new points
+
+    cache : ResultCache
+        Where to look up and store the point results
+
+    The other arguments are as for run_sweep
+    '''
+    all_params = param_grid(params, axes)
+    shape = tuple(len(values) for _, values in axes)
+
+    keys = list()
+    found = dict()
+    for ind, point in enumerate(all_params):
+        space = settings['space'] if grid_fn is None else grid_fn(point)
+        key = cache_key('sweep_point', point, asarray(space), asarray(settings['times']),
+                        settings.get('stencil'), point_fn, solve_kwargs)
+        keys.append(key)
+        entry = cache.get(key)
+        if entry is not None:
+            found[ind] = entry['result']
+
+    missing = [ind for ind in range(len(all_params)) if ind not in found]
+    if len(missing) > 0:
+        new_results = run_points([all_params[ind] for ind in missing], settings, point_fn=point_fn,
+                                 grid_fn=grid_fn, processes=processes, **solve_kwargs)
+        for ind, res in zip(missing, new_results):
+            cache.put(keys[ind], dict(result=res))
+            found[ind] = res
+
+    results = array([found[ind] for ind in range(len(all_params))])
+
+    out = dict()
+    out['axes'] = axes
+    out['results'] = results.reshape(shape + results.shape[1:])
+    return out
@@ -0,0 +1,334 @@
+'''
+On-disk storage of full reaction-diffusion solutions
+
+A full (space x time) solution from a long run can be larger than memory, and
+if it is only collected in RAM a crash near the end of the run loses all of it.
+A ResultStore is a directory holding
+
+    header.json     -- params, the solver options, the shard layout, and the
+                       number of time points that have been safely written
+    space.npy       -- settings['space']
+    times.npy       -- the output times
+    sol_00000.npy   -- the solution, split into shards of shard_size time
+    sol_00001.npy      points each, stored time-major so that each new state
+    ...                is one contiguous write into a memory-mapped file
+
+The StoreWriter reducer streams states into the shards as solve_radiff reaches
+them, and periodically checkpoints: the shards are flushed and then the header
+is atomically replaced. The stored state at the last checkpoint is everything
+the (linear) equation needs to continue, so resume_solve picks an interrupted
+run up from there. Analyses read slices lazily, one shard at a time.
+
+    out = solve_to_store('run1', y0, settings, params)
+    store = open_store('run1')
+    fht = store.fht()               # same as make_fht(times, sol)
+    late = store.read(tinds=slice(-100, None))
+
+William Gilpin, 2015
+'''
+
+from numpy import *
+import os
+import json
+from numpy.lib.format import open_memmap
+
+from brownian_integrator import *
+from rxndiff_solver import *
+
+
+STORE_VERSION = 1
+
+
+def _jsonable(vals):
+    '''
+    Convert numpy scalars and arrays in a dict to plain Python types, and
+    drop entries that cannot be written to JSON
+    '''
+    out = dict()
+    for key, val in vals.items():
+        if isinstance(val, ndarray):
+            val = val.tolist()
+        elif isinstance(val, generic):
+            val = val.item()
+        try:
+            json.dumps(val)
+        except TypeError:
+            continue
+        out[key] = val
+    return out
+
+
+class ResultStore(object):
+    '''
+    A solution stored on disk in memory-mapped shards. Use create_store or
+    open_store rather than calling this directly
+    '''
+
+    def __init__(self, path, mode='r'):
+        self.path = path
+        self.mode = mode
+        with open(os.path.join(path, 'header.json')) as f:
+            self.header = json.load(f)
+        if self.header['version'] != STORE_VERSION:
+            raise ValueError("Unsupported result store version in " + path)
+        self.space = load(os.path.join(path, 'space.npy'))
+        self.times = load(os.path.join(path, 'times.npy'))
+        self.params = self.header['params']
+        self.shard_size = self.header['shard_size']
+        self.nsaved = self.header['nsaved']
+        self._shards = dict()
+
+    def settings(self):
+        '''
+        The settings dict of the run, with 'space' and 'times'
+        '''
+        settings = dict(self.header['settings'])
+        settings['space'] = self.space
+        settings['times'] = self.times
+        return settings
+
+    def _shard_file(self, ind):
+        return os.path.join(self.path, 'sol_%05d.npy' % ind)
+
+    def _shard(self, ind):
+        if ind not in self._shards:
+            fname = self._shard_file(ind)
+            if os.path.exists(fname):
+                self._shards[ind] = load(fname, mmap_mode=('r' if self.mode == 'r' else 'r+'))
+            elif self.mode == 'r':
+                raise IOError("Missing shard " + fname)
+            else:
+                self._shards[ind] = open_memmap(fname, mode='w+', dtype=double,
+                                                shape=(self.shard_size, len(self.space)))
+        return self._shards[ind]
+
+    def write(self, tind, yvals):
+        '''
+        Store the state at output time index tind. It only counts as saved
+        once checkpoint is called
+        '''
+        if self.mode == 'r':
+            raise IOError("Result store " + self.path + " was opened read-only")
+        shard = self._shard(tind//self.shard_size)
+        shard[tind % self.shard_size] = yvals
+        self._last_written = tind
+
+    def checkpoint(self, nsaved=None):
+        '''
+        Flush the shards to disk, then record nsaved (by default, every state
+        written so far) in the header
+        '''
+        if nsaved is None:
+            nsaved = getattr(self, '_last_written', self.nsaved - 1) + 1
+        for shard in self._shards.values():
+            shard.flush()
+        self.nsaved = int(nsaved)
+        self.header['nsaved'] = self.nsaved
+        self.header['t_checkpoint'] = float(self.times[self.nsaved - 1]) if self.nsaved else None
+        _write_header(self.path, self.header)
+
+    def column(self, tind):
+        '''
+        The saved state at output time index tind, as a copy
+        '''
+        if not 0 <= tind < self.nsaved:
+            raise IndexError("Time index " + str(tind) + " has not been saved")
+        return array(self._shard(tind//self.shard_size)[tind % self.shard_size])
+
+    def read(self, tinds=slice(None), sinds=slice(None)):
+        '''
+        Read part of the saved solution, touching only the shards that are needed
+
+        tinds : slice or array
+            Output time indices, among the saved ones
+
+        sinds : slice or array
+            Grid point indices
+
+        RETURNS
+        -------
+
+        sol : array
+            A (space x time) array, as returned by solve_radiff
+        '''
+        tinds = arange(self.nsaved)[tinds]
+        npts = len(arange(len(self.space))[sinds])
+        sol = zeros((npts, len(tinds)))
+        shard_inds = tinds//self.shard_size
+        for ind in unique(shard_inds):
+            cols = where(shard_inds == ind)[0]
+            rows = tinds[cols] % self.shard_size
+            sol[:, cols] = self._shard(ind)[rows][:, sinds].T
+        return sol
+
+    def project(self, weights):
+        '''
+        weights.dot(yvals) at every saved time, computed one shard at a time
+        '''
+        out = zeros(self.nsaved)
+        for start in range(0, self.nsaved, self.shard_size):
+            stop = int(minimum(start + self.shard_size, self.nsaved))
+            out[start:stop] = self._shard(start//self.shard_size)[:stop - start].dot(weights)
+        return out
+
+    def survival(self):
+        '''
+        The surviving fraction at every saved time, as from the Survival reducer
+        '''
+        return self.project(survival_weights(self.settings(), self.params))
+
+    def fht(self):
+        '''
+        The first-passage histogram of make_fht(times, sol), without loading sol
+        '''
+        return -diff(self.project(ones(len(self.space))))
+
+    def close(self):
+        for shard in self._shards.values():
+            if self.mode != 'r':
+                shard.flush()
+        self._shards = dict()
+
+
+def _write_header(path, header):
+    tmpfile = os.path.join(path, 'header.json.tmp')
+    with open(tmpfile, 'w') as f:
+        json.dump(header, f, indent=1)
+    os.replace(tmpfile, os.path.join(path, 'header.json'))
+
+
+def create_store(path, settings, params, times=None, shard_size=1024, solver_options=None):
+    '''
+    Create an empty result store in the directory path (which may already
+    exist, but must not already hold a store)
+
+    times : array
+        The output times. Defaults to settings['times']
+
+    shard_size : int
+        The number of time points per shard file
+
+    solver_options : dict
+        The keyword arguments of solve_radiff, kept so that resume_solve can
+        continue with the same integrator
+    '''
+    if os.path.exists(os.path.join(path, 'header.json')):
+        raise IOError("A result store already exists in " + path)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    if times is None:
+        times = settings['times']
+    if solver_options is None:
+        solver_options = dict()
+
+    save(os.path.join(path, 'space.npy'), asarray(settings['space'], dtype=double))
+    save(os.path.join(path, 'times.npy'), asarray(times, dtype=double))
+
+    header = dict()
+    header['version'] = STORE_VERSION
+    header['params'] = _jsonable(params)
+    header['settings'] = _jsonable(dict((key, val) for key, val in settings.items()
+                                        if key not in ('space', 'times')))
+    header['solver'] = _jsonable(solver_options)
+    header['shard_size'] = int(shard_size)
+    header['nsaved'] = 0
+    header['t_checkpoint'] = None
+    _write_header(path, header)
+
+    return ResultStore(path, mode='r+')
+
+
+def open_store(path, mode='r'):
+    '''
+    Open an existing result store, read-only by default ('r+' to append)
+    '''
+    return ResultStore(path, mode=mode)
+
+
+class StoreWriter(object):
+    '''
+    A reducer that streams every output state into a ResultStore and
+    checkpoints every checkpoint_every states
+
+    offset : int
+        The store index of the first output time of this run, for resumed runs
+    '''
+    name = 'store'
+
+    def __init__(self, store, offset=0, checkpoint_every=64):
+        self.store = store
+        self.offset = offset
+        self.checkpoint_every = checkpoint_every
+
+    def start(self, times, settings, params):
+        self.nwritten = 0
+
+    def update(self, tind, time, yvals):
+        self.store.write(self.offset + tind, yvals)
+        self.nwritten += 1
+        if self.nwritten % self.checkpoint_every == 0:
+            self.store.checkpoint()
+
+    def result(self):
+        self.store.checkpoint()
+        return self.store
+
+
+def solve_to_store(path, y0, settings, params, shard_size=1024, checkpoint_every=64,
+                   reducers=None, **solve_kwargs):
+    '''
+    Run solve_radiff with the full solution written to a result store in path
+    rather than kept in memory
+
+    reducers : list
+        Other reducers to run alongside, e.g. [Survival()]
+
+    solve_kwargs :
+        Passed on to solve_radiff, and recorded in the store for resume_solve
+
+    RETURNS
+    -------
+
+    out : dict
+        The output of solve_radiff, with the store in out['store']
+    '''
+    times = solve_kwargs.pop('output_times', None)
+    if times is None:
+        times = settings['times']
+    store = create_store(path, settings, params, times=times, shard_size=shard_size,
+                         solver_options=solve_kwargs)
+    if reducers is None:
+        reducers = list()
+    writer = StoreWriter(store, checkpoint_every=checkpoint_every)
+    return solve_radiff(y0, settings, params, output_times=times,
+                        reducers=[writer] + list(reducers), **solve_kwargs)
+
+
+def resume_solve(path, checkpoint_every=64, reducers=None, **solve_kwargs):
+    '''
+    Continue an interrupted solve_to_store run from its last checkpoint. The
+    integrator is restarted from the stored state, with the solver options
+    saved in the store (overridden by solve_kwargs)
+
+    RETURNS
+    -------
+
+    out : dict
+        The output of solve_radiff for the remaining output times, with the
+        store in out['store'], or None if the run had already finished
+    '''
+    store = open_store(path, mode='r+')
+    nstart = store.nsaved - 1
+    if nstart < 0:
+        raise ValueError("Result store " + path + " has no checkpoint to resume from")
+    if store.nsaved == len(store.times):
+        return None
+
+    options = dict(store.header['solver'])
+    options.update(solve_kwargs)
+    if reducers is None:
+        reducers = list()
+    writer = StoreWriter(store, offset=nstart, checkpoint_every=checkpoint_every)
+    return solve_radiff(store.column(nstart), store.settings(), store.params,
+                        output_times=store.times[nstart:], reducers=[writer] + list(reducers),
+                        **options)
@@ -0,0 +1,142 @@
+'''
+Allocation-free right hand side kernels for the reaction-diffusion equation
+
+Every term of the operator (the Laplacian, the drift, the potential and the
+reaction) lives on the same narrow band around the diagonal, so the whole right
+hand side can be evaluated in a single fused pass over the grid, written into a
+preallocated output buffer. With Numba installed the pass is compiled;
+otherwise a pure NumPy version that works on views of the same buffers is used.
+
+    kernel = make_rhs_kernel(settings, params)
+    kernel['rhs'](t, yvals, out)     # out[:] = f(t, yvals)
+    kernel['jvp'](t, vvals, out)     # out[:] = J(t) vvals
+
+William Gilpin, 2015
+'''
+
+from numpy import *
+
+from brownian_integrator import *
+
+# attempt to import numba, if it is not present the NumPy kernels are used
+no_numba_module = False
+try:
+    from numba import njit
+except ImportError:
+    print ("No numba installed, using NumPy right hand side kernels")
+    no_numba_module = True
+
+
+def band_rows(op, lband, uband):
+    '''
+    Row-oriented band storage of a sparse matrix, coeffs[i, k] = op[i, i + k - lband],
+    with zeros where the band runs off the edge of the grid
+    '''
+    coo = op.tocoo()
+    coeffs = zeros((op.shape[0], lband + uband + 1))
+    coeffs[coo.row, coo.col - coo.row + lband] = coo.data
+    return coeffs
+
+
+def _band_apply_numpy(coeffs, lband, scale, rates, yvals, out, work):
+    L = len(yvals)
+    multiply(rates, yvals, out=out)
+    negative(out, out=out)
+    for k in range(coeffs.shape[1]):
+        shift = k - lband
+        lo = int(maximum(0, -shift))
+        hi = L - int(maximum(0, shift))
+        # out[lo:hi] -= scale*coeffs[lo:hi, k]*yvals[lo+shift:hi+shift], on views
+        tmp = work[lo:hi]
+        multiply(coeffs[lo:hi, k], yvals[lo+shift:hi+shift], out=tmp)
+        tmp *= scale
+        seg = out[lo:hi]
+        seg -= tmp
+    return out
+
+
+def _band_apply_compiled(coeffs, lband, scale, rates, yvals, out, work):
+    L = yvals.shape[0]
+    width = coeffs.shape[1]
+    for i in range(L):
+        acc = 0.0
+        for k in range(width):
+            j = i + k - lband
+            if j >= 0 and j < L:
+                acc += coeffs[i, k]*yvals[j]
+        out[i] = -scale*acc - rates[i]*yvals[i]
+    return out
+
+
+if not no_numba_module:
+    _band_apply_compiled = njit(cache=True, fastmath=False)(_band_apply_compiled)
+
+
+def make_rhs_kernel(settings, params, nondim=False, backend='auto'):
+    '''
+    Build in-place right hand side and jacobian-vector kernels from the cached
+    operator pieces. Each call costs O(L) and allocates nothing
+
+    settings : dict
+        settings['space'] is used to build the operator
+
+    params : dict
+        The parameter values of the diffusion equation
+
+    nondim : bool
+        Use the nondimensional operator of radiff_timeop_nondim
+
+    backend : str
+        'numba', 'numpy', or 'auto' to use Numba whenever it is installed
+
+    RETURNS
+    -------
+
+    kernel : dict
+        kernel['rhs'](t, yvals, out), the time derivative written into out
+        kernel['jvp'](t, vvals, out), the jacobian at t applied to vvals.
+        The equation is linear, so this is the same pass as the right hand side
+        kernel['ode_rhs'](t, yvals), the right hand side written into an
+        internal buffer and returned. scipy's ode class copies the result, so
+        this is safe to use there, but not with solvers that keep a reference
+        kernel['backend'], the backend in use
+    '''
+    if backend == 'auto':
+        backend = 'numpy' if no_numba_module else 'numba'
+    if backend == 'numba' and no_numba_module:
+        raise ValueError("The numba backend needs numba to be installed")
+    if backend not in ('numba', 'numpy'):
+        raise ValueError("Unknown kernel backend: " + str(backend))
+
+    spaceop, rxn_rates = radiff_parts(settings, params, nondim=nondim)
+    coo = spaceop.tocoo()
+    lband = int(maximum(0, amax(coo.row - coo.col)))
+    uband = int(maximum(0, amax(coo.col - coo.row)))
+    coeffs = ascontiguousarray(band_rows(spaceop, lband, uband))
+    rates = ascontiguousarray(rxn_rates, dtype=double)
+
+    if backend == 'numba':
+        band_apply = _band_apply_compiled
+    else:
+        band_apply = _band_apply_numpy
+
+    def scale_at(t):
+        if nondim:
+            return 1.0
+        return diffusion_prefactor(t, params)
+
+    work = zeros(len(rates))
+    buffer = zeros(len(rates))
+
+    def rhs(t, yvals, out):
+        return band_apply(coeffs, lband, scale_at(t), rates, yvals, out, work)
+
+    def ode_rhs(t, yvals):
+        return band_apply(coeffs, lband, scale_at(t), rates, yvals, buffer, work)
+
+    kernel = dict()
+    kernel['rhs'] = rhs
+    kernel['jvp'] = rhs
+    kernel['ode_rhs'] = ode_rhs
+    kernel['backend'] = backend
+    return kernel
@@ -0,0 +1,707 @@
+'''
+Solver driver for the radial reaction-diffusion equation
+
+The operators in brownian_integrator are tridiagonal apart from a few one-sided
+rows at the edges of the grid, so the jacobian handed to the stiff integrator is
+banded. This file wraps LSODA (through scipy's ode class) with a packed banded
+jacobian, and the implicit scipy solvers (BDF, Radau) with a sparse one, so
+that the LU factorizations cost O(L) instead of the O(L^3) of the dense jacobian.
+
+Observables can be streamed out of the integration with the reducers in
+observables.py, so the full solution mesh never has to be held in memory.
+
+Typical use, replacing the ode/while loop in the main notebook
+
+    out = solve_radiff(y0, settings, params)
+    sol = out['sol']
+
+or, keeping only the surviving fraction
+
+    out = solve_radiff(y0, settings, params, reducers=[Survival()])
+    total_conc = out['survival']
+
+William Gilpin, 2015
+'''
+
+from scipy import *
+from numpy import *
+import scipy.sparse as sparse
+import time
+from scipy.integrate import ode, BDF, Radau, LSODA
+from scipy.optimize import brentq
+
+from brownian_integrator import *
+from observables import *
+from rhs_kernels import make_rhs_kernel
+from propagators import magnus_step
+from solver_stats import SolverStats
+
+# the solvers that are stepped directly, rather than through the ode class
+ODE_SOLVERS = {'BDF': BDF, 'Radau': Radau, 'LSODA': LSODA}
+
+
+def jacobian_bandwidth(op):
+    '''
+    Return the lower and upper bandwidths (lband, uband) of a sparse matrix
+    '''
+    coo = sparse.coo_matrix(op)
+    offsets = coo.col - coo.row
+    lband = int(maximum(0, -offsets.min()))
+    uband = int(maximum(0, offsets.max()))
+    return lband, uband
+
+
+def to_banded(op, lband, uband):
+    '''
+    Pack a sparse matrix into the LAPACK-style banded storage used by LSODA,
+    where ab[uband + i - j, j] = op[i, j]
+    '''
+    coo = sparse.coo_matrix(op)
+    ab = zeros((lband + uband + 1, op.shape[1]))
+    ab[uband + coo.row - coo.col, coo.col] = coo.data
+    return ab
+
+
+def radiff_system(settings, params, nondim=False):
+    '''
+    Build the right hand side and sparse jacobian of the reaction-diffusion
+    equation from the cached operator pieces
+
+    settings : dict
+        The integrator settings; only settings['space'] is used here
+
+    params : dict
+        The parameter values of the diffusion equation
+
+    nondim : bool
+        Use the time-independent nondimensional operator of radiff_timeop_nondim
+        instead of the dimensional radiff_timeop
+
+    RETURNS
+    -------
+
+    rhs : function
+        rhs(t, y), the time derivative
+
+    jac : function
+        jac(t, y), the jacobian as a CSC matrix
+
+    '''
+    spaceop, rxn_rates = radiff_parts(settings, params, nondim=nondim)
+    rxn_op = sparse.diags(rxn_rates)
+
+    if nondim:
+        fixed_jac = (-spaceop - rxn_op).tocsc()
+
+        def rhs(t, y):
+            return fixed_jac.dot(y)
+
+        def jac(t, y):
+            return fixed_jac
+
+    else:
+        spaceop_csc = spaceop.tocsc()
+        rxn_csc = rxn_op.tocsc()
+
+        def rhs(t, y):
+            return -diffusion_prefactor(t, params)*spaceop.dot(y) - rxn_rates*y
+
+        def jac(t, y):
+            return -diffusion_prefactor(t, params)*spaceop_csc - rxn_csc
+
+    return rhs, jac
+
+
+def radiff_banded_system(settings, params, nondim=False, compiled=False):
+    '''
+    Like radiff_system, but the jacobian is returned in packed banded storage
+    for LSODA. The packed spatial operator is built once, so each jacobian
+    call only rescales it, which is O(L)
+
+    compiled : bool
+        Evaluate the right hand side with the fused, allocation-free kernel
+        from rhs_kernels (compiled with Numba when it is installed). The
+        result is written into a reused buffer, which is safe for scipy's ode
+        class since it copies the values
+
+    RETURNS
+    -------
+
+    rhs : function
+        rhs(t, y), the time derivative
+
+    jac_banded : function
+        jac_banded(t, y), the jacobian in banded storage
+
+    lband, uband : int
+        The bandwidths of the jacobian
+    '''
+    spaceop, rxn_rates = radiff_parts(settings, params, nondim=nondim)
+    lband, uband = jacobian_bandwidth(spaceop)
+    spaceop_ab = to_banded(spaceop, lband, uband)
+
+    if compiled:
+        rhs = make_rhs_kernel(settings, params, nondim=nondim)['ode_rhs']
+    else:
+        rhs, _ = radiff_system(settings, params, nondim=nondim)
+
+    def jac_banded(t, y):
+        if nondim:
+            ab = -spaceop_ab
+        else:
+            ab = -diffusion_prefactor(t, params)*spaceop_ab
+        ab[uband, :] -= rxn_rates
+        return ab
+
+    return rhs, jac_banded, lband, uband
+
+
+class SurvivalBelow(object):
+    '''
+    Stop once the surviving fraction falls below threshold. The crossing
+    time is located by root-finding, like a solve_ivp terminal event
+
+    threshold : double
+        The surviving fraction at which to stop
+    '''
+    name = 'survival_below'
+    localize = True
+
+    def __init__(self, threshold=1e-4):
+        self.threshold = threshold
+
+    def start(self, settings, params, rhs, nondim):
+        self.weights = survival_weights(settings, params)
+
+    def __call__(self, t, y):
+        return self.weights.dot(y) - self.threshold
+
+
+class SteadyDecay(object):
+    '''
+    Stop once the decay rate -(dS/dt)/S of the surviving fraction has
+    settled onto the slowest mode. The run stops when the relative change of
+    the rate between checks stays below rtol for patience checks in a row.
+    With ALPHA < 1 the dimensional rate keeps drifting with t^(ALPHA-1), so
+    this is mainly useful for the nondimensional equation or ALPHA = 1
+
+    rtol : double
+        The relative change in decay rate that counts as steady
+
+    patience : int
+        How many consecutive steady checks are needed
+    '''
+    name = 'steady_decay'
+    localize = False
+
+    def __init__(self, rtol=1e-4, patience=5):
+        self.rtol = rtol
+        self.patience = patience
+
+    def start(self, settings, params, rhs, nondim):
+        self.weights = survival_weights(settings, params)
+        self.rhs = rhs
+        self.last_rate = None
+        self.nsteady = 0
+
+    def __call__(self, t, y):
+        rate = -self.weights.dot(self.rhs(t, y))/self.weights.dot(y)
+
+        if self.last_rate is not None and abs(rate - self.last_rate) <= self.rtol*abs(rate):
+            self.nsteady += 1
+        else:
+            self.nsteady = 0
+        self.last_rate = rate
+
+        return self.patience - self.nsteady - 0.5
+
+
+class WallTime(object):
+    '''
+    Stop once the integration has run for max_seconds of wall time
+
+    max_seconds : double
+        The time budget, in seconds
+    '''
+    name = 'wall_time'
+    localize = False
+
+    def __init__(self, max_seconds):
+        self.max_seconds = max_seconds
+
+    def start(self, settings, params, rhs, nondim):
+        self.start_time = time.time()
+
+    def __call__(self, t, y):
+        return self.max_seconds - (time.time() - self.start_time)
+
+
+def _check_stoppers(stoppers, stop_vals, t_old, t_new, interp):
+    '''
+    Evaluate the stopping events on a new state. If one of them has dropped
+    to zero or below, return it along with the time at which it fired
+    '''
+    y_new = interp(t_new)
+    for ind, stopper in enumerate(stoppers):
+        val = stopper(t_new, y_new)
+        if val <= 0:
+            t_stop = t_new
+            if stopper.localize and stop_vals[ind] > 0:
+                t_stop = brentq(lambda tt: stopper(tt, interp(tt)), t_old, t_new)
+            return stopper, t_stop
+        stop_vals[ind] = val
+    return None, None
+
+
+def _integrate(y0, times, settings, params, method, nondim, banded, rtol, atol, nsteps,
+               callback, stoppers=(), compiled=False, substeps=1, stats=None):
+    '''
+    March the equation through the output times, calling callback(tind, t, y)
+    at each one as soon as it is reached. The stopping events are checked on
+    every internal step of the BDF/Radau/LSODA solvers, and at every output
+    time for the 'lsoda' and 'magnus' methods. If stats is a SolverStats, the
+    right hand side and jacobian are instrumented and the steps recorded.
+
+    RETURNS
+    -------
+
+    nsaved : int
+        The number of output times reached
+
+    status : str
+        'finished', 'failed', or the name of the stopping event that fired
+
+    t_stop, y_stop :
+        The time and state at which the integration ended
+    '''
+    settings_and_params = [settings, params]
+
+    def instrument(rhs, jac):
+        if stats is None:
+            return rhs, jac
+        return stats.wrap_rhs(rhs), stats.wrap_jac(jac)
+
+    rhs, _ = radiff_system(settings, params, nondim=nondim)
+    for stopper in stoppers:
+        stopper.start(settings, params, rhs, nondim)
+    stop_vals = [stopper(times[0], y0) for stopper in stoppers]
+
+    callback(0, times[0], y0)
+    nsaved = 1
+    status = 'finished'
+    t_stop, y_stop = times[0], y0
+
+    if method in ('lsoda', 'magnus'):
+
+        if method == 'magnus':
+            if nondim:
+                raise ValueError("The magnus method integrates the dimensional equation")
+
+            def advance(tind, y_old):
+                if stats is not None:
+                    stats.record_step(times[tind], (times[tind] - times[tind-1])/substeps, substeps)
+                return magnus_step(y_old, times[tind-1], times[tind], settings, params,
+                                   substeps=substeps)
+
+        else:
+            if banded:
+                rhs, jac, lband, uband = radiff_banded_system(settings, params, nondim=nondim,
+                                                              compiled=compiled)
+                rhs, jac = instrument(rhs, jac)
+                r = ode(rhs, jac).set_integrator('lsoda', with_jacobian=True, nsteps=nsteps,
+                                                lband=lband, uband=uband, rtol=rtol, atol=atol)
+            else:
+                if nondim:
+                    r = ode(*instrument(nxt_step_nondim, radiff_timeop_nondim))
+                else:
+                    r = ode(*instrument(nxt_step, radiff_timeop))
+                r.set_integrator('lsoda', with_jacobian=True, nsteps=nsteps, rtol=rtol, atol=atol)
+                r.set_f_params(settings_and_params)
+                r.set_jac_params(settings_and_params)
+
+            r.set_initial_value(y0, times[0])
+
+            def advance(tind, y_old):
+                r.integrate(times[tind])
+                if stats is not None:
+                    stats.record_lsoda(getattr(r, '_integrator', None))
+                if not r.successful():
+                    return None
+                return r.y.copy()
+
+        y_old = y0
+        for tind in range(1, len(times)):
+            y_new = advance(tind, y_old)
+            if y_new is None:
+                status = 'failed'
+                break
+
+            if stoppers:
+                # without dense output, interpolate linearly between outputs
+                t_old, t_new = times[tind-1], times[tind]
+                def interp(tt, y_old=y_old, y_new=y_new, t_old=t_old, t_new=t_new):
+                    return y_old + (tt - t_old)/(t_new - t_old)*(y_new - y_old)
+                stopper, t_hit = _check_stoppers(stoppers, stop_vals, t_old, t_new, interp)
+                if stopper is not None:
+                    status = stopper.name
+                    t_stop, y_stop = t_hit, interp(t_hit)
+                    if t_hit < t_new:
+                        break
+
+            callback(tind, times[tind], y_new)
+            nsaved += 1
+            t_stop, y_stop = times[tind], y_new
+            y_old = y_new
+            if status != 'finished':
+                break
+
+    elif method in ODE_SOLVERS:
+
+        if method == 'LSODA':
+            rhs, jac, lband, uband = radiff_banded_system(settings, params, nondim=nondim)
+            rhs, jac = instrument(rhs, jac)
+            solver = ODE_SOLVERS[method](rhs, times[0], y0, times[-1], jac=jac,
+                                         lband=lband, uband=uband, rtol=rtol, atol=atol)
+        else:
+            rhs, jac = instrument(*radiff_system(settings, params, nondim=nondim))
+            solver = ODE_SOLVERS[method](rhs, times[0], y0, times[-1], jac=jac,
+                                         rtol=rtol, atol=atol)
+
+        # take the solver's own steps, and interpolate onto any output times
+        # that were passed over
+        while nsaved < len(times) and solver.status == 'running':
+            t_old = solver.t
+            solver.step()
+            if solver.status == 'failed':
+                status = 'failed'
+                break
+            if stats is not None:
+                stats.record_step(solver.t, solver.t - t_old)
+                if method == 'LSODA':
+                    stats.record_lsoda_solver(solver.t, solver)
+            interp = solver.dense_output()
+
+            t_end = solver.t
+            if stoppers:
+                stopper, t_hit = _check_stoppers(stoppers, stop_vals, t_old, solver.t, interp)
+                if stopper is not None:
+                    status = stopper.name
+                    t_end = t_hit
+
+            while nsaved < len(times) and times[nsaved] <= t_end:
+                callback(nsaved, times[nsaved], interp(times[nsaved]))
+                nsaved += 1
+            t_stop, y_stop = t_end, interp(t_end)
+
+            if status != 'finished':
+                break
+
+    else:
+        raise ValueError("Unknown integration method: " + str(method))
+
+    return nsaved, status, t_stop, y_stop
+
+
+def solve_radiff(y0, settings, params, method='lsoda', nondim=False, banded=True,
+                 rtol=1e-6, atol=1e-12, reducers=None, output_times=None, nsteps=100000,
+                 stop_when=None, compiled=False, substeps=1, stats=None):
+    '''
+    Integrate the reaction-diffusion equation and record the state at every
+    time in settings['times'] (or in output_times)
+
+    y0 : array
+        The initial condition, a profile on settings['space']. As in the
+        notebooks this is the profile relative to the equilibrium distribution,
+        so multiply by eq_dist to get a radial probability density
+
+    settings : dict
+        settings['space'] and settings['times'] for the integration. The first
+        entry of settings['times'] is the initial time
+
+    params : dict
+        The parameter values of the diffusion equation
+
+    method : str
+        'lsoda' uses scipy's ode class, exactly like the notebooks. 'LSODA'
+        (banded jacobian), 'BDF' and 'Radau' (sparse jacobian) step the
+        corresponding scipy solvers directly. 'magnus' takes fourth-order
+        Magnus steps (see propagators.magnus_step) that integrate the
+        t^(ALPHA-1) prefactor exactly, so output times may start at t = 0
+        without an offset
+
+    nondim : bool
+        Solve the nondimensional equation of radiff_timeop_nondim; then
+        settings['times'] are in the rescaled units (see time_nondim)
+
+    banded : bool
+        Give LSODA the banded jacobian. For the other methods the sparse
+        jacobian is always used. Set to False to reproduce the old dense
+        jacobian behaviour
+
+    rtol, atol : double
+        Integrator tolerances
+
+    reducers : list
+        Streaming reducers from observables.py (Survival, FirstPassage,
+        RadialMoments, Snapshots, ...). Each one is updated as the integrator
+        reaches an output time, and the full solution is not stored. If None,
+        the full solution is kept, as with [FullSolution()]
+
+    output_times : array
+        The times at which to record the state, overriding settings['times'].
+        The integrator takes its own (large) internal steps between them, so a
+        sparse schedule from output_schedule covers many decades of time with
+        only a few hundred stored states
+
+    nsteps : int
+        The largest number of internal LSODA steps allowed between two
+        output times
+
+    stop_when : list
+        Stopping events (SurvivalBelow, SteadyDecay, WallTime). The run ends
+        as soon as any of them fires, and out['status'] records which one.
+        The BDF/Radau/LSODA methods check them on every internal step; the
+        'lsoda' method only at output times
+
+    compiled : bool
+        Use the fused, allocation-free right hand side kernel of rhs_kernels
+        for the banded 'lsoda' method
+
+    substeps : int
+        The number of Magnus steps between consecutive output times, for the
+        'magnus' method. rtol and atol do not apply to it
+
+    stats : SolverStats or bool
+        Instrument the run (see solver_stats.py): True, or a SolverStats with
+        a callback or logger attached. The summary is returned in out['stats']
+
+    RETURNS
+    -------
+
+    out : dict
+        out['times'], the output times that were reached
+        out['success'], False if the integrator failed
+        out['status'], 'finished', 'failed', or the name of the stopping
+        event that ended the run
+        out['t_stop'], out['y_stop'], the time and state at the end of the run
+        out[reducer.name], the result of each reducer. Without reducers this
+        is out['sol'], a (space x time) array of solution values
+        out['stats'], the instrumentation summary, if stats was given
+
+    '''
+    if output_times is None:
+        output_times = settings['times']
+    times = asarray(output_times, dtype=double)
+    y0 = asarray(y0, dtype=double)
+
+    if any(diff(times) <= 0):
+        raise ValueError("Output times must be strictly increasing")
+
+    if reducers is None:
+        reducers = [FullSolution()]
+
+    for reducer in reducers:
+        reducer.start(times, settings, params)
+
+    if stats is True:
+        stats = SolverStats()
+    elif stats is False:
+        stats = None
+
+    def callback(tind, time, yvals):
+        for reducer in reducers:
+            reducer.update(tind, time, yvals)
+        if stats is not None:
+            stats.output(time)
+
+    if stop_when is None:
+        stop_when = list()
+
+    if stats is not None:
+        stats.start(method)
+    nsaved, status, t_stop, y_stop = _integrate(y0, times, settings, params, method, nondim,
+                                                banded, rtol, atol, nsteps, callback,
+                                                stoppers=stop_when, compiled=compiled,
+                                                substeps=substeps, stats=stats)
+    if stats is not None:
+        stats.finish()
+
+    out = dict()
+    out['times'] = times[:nsaved]
+    out['success'] = (status != 'failed')
+    out['status'] = status
+    out['t_stop'] = t_stop
+    out['y_stop'] = y_stop
+    for reducer in reducers:
+        out[reducer.name] = reducer.result()
+    if stats is not None:
+        out['stats'] = stats.summary()
+
+    return out
+
+
+def radiff_batch_system(settings, param_list, nondim=False):
+    '''
+    The right hand side and jacobian for N parameter sets advanced together.
+    The points may differ in KAPPA, DCOEFF, ALPHA and WELL_DIAM, but must share
+    the grid and POT_DIAM, so that they all use the same cached spatial
+    operator S. The state is the (L, N) matrix Y flattened column by column,
+    and the equation is
+
+        dY/dt = -(S Y) diag(prefactors(t)) - rates * Y
+
+    so each right hand side is one sparse-times-dense product. The jacobian is
+    block diagonal, with the same bandwidth as for a single point
+
+    RETURNS
+    -------
+
+    rhs : function
+        rhs(t, y) for the flattened state
+
+    jac : function
+        jac(t, y), the block-diagonal jacobian as a CSC matrix
+
+    '''
+    pot_diams = set([point['POT_DIAM'] for point in param_list])
+    if len(pot_diams) > 1:
+        raise ValueError("Batched parameter sets must share POT_DIAM")
+
+    npts = len(param_list)
+    spaceop = radiff_parts(settings, param_list[0], nondim=nondim)[0]
+    L = spaceop.shape[0]
+    rates = array([radiff_parts(settings, point, nondim=nondim)[1] for point in param_list]).T
+    rate_op = sparse.diags(rates.T.ravel())
+
+    def prefactors(t):
+        if nondim:
+            return ones(npts)
+        return array([diffusion_prefactor(t, point) for point in param_list])
+
+    def rhs(t, y):
+        yvals = y.reshape(npts, L).T
+        nxt_vals = -spaceop.dot(yvals)*prefactors(t) - rates*yvals
+        return nxt_vals.T.ravel()
+
+    def jac(t, y):
+        return (sparse.kron(sparse.diags(-prefactors(t)), spaceop) - rate_op).tocsc()
+
+    return rhs, jac
+
+
+def integrate_stacked(rhs, jac, y0, times, record, method='BDF', rtol=1e-6, atol=1e-12):
+    '''
+    Step a stacked linear system, such as that of radiff_batch_system, with one
+    of the scipy solvers, calling record(tind, y) with the flattened state at
+    each output time as soon as it is reached (including the initial one)
+
+    jac : function
+        jac(t, y), the sparse jacobian. For 'LSODA' it is packed into banded
+        storage, whose bandwidth for a block-diagonal stack is that of a block
+
+    RETURNS
+    -------
+
+    nsaved : int
+        The number of output times reached
+
+    success : bool
+        False if the integrator failed or the state stopped being finite
+    '''
+    if method == 'LSODA':
+        lband, uband = jacobian_bandwidth(jac(times[0], None))
+        sparse_jac = jac
+        def jac(t, y):
+            return to_banded(sparse_jac(t, y), lband, uband)
+        solver = LSODA(rhs, times[0], y0, times[-1], jac=jac,
+                       lband=lband, uband=uband, rtol=rtol, atol=atol)
+    elif method in ODE_SOLVERS:
+        solver = ODE_SOLVERS[method](rhs, times[0], y0, times[-1], jac=jac,
+                                     rtol=rtol, atol=atol)
+    else:
+        raise ValueError("Unknown integration method: " + str(method))
+
+    record(0, y0)
+    nsaved = 1
+    success = True
+    while nsaved < len(times) and solver.status == 'running':
+        solver.step()
+        if solver.status == 'failed' or not all(isfinite(solver.y)):
+            success = False
+            break
+        interp = solver.dense_output()
+        while nsaved < len(times) and times[nsaved] <= solver.t:
+            record(nsaved, interp(times[nsaved]))
+            nsaved += 1
+
+    return nsaved, success
+
+
+def solve_radiff_batch(y0, settings, param_list, method='BDF', nondim=False,
+                       rtol=1e-6, atol=1e-12, output_times=None, keep_full=False):
+    '''
+    Integrate N parameter sets on the same grid as one stacked linear system,
+    so that the Python and integrator overhead is paid once per step rather
+    than once per point
+
+    y0 : array
+        The initial condition, either one profile shared by every point or an
+        (L, N) array with one column per point
+
+    settings : dict
+        settings['space'] and settings['times'] for the integration
+
+    param_list : list of dict
+        The parameter sets. They must share POT_DIAM (see radiff_batch_system)
+
+    method : str
+        'BDF' or 'Radau' (sparse jacobian), or 'LSODA' (banded jacobian)
+
+    output_times : array
+        The times at which to record, overriding settings['times']
+
+    keep_full : bool
+        Whether to also return the full solution, which is (L x N x time)
+
+    RETURNS
+    -------
+
+    out : dict
+        out['times'], the output times that were reached
+        out['survival'], an (N x time) array of surviving fractions
+        out['sol'], the full solution, if keep_full is True
+        out['success'], False if the integrator failed
+    '''
+    if output_times is None:
+        output_times = settings['times']
+    times = asarray(output_times, dtype=double)
+
+    npts = len(param_list)
+    L = len(settings['space'])
+    y0 = asarray(y0, dtype=double)
+    if y0.ndim == 1:
+        y0 = tile(y0[:, None], (1, npts))
+
+    weights = survival_weights(settings, param_list[0])
+    surv = zeros((npts, len(times)))
+    if keep_full:
+        sol = zeros((L, npts, len(times)))
+
+    def record(tind, y):
+        yvals = y.reshape(npts, L).T
+        surv[:, tind] = weights.dot(yvals)
+        if keep_full:
+            sol[:, :, tind] = yvals
+
+    rhs, jac = radiff_batch_system(settings, param_list, nondim=nondim)
+    nsaved, success = integrate_stacked(rhs, jac, y0.T.ravel(), times, record, method=method,
+                                        rtol=rtol, atol=atol)
+
+    out = dict()
+    out['times'] = times[:nsaved]
+    out['survival'] = surv[:, :nsaved]
+    out['success'] = success
+    if keep_full:
+        out['sol'] = sol[:, :, :nsaved]
+
+    return out
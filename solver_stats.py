@@ -0,0 +1,177 @@
+'''
+Instrumentation for the solver driver
+
+Pass a SolverStats to solve_radiff (or stats=True) to find out where the time
+in a run goes. The right hand side and jacobian are wrapped to count and time
+their calls, builds of the cached operators are counted, and the integrator's
+steps are recorded: every accepted step for the BDF/Radau/LSODA solver
+classes, and for the 'lsoda' method (scipy's ode class, which only reports
+back at output times) the number of internal steps and the last step size in
+each output interval, read from LSODA's work arrays. LSODA's switches between
+its non-stiff (Adams) and stiff (BDF) methods are recorded as they are seen.
+
+    out = solve_radiff(y0, settings, params, stats=True)
+    out['stats']['rhs_calls'], out['stats']['method_switches']
+
+Without stats nothing is wrapped, so the solver runs exactly as before.
+
+William Gilpin, 2015
+'''
+
+from numpy import *
+from time import perf_counter
+
+from brownian_integrator import *
+
+
+# the values of LSODA's MUSED flag
+LSODA_METHODS = {1: 'nonstiff', 2: 'stiff'}
+
+
+class SolverStats(object):
+    '''
+    Counters and histories for one solver run
+
+    callback : function
+        callback(stats, t) is called every time an output time is reached,
+        e.g. to print progress or to stop watching a run that is too slow
+
+    logger : logging.Logger
+        If given, method switches are logged at debug level and the summary
+        at info level when the run ends
+    '''
+
+    def __init__(self, callback=None, logger=None):
+        self.callback = callback
+        self.logger = logger
+
+    def start(self, method):
+        self.method = method
+        self.rhs_calls = 0
+        self.jac_calls = 0
+        self.rhs_time = 0.0
+        self.jac_time = 0.0
+        self.step_times = list()
+        self.step_sizes = list()
+        self.steps = 0
+        self.method_switches = list()
+        self.current_method = None
+        self._last_nst = 0
+        self._cache_start = operator_cache_info()
+        self._wall_start = perf_counter()
+
+    def wrap_rhs(self, rhs):
+        '''
+        Return rhs wrapped so that its calls are counted and timed
+        '''
+        def counted_rhs(*args):
+            start = perf_counter()
+            out = rhs(*args)
+            self.rhs_time += perf_counter() - start
+            self.rhs_calls += 1
+            return out
+        return counted_rhs
+
+    def wrap_jac(self, jac):
+        '''
+        Return jac wrapped so that its calls are counted and timed
+        '''
+        def counted_jac(*args):
+            start = perf_counter()
+            out = jac(*args)
+            self.jac_time += perf_counter() - start
+            self.jac_calls += 1
+            return out
+        return counted_jac
+
+    def record_step(self, t, step_size, nsteps=1):
+        '''
+        Record nsteps accepted steps ending at t, the last of size step_size
+        '''
+        self.steps += nsteps
+        self.step_times.append(t)
+        self.step_sizes.append(step_size)
+
+    def record_method(self, t, code):
+        '''
+        Record the LSODA method flag in use at t, noting any switch
+        '''
+        name = LSODA_METHODS.get(int(code))
+        if name is None or name == self.current_method:
+            return
+        if self.current_method is not None:
+            self.method_switches.append((float(t), name))
+            if self.logger is not None:
+                self.logger.debug("LSODA switched to the %s method at t = %g", name, t)
+        self.current_method = name
+
+    def record_lsoda(self, integrator):
+        '''
+        Read the step count, last step size and method from the work arrays
+        of scipy's ode('lsoda') integrator after it reaches an output time.
+        These are scipy internals, so if a scipy version does not expose them
+        the steps and switches are not recorded
+        '''
+        iwork = getattr(integrator, 'iwork', None)
+        rwork = getattr(integrator, 'rwork', None)
+        if iwork is None or rwork is None or len(iwork) < 19 or len(rwork) < 15:
+            return
+        nst = int(integrator.iwork[10])
+        if nst > self._last_nst:
+            # rwork[12] is the time reached and rwork[10] the last step size
+            self.record_step(integrator.rwork[12], integrator.rwork[10], nst - self._last_nst)
+            # rwork[14] is the time of the last method switch
+            self.record_method(integrator.rwork[14], integrator.iwork[18])
+        self._last_nst = nst
+
+    def record_lsoda_solver(self, t, solver):
+        '''
+        Record the method flag of scipy's LSODA solver class at t, read from
+        the work array of its private Fortran wrapper. Nothing is recorded if
+        a scipy version lays that out differently
+        '''
+        integrator = getattr(getattr(solver, '_lsoda_solver', None), '_integrator', None)
+        iwork = getattr(integrator, 'iwork', None)
+        if iwork is None or len(iwork) < 19:
+            return
+        self.record_method(t, iwork[18])
+
+    def output(self, t):
+        if self.callback is not None:
+            self.callback(self, t)
+
+    def finish(self):
+        self.wall_time = perf_counter() - self._wall_start
+        cache_end = operator_cache_info()
+        self.operator_builds = cache_end['misses'] - self._cache_start['misses']
+        self.operator_hits = cache_end['hits'] - self._cache_start['hits']
+        self.operator_build_time = cache_end['build_time'] - self._cache_start['build_time']
+        if self.logger is not None:
+            self.logger.info("%s: %d steps, %d rhs calls (%.3g s), %d jacobian calls (%.3g s), "
+                             "%d operator builds (%.3g s), %.3g s in total", self.method,
+                             self.steps, self.rhs_calls, self.rhs_time, self.jac_calls,
+                             self.jac_time, self.operator_builds, self.operator_build_time,
+                             self.wall_time)
+
+    def summary(self):
+        '''
+        The collected statistics as a dict. other_time is the wall time not
+        spent in the right hand side, the jacobian or operator builds, i.e.
+        the integrator itself and the Python driver loop
+        '''
+        out = dict()
+        out['method'] = self.method
+        out['wall_time'] = self.wall_time
+        out['rhs_calls'] = self.rhs_calls
+        out['rhs_time'] = self.rhs_time
+        out['jac_calls'] = self.jac_calls
+        out['jac_time'] = self.jac_time
+        out['operator_builds'] = self.operator_builds
+        out['operator_hits'] = self.operator_hits
+        out['operator_build_time'] = self.operator_build_time
+        out['other_time'] = self.wall_time - self.rhs_time - self.jac_time - self.operator_build_time
+        out['steps'] = self.steps
+        out['step_times'] = array(self.step_times)
+        out['step_sizes'] = array(self.step_sizes)
+        out['method_switches'] = list(self.method_switches)
+        return out
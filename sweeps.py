@@ -0,0 +1,281 @@
+'''
+Parameter sweeps over the reaction-diffusion solver
+
+The sweeps in the main notebook (timescale_vs_asquared and friends) run an
+independent solve for every point of a parameter grid. run_sweep fans those
+points out over a process pool in small chunks, so that every worker stays busy
+even when the whole sweep shares one grid. Points are chunked in order of their
+grid and POT_DIAM, and each worker keeps its own operator cache, so the spatial
+operators are built about once per grid and worker. Only reduced results (e.g.
+survival curves) come back from the workers, and a checkpoint file, updated as
+each chunk finishes, lets an interrupted sweep pick up where it stopped.
+
+William Gilpin, 2015
+'''
+
+from numpy import *
+import os
+import hashlib
+import itertools
+import multiprocessing
+
+from brownian_integrator import *
+from rxndiff_solver import *
+
+
+def scaled_grid(params, space_pts=100, length_factor=10):
+    '''
+    The radial grid used by the notebook sweeps, which extends out to
+    length_factor*POT_DIAM and is shifted by one step to avoid r = 0
+    '''
+    ACTUAL_LENGTH = length_factor*params['POT_DIAM']
+    dx = ACTUAL_LENGTH/space_pts
+    space = linspace(0.0, ACTUAL_LENGTH, space_pts)
+    return space + dx
+
+
+def survival_point(params, settings, **solve_kwargs):
+    '''
+    Solve one sweep point from the flat initial condition used in the
+    notebooks and return its surviving fraction at every output time. If the
+    run is ended early by a stopping event, the remaining entries are zero
+    '''
+    times = settings['times']
+    y0 = ones(len(settings['space']))
+    out = solve_radiff(y0, settings, params, reducers=[Survival()], **solve_kwargs)
+
+    surv = zeros(len(times))
+    surv[:len(out['survival'])] = out['survival']
+    return surv
+
+
+def param_grid(params, axes):
+    '''
+    The list of parameter dicts on the cartesian product of the sweep axes
+
+    params : dict
+        The base parameter values
+
+    axes : list of (name, values)
+        The parameters to sweep over, in order. The first axis varies slowest
+    '''
+    names = [name for name, _ in axes]
+    all_params = list()
+    for vals in itertools.product(*[values for _, values in axes]):
+        point = params.copy()
+        point.update(zip(names, vals))
+        all_params.append(point)
+    return all_params
+
+
+def _sweep_task(task):
+    inds, all_params, settings, point_fn, grid_fn, solve_kwargs = task
+    results = list()
+    for point in all_params:
+        point_settings = settings.copy()
+        if grid_fn is not None:
+            point_settings['space'] = grid_fn(point)
+        results.append(point_fn(point, point_settings, **solve_kwargs))
+    return inds, results
+
+
+def _sweep_key(all_params, settings, point_fn, grid_fn):
+    # identifies the sweep a checkpoint belongs to: its points, grid, output
+    # times and the functions that solve them
+    digest = hashlib.sha256()
+    for point in all_params:
+        for name in sorted(point):
+            val = asarray(point[name])
+            digest.update(name.encode() + str(val.dtype).encode() + val.tobytes())
+    for name in ('space', 'times'):
+        digest.update(ascontiguousarray(settings[name], dtype=double).tobytes())
+    digest.update(str(settings.get('stencil')).encode())
+    for fn in (point_fn, grid_fn):
+        digest.update(getattr(fn, '__qualname__', str(fn)).encode())
+    return digest.hexdigest()
+
+
+def _load_checkpoint(checkpoint, npts, sweep_key):
+    if checkpoint is None or not os.path.exists(checkpoint):
+        return zeros(npts, dtype=bool), None
+    saved = load(checkpoint)
+    if 'sweep_key' not in saved.files or str(saved['sweep_key']) != sweep_key:
+        raise ValueError("Checkpoint " + checkpoint + " belongs to a different sweep")
+    return saved['done'].copy(), saved['results'].copy()
+
+
+def _save_checkpoint(checkpoint, done, results, sweep_key):
+    tmpfile = checkpoint + '.tmp.npz'
+    savez(tmpfile, done=done, results=results, sweep_key=sweep_key)
+    os.replace(tmpfile, checkpoint)
+
+
+def run_points(all_params, settings, point_fn=survival_point, grid_fn=None, processes=None,
+               checkpoint=None, chunksize=None, **solve_kwargs):
+    '''
+    Run the solver at every parameter set in the list all_params, in parallel.
+    This is run_sweep without the grid structure, for arbitrary lists of points
+
+    RETURNS
+    -------
+
+    results : array
+        An array of shape (len(all_params),) + result shape
+    '''
+    npts = len(all_params)
+
+    sweep_key = _sweep_key(all_params, settings, point_fn, grid_fn)
+    done, results = _load_checkpoint(checkpoint, npts, sweep_key)
+
+    # order the points by grid, so that consecutive points in a chunk reuse
+    # the operators cached in their worker
+    groups = dict()
+    for ind, point in enumerate(all_params):
+        if done[ind]:
+            continue
+        if grid_fn is None:
+            space = settings['space']
+        else:
+            space = grid_fn(point)
+        key = (grid_key(space), point['POT_DIAM'])
+        groups.setdefault(key, list()).append(ind)
+    pending = [ind for inds in groups.values() for ind in inds]
+
+    if processes is None:
+        nworkers = multiprocessing.cpu_count()
+    else:
+        nworkers = processes
+    if chunksize is None:
+        # a few chunks per worker, to balance the load
+        chunksize = int(maximum(1, ceil(len(pending)/(4*nworkers))))
+
+    tasks = list()
+    for start in range(0, len(pending), chunksize):
+        inds = pending[start:start + chunksize]
+        tasks.append((inds, [all_params[ind] for ind in inds], settings, point_fn, grid_fn,
+                      solve_kwargs))
+
+    def collect(task_results):
+        nonlocal results
+        for inds, point_results in task_results:
+            for ind, res in zip(inds, point_results):
+                res = asarray(res)
+                if results is None:
+                    results = zeros((npts,) + res.shape)
+                results[ind] = res
+                done[ind] = True
+            if checkpoint is not None:
+                _save_checkpoint(checkpoint, done, results, sweep_key)
+
+    if processes == 1 or len(tasks) == 0:
+        collect(map(_sweep_task, tasks))
+    else:
+        with multiprocessing.Pool(processes) as pool:
+            collect(pool.imap_unordered(_sweep_task, tasks))
+
+    return results
+
+
+def run_sweep(params, axes, settings, point_fn=survival_point, grid_fn=None,
+              processes=None, checkpoint=None, chunksize=None, **solve_kwargs):
+    '''
+    Run the solver at every point of a parameter grid, in parallel
+
+    params : dict
+        The base parameter values
+
+    axes : list of (name, values)
+        The parameters to sweep over, e.g. [('KAPPA', kvals), ('POT_DIAM', well_diams)]
+
+    settings : dict
+        The integrator settings shared by all points
+
+    point_fn : function
+        point_fn(params, settings, **solve_kwargs) solves one point and returns
+        an array of results of the same shape for every point. It must be a
+        module-level function so that it can be sent to the worker processes
+
+    grid_fn : function
+        grid_fn(params) returns the spatial grid for a point, e.g. scaled_grid.
+        If None, settings['space'] is used everywhere
+
+    processes : int
+        The number of worker processes. None uses every core, and 1 runs the
+        sweep serially in this process
+
+    checkpoint : str
+        A .npz file where finished points are saved as they come in. If it
+        already exists, those points are skipped, so an interrupted sweep can
+        be resumed by calling run_sweep again with the same arguments. It is
+        rewritten each time a chunk of points finishes, and a checkpoint left
+        by a sweep with other points, grid, times or functions raises a
+        ValueError
+
+    chunksize : int
+        The number of points sent to a worker at a time. Defaults to a few
+        chunks per worker
+
+    solve_kwargs :
+        Passed on to point_fn, and from there to solve_radiff (for instance
+        stop_when or output_times)
+
+    RETURNS
+    -------
+
+    out : dict
+        out['axes'], the sweep axes
+        out['results'], an array of shape (len(values) for each axis) + result shape
+    '''
+    all_params = param_grid(params, axes)
+    shape = tuple(len(values) for _, values in axes)
+    results = run_points(all_params, settings, point_fn=point_fn, grid_fn=grid_fn,
+                         processes=processes, checkpoint=checkpoint, chunksize=chunksize,
+                         **solve_kwargs)
+
+    out = dict()
+    out['axes'] = axes
+    out['results'] = results.reshape(shape + results.shape[1:])
+    return out
+
+
+def timescale_vs_asquared(well_diams, params, settings, processes=None, **solve_kwargs):
+    '''
+    Survival probability traces for each potential width in well_diams, using
+    the notebook grid of scaled_grid. Same output as the notebook function of
+    the same name, but the points are solved in parallel
+
+    RETURNS
+    -------
+
+    outs : array
+        Survival probability traces for each value in well_diams
+    '''
+    out = run_sweep(params, [('POT_DIAM', well_diams)], settings, grid_fn=scaled_grid,
+                    processes=processes, **solve_kwargs)
+    return out['results']
+
+
+def timescale_vs_asquared_vs_kappa(well_diams, kvals, params, settings, processes=None,
+                                   **solve_kwargs):
+    '''
+    Survival times dt*sum(survival) as a function of well diameter, for each
+    value of KAPPA. All of the (KAPPA, POT_DIAM) points go into one sweep
+    '''
+    times = settings['times']
+    dt = times[2] - times[1]
+    out = run_sweep(params, [('KAPPA', kvals), ('POT_DIAM', well_diams)], settings,
+                    grid_fn=scaled_grid, processes=processes, **solve_kwargs)
+    return list(dt*sum(out['results'], axis=-1))
+
+
+def timescale_vs_asquared_vs_rxndiam(well_diams, rxn_diam_vals, params, settings,
+                                     processes=None, **solve_kwargs):
+    '''
+    Survival times dt*sum(survival) as a function of well diameter, for each
+    reaction zone diameter WELL_DIAM
+    '''
+    times = settings['times']
+    dt = times[2] - times[1]
+    out = run_sweep(params, [('WELL_DIAM', rxn_diam_vals), ('POT_DIAM', well_diams)], settings,
+                    grid_fn=scaled_grid, processes=processes, **solve_kwargs)
+    return list(dt*sum(out['results'], axis=-1))
@@ -0,0 +1,26 @@
+from numpy import *
+
+from angular_channels import radiff_channel_system
+
+
+def test_centrifugal_sign_matches_laplacian():
+    # in the Laplacian d^2/dr^2 + (2/r) d/dr - l(l+1)/r^2 (which is why
+    # r^l P_l(cos theta) is harmonic) the centrifugal term is -l(l+1)/r^2
+    # relative to the second derivative, whatever sign the operator carries
+    space = linspace(.1, 10, 100)
+    settings = dict(space=space, times=array([1.0]), stencil='fd2')
+    params = dict(WELL_DIAM=.5, POT_DIAM=1.0, KAPPA=1.0, DCOEFF=1.0, ALPHA=.5)
+    ells = arange(4)
+    _, jac = radiff_channel_system(settings, params, ells, nondim=True)
+    jac = jac(0.0, None).toarray()
+    L = len(space)
+
+    ind = L//2
+    r0 = space[ind]
+    # fd2 is exact on a quadratic, and its slope and value vanish at r0
+    quad = .5*(space - r0)**2
+    second = jac[:L, :L].dot(quad)[ind]
+    for ell in ells[1:]:
+        block = slice(ell*L, (ell + 1)*L)
+        centrifugal = jac[block, block][ind, ind] - jac[:L, :L][ind, ind]
+        assert allclose(centrifugal/second, -ell*(ell + 1)/r0**2)
@@ -0,0 +1,19 @@
+from numpy import *
+import scipy.sparse as sparse
+
+from caputo_solver import caputo_march
+
+
+def march(history, alpha, dt=1e-3, nsteps=400):
+    jac = -sparse.diags(linspace(.1, 5, 20)).tocsr()
+    ys = list()
+    caputo_march(jac, ones(20), dt, nsteps, alpha, lambda tind, y: ys.append(y.copy()),
+                 history=history, eps=1e-8)
+    return array(ys)
+
+
+def test_soe_matches_full_history_at_small_dt():
+    # nodes*dt << 1 for most of the exponentials, where the history weights
+    # used to lose digits to cancellation
+    for alpha in (.3, .5, .8):
+        assert amax(abs(march('soe', alpha) - march('full', alpha))) < 1e-8